@@ -0,0 +1,402 @@
+#!/usr/bin/python3
+# coding: utf-8
+import sys
+import struct
+import asyncio
+import argparse
+import resource
+from ipaddress import IPv4Address
+from os.path import dirname, abspath
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from lib.xdr import Packer, Unpacker
+from lib.portmap import Portmap, map_entry
+from lib.mount import Mount
+from lib.nfs import NFS, fattr3, fsinfo_result
+
+#
+# Author: Hegusung
+#
+
+# Loopback stand-in for a NAS: portmap, mountd and nfsd on the same port of many
+# loopback addresses, serving the same synthetic tree. Only the procedures
+# called by lib/ are implemented: portmap NULL, GETPORT and DUMP, mount NULL,
+# MNT and EXPORT, NFS NULL, GETATTR, LOOKUP, READ, READDIRPLUS and FSINFO.
+
+call_header = struct.Struct('!LLLLLL')
+reply_header = struct.Struct('!LLLLLL')
+handle_format = struct.Struct('!4sQ')
+
+# accept states
+SUCCESS = 0
+PROG_UNAVAIL = 1
+PROC_UNAVAIL = 3
+
+# NFS errors
+NFS3ERR_NOENT = 2
+NFS3ERR_NOTDIR = 20
+NFS3ERR_STALE = 70
+NFS3ERR_BAD_COOKIE = 10003
+
+rtmax = 1024*1024
+readdir_max = 64*1024
+
+# the content of the files depends on the offset only, a 251 bytes pattern
+pattern = bytes(range(251)) * (rtmax // 251 + 2)
+
+class Tree(object):
+    def __init__(self, dirs=3, files=5, depth=2, file_size=1000, big_dir=0, big_file=0):
+        # file id -> {"file_type", "file_size", "children": [(name, file id)] for directories}
+        self.nodes = {}
+        self.root = self.mkdir(depth, dirs, files, file_size)
+
+        children = self.nodes[self.root]["children"]
+        if big_dir:
+            big = self.mkdir(0, 0, big_dir, 1024)
+            children.append(("big", big))
+        if big_file:
+            children.append(("bigfile", self.new(1, big_file)))
+
+        for node in self.nodes.values():
+            if node["file_type"] == 2:
+                node["names"] = dict(node["children"])
+
+    def new(self, file_type, file_size):
+        file_id = len(self.nodes) + 1
+        self.nodes[file_id] = {"file_type": file_type, "file_size": file_size, "children": [] if file_type == 2 else None}
+        return file_id
+
+    def mkdir(self, depth, dirs, files, file_size):
+        file_id = self.new(2, 4096)
+        children = self.nodes[file_id]["children"]
+        for index in range(files):
+            children.append(("file%d.txt" % index, self.new(1, file_size)))
+        if depth > 0:
+            for index in range(dirs):
+                children.append(("dir%d" % index, self.mkdir(depth-1, dirs, files, file_size)))
+        return file_id
+
+    def handle(self, file_id):
+        return handle_format.pack(b"FAKE", file_id)
+
+    def file_id(self, handle):
+        if len(handle) != handle_format.size:
+            return None
+        magic, file_id = handle_format.unpack(handle)
+        if magic != b"FAKE" or file_id not in self.nodes:
+            return None
+        return file_id
+
+    def pack_fattr(self, packer, file_id):
+        node = self.nodes[file_id]
+        mtime = 1600000000 + file_id
+        packer.pack_struct(fattr3, node["file_type"], 0o755, 1, 0, 0, node["file_size"], node["file_size"], 0, 0, 1, file_id, mtime, 0, mtime, 0, mtime, 0)
+
+    def pack_post_op_attr(self, packer, file_id):
+        packer.pack_uint(1)
+        self.pack_fattr(packer, file_id)
+
+class Server(object):
+    def __init__(self, tree, port, exports, latency=0.0):
+        self.tree = tree
+        self.port = port
+        self.exports = exports
+        self.latency = latency
+        self.services = [
+            (Portmap.program, Portmap.program_version, 6),
+            (Portmap.program, Portmap.program_version, 17),
+            (Mount.program, Mount.program_version, 6),
+            (NFS.program, NFS.program_version, 6),
+        ]
+
+    def handle_call(self, call):
+        # returns the reply, None to drop the call
+        unpacker = Unpacker(call)
+        try:
+            xid, message_type, rpc_version, program, program_version, procedure = unpacker.unpack_struct(call_header)
+            for _ in range(2): # credentials, verifier
+                unpacker.unpack_uint()
+                unpacker.unpack_opaque_view()
+        except struct.error:
+            return None
+
+        if message_type != 0:
+            return None
+
+        packer = Packer()
+        packer.pack_struct(reply_header, xid, 1, 0, 0, 0, SUCCESS)
+
+        procedures = {
+            Portmap.program: {0: self.null, 3: self.getport, 4: self.dump},
+            Mount.program: {0: self.null, 1: self.mnt, 5: self.export},
+            NFS.program: {0: self.null, 1: self.getattr, 3: self.lookup, 6: self.read, 17: self.readdirplus, 19: self.fsinfo},
+        }
+
+        if program not in procedures:
+            accept_state = PROG_UNAVAIL
+        elif procedure not in procedures[program]:
+            accept_state = PROC_UNAVAIL
+        else:
+            try:
+                procedures[program][procedure](unpacker, packer)
+                accept_state = SUCCESS
+            except struct.error:
+                accept_state = 4 # GARBAGE_ARGS
+
+        if accept_state != SUCCESS:
+            packer.reset()
+            packer.pack_struct(reply_header, xid, 1, 0, 0, 0, accept_state)
+
+        return bytes(packer.get_view())
+
+    def null(self, unpacker, packer):
+        pass
+
+    def getport(self, unpacker, packer):
+        program, program_version, protocol, _ = unpacker.unpack_struct(map_entry)
+        port = self.port if (program, program_version, protocol) in self.services else 0
+        packer.pack_uint(port)
+
+    def dump(self, unpacker, packer):
+        for program, program_version, protocol in self.services:
+            packer.pack_uint(1)
+            packer.pack_struct(map_entry, program, program_version, protocol, self.port)
+        packer.pack_uint(0)
+
+    def mnt(self, unpacker, packer):
+        path = unpacker.unpack_string()
+        if path not in self.exports:
+            packer.pack_uint(NFS3ERR_NOENT)
+            return
+
+        packer.pack_uint(0)
+        packer.pack_opaque(self.tree.handle(self.tree.root))
+        packer.pack_uint(1)
+        packer.pack_uint(1) # AUTH_UNIX
+
+    def export(self, unpacker, packer):
+        for path in self.exports:
+            packer.pack_uint(1)
+            packer.pack_string(path)
+            packer.pack_uint(1)
+            packer.pack_string("*")
+            packer.pack_uint(0)
+        packer.pack_uint(0)
+
+    def getattr(self, unpacker, packer):
+        file_id = self.tree.file_id(unpacker.unpack_opaque())
+        if file_id == None:
+            packer.pack_uint(NFS3ERR_STALE)
+            return
+
+        packer.pack_uint(0)
+        self.tree.pack_fattr(packer, file_id)
+
+    def lookup(self, unpacker, packer):
+        dir_id = self.tree.file_id(unpacker.unpack_opaque())
+        name = unpacker.unpack_string()
+        if dir_id == None:
+            packer.pack_uint(NFS3ERR_STALE)
+            packer.pack_uint(0)
+            return
+
+        node = self.tree.nodes[dir_id]
+        if node["file_type"] != 2:
+            packer.pack_uint(NFS3ERR_NOTDIR)
+            self.tree.pack_post_op_attr(packer, dir_id)
+            return
+
+        file_id = node["names"].get(name)
+        if file_id == None:
+            packer.pack_uint(NFS3ERR_NOENT)
+            self.tree.pack_post_op_attr(packer, dir_id)
+            return
+
+        packer.pack_uint(0)
+        packer.pack_opaque(self.tree.handle(file_id))
+        self.tree.pack_post_op_attr(packer, file_id)
+        self.tree.pack_post_op_attr(packer, dir_id)
+
+    def read(self, unpacker, packer):
+        file_id = self.tree.file_id(unpacker.unpack_opaque())
+        offset = unpacker.unpack_uhyper()
+        count = min(unpacker.unpack_uint(), rtmax)
+        if file_id == None:
+            packer.pack_uint(NFS3ERR_STALE)
+            packer.pack_uint(0)
+            return
+
+        file_size = self.tree.nodes[file_id]["file_size"]
+        end = min(offset + count, file_size)
+        count = max(end - offset, 0)
+        start = offset % 251
+
+        packer.pack_uint(0)
+        self.tree.pack_post_op_attr(packer, file_id)
+        packer.pack_uint(count)
+        packer.pack_uint(1 if offset + count >= file_size else 0)
+        packer.pack_opaque(memoryview(pattern)[start:start+count])
+
+    def readdirplus(self, unpacker, packer):
+        dir_id = self.tree.file_id(unpacker.unpack_opaque())
+        cookie = unpacker.unpack_uhyper()
+        cookie_verifier = unpacker.unpack_uhyper()
+        dircount = unpacker.unpack_uint()
+        maxcount = min(unpacker.unpack_uint(), readdir_max)
+        if dir_id == None:
+            packer.pack_uint(NFS3ERR_STALE)
+            packer.pack_uint(0)
+            return
+
+        node = self.tree.nodes[dir_id]
+        if node["file_type"] != 2:
+            packer.pack_uint(NFS3ERR_NOTDIR)
+            self.tree.pack_post_op_attr(packer, dir_id)
+            return
+
+        # the verifier of a directory is its file id, it never changes
+        if cookie != 0 and cookie_verifier != dir_id:
+            packer.pack_uint(NFS3ERR_BAD_COOKIE)
+            self.tree.pack_post_op_attr(packer, dir_id)
+            return
+
+        packer.pack_uint(0)
+        self.tree.pack_post_op_attr(packer, dir_id)
+        packer.pack_uhyper(dir_id)
+
+        entries = [(".", dir_id), ("..", dir_id)] + node["children"]
+        # entry: value follows, file id, name, cookie, attributes, handle
+        entry_size = 4 + 8 + 4 + 8 + 4 + fattr3.size + 4 + 4 + handle_format.size
+        index = cookie
+        start = packer.offset
+        while index < len(entries):
+            name, file_id = entries[index]
+            if packer.offset - start + entry_size + len(name) + 3 + 8 > maxcount:
+                break
+
+            packer.pack_uint(1)
+            packer.pack_uhyper(file_id)
+            packer.pack_string(name)
+            packer.pack_uhyper(index + 1)
+            self.tree.pack_post_op_attr(packer, file_id)
+            packer.pack_uint(1)
+            packer.pack_opaque(self.tree.handle(file_id))
+            index += 1
+
+        packer.pack_uint(0)
+        packer.pack_uint(1 if index >= len(entries) else 0)
+
+    def fsinfo(self, unpacker, packer):
+        file_id = self.tree.file_id(unpacker.unpack_opaque())
+        if file_id == None:
+            packer.pack_uint(NFS3ERR_STALE)
+            packer.pack_uint(0)
+            return
+
+        packer.pack_uint(0)
+        self.tree.pack_post_op_attr(packer, file_id)
+        packer.pack_struct(fsinfo_result, rtmax, rtmax, 4096, rtmax, rtmax, 4096, readdir_max, 1 << 40, 0, 1, 0x1b)
+
+class TCPService(object):
+    def __init__(self, server):
+        self.server = server
+
+    async def __call__(self, reader, writer):
+        tasks = set()
+        try:
+            while True:
+                fragments = []
+                last_fragment = False
+                while not last_fragment:
+                    (header,) = struct.unpack('!L', await reader.readexactly(4))
+                    last_fragment = header & 0x80000000 != 0
+                    fragments.append(await reader.readexactly(header & 0x7fffffff))
+
+                # calls are answered concurrently, as a real server does
+                task = asyncio.ensure_future(self.reply(b"".join(fragments), writer))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            for task in tasks:
+                task.cancel()
+            writer.close()
+
+    async def reply(self, call, writer):
+        if self.server.latency:
+            await asyncio.sleep(self.server.latency)
+
+        reply = self.server.handle_call(call)
+        if reply == None or writer.is_closing():
+            return
+
+        writer.write(struct.pack('!L', 0x80000000 | len(reply)) + reply)
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+
+class UDPService(asyncio.DatagramProtocol):
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        reply = self.server.handle_call(data)
+        if reply != None:
+            self.transport.sendto(reply, addr)
+
+def host_addresses(count):
+    # 127.0.0.1, 127.0.0.2, ... skipping the network and broadcast addresses of every /24
+    addresses = []
+    address = IPv4Address("127.0.0.1")
+    while len(addresses) < count:
+        if int(address) & 0xff not in [0, 255]:
+            addresses.append(str(address))
+        address += 1
+    return addresses
+
+async def serve(args):
+    tree = Tree(args.dirs, args.files, args.depth, args.file_size, args.big_dir, args.big_file)
+    server = Server(tree, args.port, args.exports.split(","), args.latency)
+
+    loop = asyncio.get_running_loop()
+    for host in host_addresses(args.hosts):
+        await asyncio.start_server(TCPService(server), host, args.port)
+        await loop.create_datagram_endpoint(lambda: UDPService(server), local_addr=(host, args.port))
+
+    print("ready %d hosts, %d files" % (args.hosts, len(tree.nodes)), flush=True)
+    await asyncio.Event().wait()
+
+def main():
+    parser = argparse.ArgumentParser(description='fake portmap/mountd/nfsd server on loopback addresses', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--hosts', help='number of loopback addresses served, from 127.0.0.1', nargs='?', default=1, type=int, dest='hosts')
+    parser.add_argument('-p', help='port of every service', nargs='?', default=1111, type=int, dest='port')
+    parser.add_argument('--latency', help='delay before every reply (seconds)', nargs='?', default=0.0, type=float, dest='latency')
+    parser.add_argument('--exports', help='comma separated exports, all serving the same tree', nargs='?', default="/export", type=str, dest='exports')
+    parser.add_argument('--dirs', help='number of subdirectories per directory', nargs='?', default=3, type=int, dest='dirs')
+    parser.add_argument('--files', help='number of files per directory', nargs='?', default=5, type=int, dest='files')
+    parser.add_argument('--depth', help='depth of the tree', nargs='?', default=2, type=int, dest='depth')
+    parser.add_argument('--file-size', help='size of the files of the tree', nargs='?', default=1000, type=int, dest='file_size')
+    parser.add_argument('--big-dir', help='number of files of the /big directory, none if 0', nargs='?', default=0, type=int, dest='big_dir')
+    parser.add_argument('--big-file', help='size of the /bigfile file, none if 0', nargs='?', default=0, type=int, dest='big_file')
+
+    args = parser.parse_args()
+
+    # two sockets per host
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,297 @@
+#!/usr/bin/python3
+# coding: utf-8
+import gc
+import os
+import sys
+import json
+import time
+import argparse
+import tracemalloc
+from glob import glob
+from os.path import join, dirname, abspath, basename
+from urllib.parse import urlparse
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from lib.xdr import Packer
+from lib.portmap import Portmap, map_entry, parse_dump, pack_dump, dump_ports, resolve_port
+from lib.mount import Mount, parse_export
+from lib.nfs import NFS, fattr3, parse_readdirplus, pack_readdirplus, readdirplus_dircount
+from lib.lookup import resolve_path
+
+#
+# Author: Hegusung
+#
+
+# Micro-benchmark of the reply parsers: parse_readdirplus, parse_export and
+# parse_dump are timed on a corpus of replies (the procedure results, without
+# the RPC header), synthesized or recorded from real servers with --record.
+# The allocations of a parse are counted with tracemalloc. The results can be
+# saved as a baseline, a run slower or allocating more than the baseline by
+# more than the thresholds fails. The allocations are exact, the timings depend
+# on the load of the machine.
+
+parsers = {
+    "readdirplus": parse_readdirplus,
+    "export": parse_export,
+    "dump": parse_dump,
+}
+
+def count_entries(kind, result):
+    if kind == "readdirplus":
+        return len(result["contents"])
+    return len(result)
+
+def synth_readdirplus(entries, attributes=True, handle_size=32):
+    packer = Packer()
+    packer.pack_uint(0) # NFS3_OK
+    packer.pack_uint(1)
+    packer.pack_struct(fattr3, 2, 0o755, 2, 0, 0, 4096, 4096, 0, 0, 1, 1, 1600000000, 0, 1600000000, 0, 1600000000, 0)
+    packer.pack_uhyper(1) # cookie verifier
+
+    for index in range(entries):
+        file_id = index + 2
+        packer.pack_uint(1)
+        packer.pack_uhyper(file_id)
+        packer.pack_string("file_%08d.dat" % index)
+        packer.pack_uhyper(index + 1)
+        if attributes:
+            packer.pack_uint(1)
+            packer.pack_struct(fattr3, 1, 0o644, 1, 1000, 1000, index*512, index*512, 0, 0, 1, file_id, 1600000000 + index, 0, 1600000000 + index, 0, 1600000000 + index, 0)
+            packer.pack_uint(1)
+            packer.pack_opaque(file_id.to_bytes(8, "big") * (handle_size // 8))
+        else:
+            packer.pack_uint(0)
+            packer.pack_uint(0)
+
+    packer.pack_uint(0)
+    packer.pack_uint(1) # EOF
+    return bytes(packer.get_view())
+
+def synth_export(exports, groups=4):
+    packer = Packer()
+    for index in range(exports):
+        packer.pack_uint(1)
+        packer.pack_string("/srv/nfs/share%04d" % index)
+        for group in range(groups):
+            packer.pack_uint(1)
+            packer.pack_string("10.%d.%d.0/24" % (index % 256, group))
+        packer.pack_uint(0)
+    packer.pack_uint(0)
+    return bytes(packer.get_view())
+
+def synth_dump(entries):
+    packer = Packer()
+    for index in range(entries):
+        packer.pack_uint(1)
+        # programs with 4 versions over tcp and udp
+        packer.pack_struct(map_entry, 100000 + index // 8, 1 + index % 4, 6 if index % 8 < 4 else 17, 1024 + index)
+    packer.pack_uint(0)
+    return bytes(packer.get_view())
+
+def synthesized_corpus():
+    # name -> (kind, data)
+    return {
+        "readdirplus-10k": ("readdirplus", synth_readdirplus(10000)),
+        "readdirplus-10k-noattr": ("readdirplus", synth_readdirplus(10000, attributes=False)),
+        "readdirplus-100": ("readdirplus", synth_readdirplus(100)),
+        "export-500": ("export", synth_export(500)),
+        "export-10": ("export", synth_export(10)),
+        "dump-2000": ("dump", synth_dump(2000)),
+        "dump-20": ("dump", synth_dump(20)),
+    }
+
+def recorded_corpus(directory):
+    # files <kind>-<name>.xdr
+    corpus = {}
+    for path in sorted(glob(join(directory, "*.xdr"))):
+        name = basename(path)[:-4]
+        kind = name.split("-")[0]
+        if kind not in parsers:
+            continue
+        with open(path, "rb") as f:
+            corpus["recorded/" + name] = (kind, f.read())
+    return corpus
+
+def record(nfs_path, directory, port, timeout, auth):
+    # saves the DUMP, EXPORT and first READDIRPLUS replies of a server to the corpus
+    o = urlparse(nfs_path)
+    host = o.netloc
+    name = host.replace(":", "_")
+
+    os.makedirs(directory, exist_ok=True)
+
+    def save(kind, data):
+        path = join(directory, "%s-%s.xdr" % (kind, name))
+        with open(path, "wb") as f:
+            f.write(data)
+        print("%s: %d bytes" % (path, len(data)))
+
+    portmap = Portmap(host, port, timeout)
+    portmap.connect()
+    save("dump", bytes(portmap.request(Portmap.program, Portmap.program_version, 4, pack_args=lambda packer: pack_dump(packer, Portmap.program_version, 4))))
+
+    mount_port = resolve_port(portmap, dump_ports(portmap), Mount.program, Mount.program_version)
+    portmap.disconnect()
+
+    mount = Mount(host, mount_port, timeout)
+    mount.connect()
+    save("export", bytes(mount.request(Mount.program, Mount.program_version, 5)))
+    mount.disconnect()
+
+    res = resolve_path(host, o.path, timeout, auth=auth, portmapper_port=port)
+    nfs = res["nfs"]
+    # one reply as big as the server allows
+    maxcount = nfs.get_readdirplus_limit(res["file_handle"], auth=auth)
+    save("readdirplus", bytes(nfs.request(NFS.program, NFS.program_version, 17, pack_args=lambda packer: pack_readdirplus(packer, res["file_handle"], 0, 0, max(readdirplus_dircount, maxcount // 4), maxcount), auth=auth)))
+    nfs.disconnect()
+
+def bench(kind, data, min_time=0.5, repeat=20):
+    parse = parsers[kind]
+
+    # the garbage collector runs are not counted, as timeit does
+    gc.collect()
+    gc.disable()
+    try:
+        seconds = timing(parse, data, min_time, repeat)
+    finally:
+        gc.enable()
+
+    # allocations of one parse: memory blocks still held by the result, and peak of the memory allocated
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    tracemalloc.reset_peak()
+    result = parse(data)
+    _, peak = tracemalloc.get_traced_memory()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    blocks = sum(stat.count_diff for stat in after.compare_to(before, "filename"))
+    entries = count_entries(kind, result)
+
+    return {
+        "kind": kind,
+        "bytes": len(data),
+        "entries": entries,
+        "seconds": seconds,
+        "allocations": blocks,
+        "peak_bytes": peak,
+    }
+
+def timing(parse, data, min_time, repeat):
+    # fastest of repeat timings, the loops per timing are set so that a timing lasts about min_time / repeat
+    loops = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(loops):
+            parse(data)
+        if time.perf_counter() - start >= min_time / repeat:
+            break
+        loops *= 2
+
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(loops):
+            parse(data)
+        timings.append((time.perf_counter() - start) / loops)
+
+    return min(timings)
+
+def compare(results, baseline, time_threshold, allocation_threshold):
+    # returns the regressions: (name, metric, value, baseline value)
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        # the allocation counts vary by a few blocks of tracemalloc itself
+        for metric, threshold, slack in [("seconds", time_threshold, 0), ("allocations", allocation_threshold, 4)]:
+            # baselines made with --allocations-only have no timings
+            if metric not in baseline[name]:
+                continue
+            if result[metric] > baseline[name][metric] * (1 + threshold) + slack:
+                regressions.append((name, metric, result[metric], baseline[name][metric]))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the RPC reply parsers', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--corpus', help='directory of recorded replies, <kind>-<name>.xdr with kind readdirplus, export or dump', nargs='?', default=join(dirname(abspath(__file__)), "corpus"), type=str, dest='corpus')
+    parser.add_argument('--record', help='record the DUMP, EXPORT and READDIRPLUS replies of nfs://<host>/<directory> to the corpus', nargs='?', default=None, type=str, dest='record')
+    parser.add_argument('-p', help='portmapper port of --record', nargs='?', default=111, type=int, dest='port')
+    parser.add_argument('-t', help='timeout of --record', nargs='?', default=15, type=int, dest='timeout')
+    parser.add_argument('-u', help='uid of --record', nargs='?', default=0, type=int, dest='uid')
+    parser.add_argument('-g', help='gid of --record', nargs='?', default=0, type=int, dest='gid')
+    parser.add_argument('--filter', help='only benchmark the replies whose name contains this string', nargs='?', default=None, type=str, dest='filter')
+    parser.add_argument('--min-time', help='time spent timing each reply (seconds)', nargs='?', default=0.5, type=float, dest='min_time')
+    parser.add_argument('--baseline', help='JSON file of the results the run is compared to, the default one holds the allocation counts of the synthesized replies', nargs='?', default=join(dirname(abspath(__file__)), "parsers_baseline.json"), type=str, dest='baseline')
+    parser.add_argument('--save-baseline', help='save the results to the --baseline file', action='store_true', dest='save_baseline')
+    parser.add_argument('--allocations-only', help='save the allocation counts only to the baseline, the timings depend on the machine', action='store_true', dest='allocations_only')
+    parser.add_argument('--time-threshold', help='fail if a reply takes more time than the baseline by this ratio', nargs='?', default=0.25, type=float, dest='time_threshold')
+    parser.add_argument('--allocation-threshold', help='fail if a reply takes more allocations than the baseline by this ratio', nargs='?', default=0.05, type=float, dest='allocation_threshold')
+    parser.add_argument('--json', help='output the results as JSON', action='store_true', dest='json')
+
+    args = parser.parse_args()
+
+    if args.record != None:
+        auth = {
+            "flavor": 1, #AUTH_UNIX
+            "machine_name": "nfsclient",
+            "uid": args.uid,
+            "gid": args.gid,
+            "aux_gid": [args.gid],
+        }
+        record(args.record, args.corpus, args.port, args.timeout, auth)
+        return
+
+    if not args.save_baseline and not os.path.exists(args.baseline):
+        parser.error("baseline %s not found, create it with --save-baseline" % args.baseline)
+
+    corpus = synthesized_corpus()
+    corpus.update(recorded_corpus(args.corpus))
+
+    results = {}
+    for name, (kind, data) in corpus.items():
+        if args.filter != None and args.filter not in name:
+            continue
+        results[name] = bench(kind, data, min_time=args.min_time)
+
+    python_version = "%d.%d" % sys.version_info[:2]
+
+    baseline = {}
+    if not args.save_baseline:
+        with open(args.baseline) as f:
+            saved = json.load(f)
+        baseline = saved["replies"]
+        # the allocations depend on the Python version
+        if saved["python"] != python_version:
+            print("warning: baseline made with Python %s, running Python %s" % (saved["python"], python_version), file=sys.stderr)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print("%-32s %10s %8s %12s %10s %12s %10s %8s" % ("reply", "bytes", "entries", "us/reply", "ns/entry", "allocations", "peak KB", "vs base"))
+        for name, result in results.items():
+            ratio = ""
+            if "seconds" in baseline.get(name, {}):
+                ratio = "%+.0f%%" % ((result["seconds"] / baseline[name]["seconds"] - 1) * 100)
+            print("%-32s %10d %8d %12.1f %10.1f %12d %10.1f %8s" % (
+                name, result["bytes"], result["entries"], result["seconds"]*1e6,
+                result["seconds"]*1e9 / max(result["entries"], 1), result["allocations"],
+                result["peak_bytes"] / 1024, ratio))
+
+    if args.save_baseline:
+        replies = results
+        if args.allocations_only:
+            replies = {name: {"kind": result["kind"], "allocations": result["allocations"]} for name, result in results.items()}
+        with open(args.baseline, "w") as f:
+            json.dump({"python": python_version, "replies": replies}, f, indent=2)
+        return
+
+    regressions = compare(results, baseline, args.time_threshold, args.allocation_threshold)
+    for name, metric, value, base in regressions:
+        print("regression: %s %s %g, baseline %g" % (name, metric, value, base), file=sys.stderr)
+    if len(regressions) != 0:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
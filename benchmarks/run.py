@@ -0,0 +1,162 @@
+#!/usr/bin/python3
+# coding: utf-8
+import os
+import sys
+import json
+import time
+import shlex
+import argparse
+import tempfile
+import subprocess
+from os.path import join, dirname, abspath
+
+from fake_server import host_addresses
+
+#
+# Author: Hegusung
+#
+
+# End to end benchmark: rpc-scan.py, nfs-ls.py and nfs-get.py are run against
+# benchmarks/fake_server.py, serving the same synthetic tree on many loopback
+# addresses, and their throughput is reported.
+
+root = dirname(dirname(abspath(__file__)))
+
+def start_server(args):
+    command = [
+        sys.executable, join(root, "benchmarks", "fake_server.py"),
+        "--hosts", str(args.hosts),
+        "-p", str(args.port),
+        "--latency", str(args.latency),
+        "--dirs", str(args.dirs),
+        "--files", str(args.files),
+        "--depth", str(args.depth),
+        "--big-dir", str(args.big_dir),
+        "--big-file", str(args.big_file),
+    ]
+    server = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+
+    line = server.stdout.readline()
+    if not line.startswith("ready"):
+        server.kill()
+        raise Exception("fake server did not start: %s" % line.strip())
+
+    return server
+
+def run(command, cwd=None):
+    # returns (duration, stdout)
+    start = time.perf_counter()
+    result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, cwd=cwd)
+    duration = time.perf_counter() - start
+
+    if result.returncode != 0:
+        raise Exception("%s failed (%d): %s" % (os.path.basename(command[1]), result.returncode, result.stderr.strip()))
+
+    return duration, result.stdout
+
+def bench_scan(args, host_file):
+    command = [
+        sys.executable, join(root, "rpc-scan.py"),
+        "-H", host_file, "-p", str(args.port),
+        "--rpc", "--mounts", "--nfs", "--recurse", str(args.depth + 1),
+        "--jsonl",
+    ] + shlex.split(args.scan_args)
+    duration, output = run(command)
+
+    hosts = 0
+    entries = 0
+    for line in output.splitlines():
+        record = json.loads(line)
+        if record["type"] == "portmapper":
+            hosts += 1
+        elif record["type"] == "nfs":
+            entries += 1
+
+    if hosts != args.hosts:
+        raise Exception("rpc-scan.py found %d hosts out of %d" % (hosts, args.hosts))
+
+    return {"seconds": duration, "hosts": hosts, "entries": entries, "hosts/s": hosts / duration, "entries/s": entries / duration}
+
+def bench_ls(args):
+    command = [
+        sys.executable, join(root, "nfs-ls.py"),
+        "nfs://127.0.0.1/export/big", "-p", str(args.port),
+    ]
+    duration, output = run(command)
+
+    # . and .. are listed too
+    entries = len(output.splitlines())
+    if entries != args.big_dir + 2:
+        raise Exception("nfs-ls.py listed %d entries out of %d" % (entries, args.big_dir + 2))
+
+    return {"seconds": duration, "entries": entries, "entries/s": entries / duration}
+
+def bench_get(args, directory):
+    destination = join(directory, "bigfile")
+    command = [
+        sys.executable, join(root, "nfs-get.py"),
+        "nfs://127.0.0.1/export/bigfile", "-p", str(args.port),
+        "-d", destination, "--no-checkpoint",
+    ] + shlex.split(args.get_args)
+    duration, _ = run(command)
+
+    size = os.path.getsize(destination)
+    os.remove(destination)
+    if size != args.big_file:
+        raise Exception("nfs-get.py downloaded %d bytes out of %d" % (size, args.big_file))
+
+    return {"seconds": duration, "bytes": size, "MB/s": size / duration / 1e6}
+
+def best(runs):
+    # the fastest run is the least disturbed by the rest of the system
+    return min(runs, key=lambda result: result["seconds"])
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark rpc-scan.py, nfs-ls.py and nfs-get.py against a local fake server', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--hosts', help='number of loopback hosts scanned by rpc-scan.py', nargs='?', default=64, type=int, dest='hosts')
+    parser.add_argument('-p', help='port of the fake server', nargs='?', default=1111, type=int, dest='port')
+    parser.add_argument('--latency', help='delay of the fake server before every reply (seconds)', nargs='?', default=0.0, type=float, dest='latency')
+    parser.add_argument('--dirs', help='number of subdirectories per directory', nargs='?', default=3, type=int, dest='dirs')
+    parser.add_argument('--files', help='number of files per directory', nargs='?', default=5, type=int, dest='files')
+    parser.add_argument('--depth', help='depth of the tree', nargs='?', default=2, type=int, dest='depth')
+    parser.add_argument('--big-dir', help='number of files of the directory listed by nfs-ls.py, also listed by rpc-scan.py', nargs='?', default=2000, type=int, dest='big_dir')
+    parser.add_argument('--big-file', help='size of the file downloaded by nfs-get.py (bytes)', nargs='?', default=64*1024*1024, type=int, dest='big_file')
+    parser.add_argument('--repeat', help='number of runs of each benchmark, the fastest is reported', nargs='?', default=3, type=int, dest='repeat')
+    parser.add_argument('--scan-args', help='additional rpc-scan.py arguments', nargs='?', default="", type=str, dest='scan_args')
+    parser.add_argument('--get-args', help='additional nfs-get.py arguments', nargs='?', default="", type=str, dest='get_args')
+    parser.add_argument('--json', help='output the results as JSON', action='store_true', dest='json')
+
+    args = parser.parse_args()
+
+    server = start_server(args)
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            host_file = join(directory, "hosts.txt")
+            with open(host_file, "w") as f:
+                for host in host_addresses(args.hosts):
+                    f.write("%s:%d\n" % (host, args.port))
+
+            results = {
+                "rpc-scan.py": best([bench_scan(args, host_file) for _ in range(args.repeat)]),
+                "nfs-ls.py": best([bench_ls(args) for _ in range(args.repeat)]) if args.big_dir else None,
+                "nfs-get.py": best([bench_get(args, directory) for _ in range(args.repeat)]) if args.big_file else None,
+            }
+    finally:
+        server.terminate()
+        server.wait()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    scan = results["rpc-scan.py"]
+    print("rpc-scan.py  %8.2f s  %10.1f hosts/s  %10.1f entries/s" % (scan["seconds"], scan["hosts/s"], scan["entries/s"]))
+    if results["nfs-ls.py"] != None:
+        ls = results["nfs-ls.py"]
+        print("nfs-ls.py    %8.2f s  %10.1f entries/s" % (ls["seconds"], ls["entries/s"]))
+    if results["nfs-get.py"] != None:
+        get = results["nfs-get.py"]
+        print("nfs-get.py   %8.2f s  %10.1f MB/s" % (get["seconds"], get["MB/s"]))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,303 @@
+import socket
+import asyncio
+
+from .rpc import RPC, RPCProtocolError, bind_reserved_port
+from .stats import CONNECT
+from .xdr import uint
+from .portmap import Portmap, pack_dump, parse_dump, pack_getport, parse_getport
+from .mount import Mount, pack_mnt, parse_mnt, parse_export
+from .nfs import NFS, NFSAccessError, encode_handle, parse_getattr, pack_readdirplus, parse_readdirplus, grow_readdirplus_counts, readdirplus_dircount, readdirplus_maxcount, parse_fsinfo
+
+#
+# Author: Hegusung
+#
+
+# asyncio versions of the RPC clients, used by rpc-scan.py to scan many hosts concurrently
+# call encoding and reply parsing are shared with the blocking clients
+
+class AsyncRPC(RPC):
+    def __init__(self, host, port, timeout):
+        super(AsyncRPC, self).__init__(host, port, timeout)
+        self.reader = None
+        self.writer = None
+        self.reader_task = None
+        # futures of the calls in flight, by XID
+        self.pending = {}
+        # HostTimeouts shared by the connections to the host, None to use timeout for everything
+        self.timeouts = None
+        # HostLimiter shared by the connections to the host, None for no rate limit
+        self.limiter = None
+
+    async def request(self, program, program_version, procedure, data=None, message_type=0, version=2, auth=None, pack_args=None):
+        if self.reader_task.done():
+            raise ConnectionResetError("connection closed by %s:%d" % (self.host, self.port))
+
+        xid = self.next_xid()
+        # the transport may keep a reference to the data, do not give it the packer buffer
+        proto = bytes(self.build_call(program, program_version, procedure, data=data, message_type=message_type, version=version, auth=auth, xid=xid, pack_args=pack_args))
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending[xid] = future
+
+        if self.limiter != None:
+            await self.limiter.call(len(proto))
+
+        timeout = self.read_timeout() if self.timeouts != None else self.timeout
+        start = loop.time()
+        try:
+            self.writer.write(proto)
+            await asyncio.wait_for(self.writer.drain(), timeout)
+
+            try:
+                data = await asyncio.wait_for(asyncio.shield(future), timeout)
+            except asyncio.TimeoutError:
+                if self.timeouts == None:
+                    raise
+                # TCP does not lose the call, the reply is slow (big reply, slow link): wait once more with the backed-off timeout
+                self.timeouts.read.timed_out()
+                data = await asyncio.wait_for(future, self.read_timeout())
+        except Exception as e:
+            if isinstance(e, asyncio.TimeoutError) and self.timeouts != None:
+                self.timeouts.read.timed_out()
+            if isinstance(e, (asyncio.TimeoutError, ConnectionResetError)) and self.limiter != None:
+                self.limiter.report(False)
+            if self.stats != None:
+                self.stats.record(program, procedure, loop.time() - start, len(proto), error=e)
+            raise
+        finally:
+            self.pending.pop(xid, None)
+
+        elapsed = loop.time() - start
+        if self.timeouts != None:
+            self.timeouts.read.sample(elapsed)
+        if self.limiter != None:
+            self.limiter.report(True)
+            await self.limiter.transferred(len(data))
+
+        if self.stats == None:
+            return self.parse_reply(data)
+
+        # the replies rejected by the server are counted as errors
+        try:
+            reply = self.parse_reply(data)
+        except Exception as e:
+            self.stats.record(program, procedure, elapsed, len(proto), len(data) + 4, e)
+            raise
+        self.stats.record(program, procedure, elapsed, len(proto), len(data) + 4)
+
+        return reply
+
+    def read_timeout(self):
+        # the reply is read after the replies of the calls in flight before it, the timeout grows with them up to the ceiling
+        timeout = self.timeouts.read.timeout()
+        return max(min(timeout*len(self.pending), self.timeouts.read.ceiling), timeout)
+
+    async def read_replies(self):
+        # dispatch every reply read on the connection to the call waiting for its XID
+        try:
+            while True:
+                last_fragment, data = await self.recv_fragment()
+
+                if not last_fragment:
+                    fragments = [data]
+                    while not last_fragment:
+                        last_fragment, data = await self.recv_fragment()
+                        fragments.append(data)
+                    data = b"".join(fragments)
+
+                if len(data) < 4:
+                    raise RPCProtocolError("incorrect struct size")
+
+                (xid,) = uint.unpack_from(data)
+                future = self.pending.get(xid)
+                if future != None and not future.done():
+                    future.set_result(data)
+        except Exception as e:
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(e)
+
+    async def connect(self):
+        loop = asyncio.get_running_loop()
+
+        client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        client.setblocking(False)
+        bind_reserved_port(client)
+
+        if self.limiter != None:
+            await self.limiter.connection()
+
+        timeout = self.timeouts.connect.timeout() if self.timeouts != None else self.timeout
+        start = loop.time()
+        try:
+            await asyncio.wait_for(loop.sock_connect(client, (self.host, self.port)), timeout)
+        except BaseException as e:
+            client.close()
+            if isinstance(e, asyncio.TimeoutError) and self.timeouts != None:
+                self.timeouts.connect.timed_out()
+            # a rate limiting middlebox answers the SYNs with a RST
+            if isinstance(e, (asyncio.TimeoutError, ConnectionResetError, ConnectionRefusedError)) and self.limiter != None:
+                self.limiter.report(False)
+            if isinstance(e, Exception) and self.stats != None:
+                self.stats.record(self.program, CONNECT, loop.time() - start, error=e)
+            raise
+
+        elapsed = loop.time() - start
+        if self.timeouts != None:
+            self.timeouts.connect.sample(elapsed)
+        if self.limiter != None:
+            self.limiter.report(True)
+        if self.stats != None:
+            self.stats.record(self.program, CONNECT, elapsed)
+
+        self.client = client
+        self.reader, self.writer = await asyncio.open_connection(sock=client)
+        self.reader_task = asyncio.ensure_future(self.read_replies())
+
+    async def disconnect(self):
+        self.reader_task.cancel()
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except OSError:
+            pass
+
+    async def recv_fragment(self):
+        try:
+            (rpc_fragment_header,) = uint.unpack(await self.reader.readexactly(4))
+
+            last_fragment = rpc_fragment_header & 0x80000000 != 0
+            response_size = rpc_fragment_header & 0x7fffffff
+
+            if response_size > self.max_fragment_size: # len too high, propably an error
+                raise RPCProtocolError("response_size > 0x%08x: %d" % (self.max_fragment_size, response_size))
+
+            rpc_response = await self.reader.readexactly(response_size)
+        except asyncio.IncompleteReadError:
+            raise ConnectionResetError("connection closed by %s:%d" % (self.host, self.port))
+
+        return last_fragment, rpc_response
+
+class AsyncPortmap(AsyncRPC):
+    program = Portmap.program
+    program_version = Portmap.program_version
+
+    async def null(self):
+        procedure = 0 # Null
+
+        await self.request(self.program, self.program_version, procedure)
+
+        # no exception raised
+        return True
+
+    async def dump(self):
+        procedure = 4 # Dump
+
+        portmap = await self.request(self.program, self.program_version, procedure, pack_args=lambda packer: pack_dump(packer, self.program_version, procedure))
+
+        return parse_dump(portmap)
+
+    async def getport(self, getport_program, getport_program_version, getport_protocol=6):
+        procedure = 3 # GetPort
+
+        getport = await self.request(self.program, self.program_version, procedure, pack_args=lambda packer: pack_getport(packer, getport_program, getport_program_version, getport_protocol))
+
+        return parse_getport(getport)
+
+class AsyncMount(AsyncRPC):
+    program = Mount.program
+    program_version = Mount.program_version
+
+    async def null(self, auth=None):
+        procedure = 0 # Null
+
+        await self.request(self.program, self.program_version, procedure, auth=auth)
+
+        # no exception raised
+        return True
+
+    async def mnt(self, path, auth=None):
+        procedure = 1
+
+        data = await self.request(self.program, self.program_version, procedure, pack_args=lambda packer: pack_mnt(packer, path), auth=auth)
+
+        return parse_mnt(data)
+
+    async def export(self):
+        procedure = 5 # Export
+
+        export = await self.request(self.program, self.program_version, procedure)
+
+        return parse_export(export)
+
+class AsyncNFS(AsyncRPC):
+    program = NFS.program
+    program_version = NFS.program_version
+    max_fragment_size = NFS.max_fragment_size
+    readdirplus_limit = None
+
+    async def null(self):
+        procedure = 0 # Null
+
+        await self.request(self.program, self.program_version, procedure)
+
+        # no exception raised
+        return True
+
+    async def getattr(self, file_handle, auth=None):
+        procedure = 1 # GetAttr
+
+        data = await self.request(self.program, self.program_version, procedure, pack_args=lambda packer: packer.pack_fixed(encode_handle(file_handle)), auth=auth)
+
+        return parse_getattr(data)
+
+    async def fsinfo(self, file_handle, auth=None):
+        procedure = 19 # FsInfo
+
+        data = await self.request(self.program, self.program_version, procedure, pack_args=lambda packer: packer.pack_fixed(encode_handle(file_handle)), auth=auth)
+
+        return parse_fsinfo(data)
+
+    async def get_readdirplus_limit(self, file_handle, auth=None):
+        if self.readdirplus_limit == None:
+            limit = self.max_fragment_size - 0x10000
+            try:
+                limit = min(max((await self.fsinfo(file_handle, auth=auth))["rtmax"], readdirplus_maxcount), limit)
+            except NFSAccessError:
+                pass
+            self.readdirplus_limit = limit
+
+        return self.readdirplus_limit
+
+    async def iter_readdirplus(self, dir_handle, cookie=0, auth=None):
+        # async generator of the entries of the directory
+        procedure = 17 # ReadDirPlus
+
+        cookie_verifier = 0
+        dircount = readdirplus_dircount
+        maxcount = readdirplus_maxcount
+
+        while True:
+            args = lambda packer, cookie=cookie, cookie_verifier=cookie_verifier, dircount=dircount, maxcount=maxcount: pack_readdirplus(packer, dir_handle, cookie, cookie_verifier, dircount, maxcount)
+            data = await self.request(self.program, self.program_version, procedure, pack_args=args, auth=auth)
+
+            res = parse_readdirplus(data)
+
+            for entry in res["contents"]:
+                yield entry
+
+            if res["eof"]:
+                break
+
+            limit = await self.get_readdirplus_limit(dir_handle, auth=auth)
+            if len(res["contents"]) != 0:
+                cookie = res["last_cookie"]
+            elif maxcount >= limit:
+                raise NFSAccessError("Error: no entry fits in a READDIRPLUS reply")
+
+            cookie_verifier = res["cookie_verifier"]
+            dircount, maxcount = grow_readdirplus_counts(dircount, maxcount, limit)
+
+    async def readdirplus(self, dir_handle, cookie=0, auth=None):
+        return [entry async for entry in self.iter_readdirplus(dir_handle, cookie=cookie, auth=auth)]
@@ -0,0 +1,394 @@
+import os
+import json
+import time
+import queue
+import hashlib
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from .nfs import NFS
+
+#
+# Author: Hegusung
+#
+
+# Ranged download: the file is split in byte ranges, each range is read over
+# its own NFS connection and written at its offset in the destination file.
+# Completed ranges are saved to a checkpoint file next to the destination so
+# an interrupted download can be resumed.
+# Mirror: a directory tree is walked with READDIRPLUS while a pool of workers,
+# each one with its own NFS connection, downloads the files found.
+
+class DownloadCancelled(Exception):
+    pass
+
+class Checkpoint(object):
+    def __init__(self, path, file_handle, file_size, mtime, interval=1.0):
+        # path is None when the progress is not saved
+        self.path = path
+        self.file_handle = file_handle
+        self.file_size = file_size
+        self.mtime = mtime
+        self.interval = interval
+        # sorted, merged [start, end) ranges already written to the destination file
+        self.ranges = []
+        self.lock = threading.Lock()
+        self.last_save = time.monotonic()
+        self.cancelled = False
+
+    def load(self):
+        # returns True if the saved progress is for the same file in the same state
+        if self.path == None or self.file_size == None:
+            return False
+
+        try:
+            with open(self.path, 'r') as f:
+                checkpoint = json.load(f)
+        except (OSError, ValueError):
+            return False
+
+        if checkpoint.get("file_handle") != self.file_handle.hex() or checkpoint.get("file_size") != self.file_size or checkpoint.get("mtime") != self.mtime:
+            return False
+
+        self.ranges = [(start, end) for start, end in checkpoint["ranges"]]
+        return True
+
+    def add(self, start, end, fd):
+        with self.lock:
+            ranges = []
+            for range_start, range_end in self.ranges:
+                if range_end < start or range_start > end:
+                    ranges.append((range_start, range_end))
+                else:
+                    start = min(start, range_start)
+                    end = max(end, range_end)
+            ranges.append((start, end))
+            ranges.sort()
+            self.ranges = ranges
+
+            if self.path != None and time.monotonic() - self.last_save > self.interval:
+                self.save(fd)
+
+    def contiguous_end(self):
+        # the destination file is complete up to this offset
+        ranges = self.ranges
+        if len(ranges) != 0 and ranges[0][0] == 0:
+            return ranges[0][1]
+        return 0
+
+    def missing(self):
+        # (offset, count) of the ranges left to download, the last one is read up to the end of file
+        missing = []
+        offset = 0
+        for start, end in self.ranges:
+            if start > offset:
+                missing.append((offset, start - offset))
+            offset = max(offset, end)
+
+        if self.file_size == None or offset < self.file_size or len(missing) == 0:
+            missing.append((offset, None))
+
+        return missing
+
+    def save(self, fd):
+        # the data must be on disk before the checkpoint says so
+        os.fsync(fd)
+
+        with open(self.path + ".tmp", 'w') as f:
+            json.dump({
+                "file_handle": self.file_handle.hex(),
+                "file_size": self.file_size,
+                "mtime": self.mtime,
+                "ranges": self.ranges,
+            }, f)
+        os.replace(self.path + ".tmp", self.path)
+        self.last_save = time.monotonic()
+
+    def remove(self):
+        if self.path == None:
+            return
+
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+class StreamHash(object):
+    # SHA-256 of the destination file computed in offset order while the ranges are received:
+    # chunks following the hashed prefix are hashed from memory, the others are read back from the
+    # page cache once the prefix reaches them
+
+    def __init__(self, fd, block_size=1024*1024):
+        self.fd = fd
+        self.block_size = block_size
+        self.sha256 = hashlib.sha256()
+        self.offset = 0
+        self.lock = threading.Lock()
+
+    def update(self, chunk_offset, data, contiguous_end):
+        with self.lock:
+            if chunk_offset == self.offset:
+                self.sha256.update(data)
+                self.offset += len(data)
+
+            self.catch_up(contiguous_end)
+
+    def catch_up(self, end):
+        while self.offset < end:
+            block = os.pread(self.fd, min(self.block_size, end - self.offset), self.offset)
+            if len(block) == 0:
+                break
+            self.sha256.update(block)
+            self.offset += len(block)
+
+    def hexdigest(self, file_size):
+        with self.lock:
+            self.catch_up(file_size)
+            return self.sha256.hexdigest()
+
+def split_ranges(missing, file_size, connections, chunk_count):
+    # split the missing (offset, count) ranges in pieces aligned on chunk_count so that every connection gets about
+    # the same amount of data, a count of None means up to the end of file
+    if file_size == None:
+        return missing
+
+    total = 0
+    for offset, count in missing:
+        total += count if count != None else max(file_size - offset, 0)
+
+    range_size = -(-total // max(connections, 1))
+    range_size = max(-(-range_size // chunk_count) * chunk_count, chunk_count)
+
+    ranges = []
+    for offset, count in missing:
+        end = offset + count if count != None else file_size
+        while offset + range_size < end:
+            ranges.append((offset, range_size))
+            offset += range_size
+        ranges.append((offset, count if count == None else end - offset))
+
+    return ranges
+
+def download_range(nfs, fd, file_handle, offset, count, checkpoint, stream_hash=None, auth=None, chunk_count=1024*1024, window=8):
+    # returns the offset following the last byte written
+    end = offset
+    for chunk_offset, data in nfs.read_chunks(file_handle, auth=auth, offset=offset, chunk_count=chunk_count, window=window, count=count):
+        os.pwrite(fd, data, chunk_offset)
+        end = chunk_offset + len(data)
+
+        checkpoint.add(chunk_offset, end, fd)
+        if stream_hash != None:
+            stream_hash.update(chunk_offset, data, checkpoint.contiguous_end())
+
+        if checkpoint.cancelled:
+            raise DownloadCancelled("download cancelled")
+
+    return end
+
+def download(nfs, file_handle, file_size, file_name, auth=None, connections=4, chunk_count=1024*1024, window=8, mtime=None, checkpoint_file=None, sha256=False):
+    # nfs is used for the first range, the other ranges use new connections to the same NFS service
+    # returns {"file_size", "sha256", "resumed"}
+    checkpoint = Checkpoint(checkpoint_file, file_handle, file_size, mtime)
+    resumed = checkpoint.load() and os.path.exists(file_name)
+    if not resumed:
+        checkpoint.ranges = []
+
+    ranges = split_ranges(checkpoint.missing(), file_size, connections, chunk_count)
+
+    fd = os.open(file_name, os.O_RDWR | os.O_CREAT | (0 if resumed else os.O_TRUNC), 0o644)
+    clients = [nfs]
+    complete = False
+    try:
+        if file_size != None:
+            # preallocate the destination file, ranges are written in any order
+            os.ftruncate(fd, file_size)
+
+        stream_hash = StreamHash(fd) if sha256 else None
+
+        for _ in range(min(len(ranges), connections) - 1):
+            client = NFS(nfs.host, nfs.port, nfs.timeout)
+            client.connect()
+            clients.append(client)
+
+        # every connection takes the next range to download once its own is complete
+        queue = list(reversed(ranges))
+        queue_lock = threading.Lock()
+        ends = {}
+
+        def worker(client):
+            while True:
+                with queue_lock:
+                    if len(queue) == 0:
+                        return
+                    offset, count = queue.pop()
+                ends[(offset, count)] = download_range(client, fd, file_handle, offset, count, checkpoint, stream_hash=stream_hash, auth=auth, chunk_count=chunk_count, window=window)
+
+        with ThreadPoolExecutor(len(clients)) as executor:
+            futures = [executor.submit(worker, client) for client in clients]
+            try:
+                for future in futures:
+                    future.result()
+            except BaseException:
+                # stop the other connections at their next chunk
+                checkpoint.cancelled = True
+                raise
+
+        # the file may have shrunk or grown since its size was read
+        size = file_size
+        for (offset, count), end in sorted(ends.items()):
+            if count == None:
+                size = end
+            elif end != offset + count:
+                size = end
+                break
+        os.ftruncate(fd, size)
+
+        digest = stream_hash.hexdigest(size) if stream_hash != None else None
+        complete = True
+    finally:
+        if complete:
+            checkpoint.remove()
+        elif checkpoint.path != None:
+            checkpoint.save(fd)
+
+        os.close(fd)
+        for client in clients[1:]:
+            client.disconnect()
+
+    return {
+        "file_size": size,
+        "sha256": digest,
+        "resumed": resumed,
+    }
+
+def is_mirrored(path, entry):
+    # the local file is complete if it has the size and mtime of the remote one
+    if entry["file_size"] == None or entry["mtime"] == None:
+        return False
+
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return False
+
+    return stat.st_size == entry["file_size"] and int(stat.st_mtime) == entry["mtime"]
+
+def mirror(nfs, dir_handle, local_path, auth=None, workers=4, chunk_count=1024*1024, window=8, checkpoint=True, log=print, fanout=16):
+    # nfs is used to walk the tree, the files are downloaded over workers other connections
+    # fanout: number of directories listed at once
+    # returns {"files", "skipped", "errors", "bytes"}
+    stats = {
+        "files": 0,
+        "skipped": 0,
+        "errors": 0,
+        "bytes": 0,
+    }
+    stats_lock = threading.Lock()
+
+    # bounded, the walk waits for the workers when it is ahead
+    files = queue.Queue(workers*4)
+
+    def worker(client):
+        while True:
+            item = files.get()
+            if item == None:
+                break
+
+            entry, path = item
+            try:
+                res = download(client, entry["file_handle"], entry["file_size"], path, auth=auth, connections=1, chunk_count=chunk_count, window=window, mtime=entry["mtime"], checkpoint_file=path + ".nfsget" if checkpoint else None)
+                if entry["mtime"] != None:
+                    # a file with the remote mtime is complete, it is skipped by the next runs
+                    os.utime(path, (entry["mtime"], entry["mtime"]))
+                log("file %s written" % path)
+
+                with stats_lock:
+                    stats["files"] += 1
+                    stats["bytes"] += res["file_size"]
+            except Exception as e:
+                log("error %s: %s" % (path, e))
+
+                with stats_lock:
+                    stats["errors"] += 1
+
+                if isinstance(e, OSError):
+                    # the connection may be unusable, open a new one
+                    client.disconnect()
+                    client = NFS(nfs.host, nfs.port, nfs.timeout)
+                    try:
+                        client.connect()
+                    except OSError:
+                        pass
+
+        client.disconnect()
+
+    threads = []
+    try:
+        for _ in range(workers):
+            client = NFS(nfs.host, nfs.port, nfs.timeout)
+            client.connect()
+            thread = threading.Thread(target=worker, args=(client,))
+            thread.start()
+            threads.append(thread)
+
+        dirs = deque([(dir_handle, local_path)])
+        while len(dirs) != 0:
+            # the READDIRPLUS calls of up to fanout queued directories are pipelined on the connection
+            batch = [dirs.popleft() for _ in range(min(len(dirs), fanout))]
+            results = nfs.readdirplus_many([dir_handle for dir_handle, _ in batch], auth=auth)
+
+            for (dir_handle, path), (contents, error) in zip(batch, results):
+                os.makedirs(path, exist_ok=True)
+
+                if error != None:
+                    # the entries listed before the error are still mirrored
+                    log("error %s: %s" % (path, error))
+                    with stats_lock:
+                        stats["errors"] += 1
+
+                # the names come from the server, they must stay in the destination directory
+                entries = [entry for entry in contents if entry["name"] not in [".", ".."] and "/" not in entry["name"] and "\x00" not in entry["name"]]
+
+                # the entries returned without a file handle are looked up, pipelined on the connection
+                missing = [entry for entry in entries if entry["file_handle"] == None]
+                if len(missing) != 0:
+                    for entry, (res, error) in zip(missing, nfs.lookup_many(dir_handle, [entry["name"] for entry in missing], auth=auth)):
+                        if error != None:
+                            log("error %s: %s" % (os.path.join(path, entry["name"]), error))
+                            with stats_lock:
+                                stats["errors"] += 1
+                        else:
+                            entry.update(res)
+
+                for entry in entries:
+                    if entry["file_handle"] == None:
+                        # its lookup failed
+                        continue
+
+                    entry_path = os.path.join(path, entry["name"])
+
+                    if entry["file_type"] == 2: # DIR
+                        dirs.append((entry["file_handle"], entry_path))
+                    elif entry["file_type"] == 1: # regular file
+                        if is_mirrored(entry_path, entry):
+                            with stats_lock:
+                                stats["skipped"] += 1
+                            continue
+
+                        files.put((entry, entry_path))
+    except BaseException:
+        # do not download the files left in the queue
+        try:
+            while True:
+                files.get_nowait()
+        except queue.Empty:
+            pass
+        raise
+    finally:
+        for _ in threads:
+            files.put(None)
+        for thread in threads:
+            thread.join()
+
+    return stats
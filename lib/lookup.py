@@ -0,0 +1,206 @@
+import os
+import json
+import time
+from collections import OrderedDict
+
+from .portmap import Portmap, dump_ports, resolve_port
+from .mount import Mount
+from .nfs import NFS, NFSAccessError
+
+#
+# Author: Hegusung
+#
+
+# Path resolution for nfs-ls.py and nfs-get.py: nfs://host/export/path is resolved
+# to a file handle with MNT and a LOOKUP per path component. The handles found
+# are kept in a LRU cache by (host, export, path), in memory and optionally in a
+# file, so that paths under an already resolved directory cost no round trip.
+
+class LookupCache(object):
+    def __init__(self, path=None, ttl=300, size=4096):
+        # path: file the cache is loaded from and saved to, None to keep it in memory only
+        self.path = path
+        self.ttl = ttl
+        self.size = size
+        # (host, export, path) -> (expiration time, value), least recently used first
+        self.entries = OrderedDict()
+
+        if path != None:
+            self.load()
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry == None:
+            return None
+
+        expires, value = entry
+        if expires < time.time():
+            del self.entries[key]
+            return None
+
+        self.entries.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self.entries[key] = (time.time() + self.ttl, value)
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, host, export=None):
+        for key in list(self.entries):
+            if key[0] == host and (export == None or key[1] == export):
+                del self.entries[key]
+
+    def load(self):
+        # the file is JSON: [[host, export, path, expiration time, value with the file handle in hex], ...]
+        try:
+            with open(self.path) as f:
+                entries = json.load(f)
+
+            now = time.time()
+            for host, export, path, expires, value in entries:
+                if expires >= now:
+                    value = dict(value, file_handle=bytes.fromhex(value["file_handle"]))
+                    self.entries[(host, export, path)] = (expires, value)
+        except Exception:
+            # no cache yet, or unreadable: start with an empty one
+            self.entries.clear()
+            return
+
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def save(self):
+        if self.path == None:
+            return
+
+        try:
+            entries = [list(key) + [expires, dict(value, file_handle=value["file_handle"].hex())] for key, (expires, value) in self.entries.items()]
+            with open(self.path + ".tmp", 'w') as f:
+                json.dump(entries, f)
+            os.replace(self.path + ".tmp", self.path)
+        except OSError:
+            pass
+
+def cached_path(cache, host, uri):
+    # deepest cached entry of the path: (export, path components below the export, number of them cached, cached value) or None
+    components = [component for component in uri.split("/") if len(component) != 0]
+
+    # the longest export first
+    for export_length in range(len(components), -1, -1):
+        export = "/" + "/".join(components[:export_length])
+        path = components[export_length:]
+
+        for path_length in range(len(path), -1, -1):
+            value = cache.get((host, export, "/".join(path[:path_length])))
+            if value != None:
+                return export, path, path_length, value
+
+    return None
+
+def resolve_path(host, uri, timeout, auth=None, cache=None, portmapper_port=111, refresh=False):
+    # returns the NFS connection and the attributes of the file or directory at uri:
+    # {"nfs", "file_handle", "file_type", "file_size", "mtime", "export", "cached"}
+    # only directories are allowed before the last path component
+    # when cached is True, the handle comes from the cache: an error using the handle may mean the handle
+    # is stale, and the attributes may be out of date unless refresh is set (one GETATTR call)
+    hit = cached_path(cache, host, uri) if cache != None else None
+
+    if hit != None:
+        mount_path, path, path_length, value = hit
+
+        nfs = NFS(host, value["nfs_port"], timeout)
+        try:
+            nfs.connect()
+        except OSError:
+            # the NFS service may have moved to another port
+            cache.invalidate(host)
+            return resolve_path(host, uri, timeout, auth=auth, cache=cache, portmapper_port=portmapper_port, refresh=refresh)
+    else:
+        portmap = Portmap(host, portmapper_port, timeout)
+        portmap.connect()
+
+        # one DUMP gives the mount and nfs service ports
+        service_ports = dump_ports(portmap)
+
+        # get mount service port
+        mount_port = resolve_port(portmap, service_ports, Mount.program, Mount.program_version)
+        mount = Mount(host, mount_port, timeout)
+        mount.connect()
+
+        # list mount points and grab the correct file handle
+        file_handle = None
+        for mountpoint in mount.export():
+            if uri.startswith(mountpoint["path"]):
+                mount_path = mountpoint["path"]
+                file_handle = mount.mnt(mountpoint["path"])["file_handle"]
+
+        mount.disconnect()
+
+        if file_handle == None:
+            portmap.disconnect()
+            raise Exception("Mount point not found")
+
+        # get nfs port
+        nfs_port = resolve_port(portmap, service_ports, NFS.program, NFS.program_version)
+        portmap.disconnect()
+
+        nfs = NFS(host, nfs_port, timeout)
+        nfs.connect()
+
+        path = [folder for folder in uri[len(mount_path):].split("/") if len(folder) != 0]
+        path_length = 0
+        value = {
+            "nfs_port": nfs_port,
+            "file_handle": file_handle,
+            "file_type": 2,
+            "file_size": None,
+            "mtime": None,
+        }
+        if cache != None:
+            cache.set((host, mount_path, ""), value)
+
+    # iterate through the folders which are not cached
+    try:
+        for index in range(path_length, len(path)):
+            if value["file_type"] != 2: # DIR
+                raise Exception("Unexpected file type")
+
+            res = nfs.lookup(value["file_handle"], path[index], auth=auth)
+            value = {
+                "nfs_port": nfs.port,
+                "file_handle": res["file_handle"],
+                "file_type": res["file_type"],
+                "file_size": res["file_size"],
+                "mtime": res["mtime"],
+            }
+            if cache != None:
+                cache.set((host, mount_path, "/".join(path[:index+1])), value)
+
+        if refresh and path_length == len(path) and hit != None:
+            attributes = nfs.getattr(value["file_handle"], auth=auth)
+            value = dict(value, file_type=attributes["file_type"], file_size=attributes["file_size"], mtime=attributes["mtime"])
+            cache.set((host, mount_path, "/".join(path)), value)
+    except NFSAccessError:
+        nfs.disconnect()
+        if hit == None:
+            raise
+
+        # the cached handle may be stale, resolve the whole path again
+        cache.invalidate(host)
+        return resolve_path(host, uri, timeout, auth=auth, cache=cache, portmapper_port=portmapper_port, refresh=refresh)
+    except Exception:
+        nfs.disconnect()
+        raise
+
+    return {
+        "nfs": nfs,
+        "file_handle": value["file_handle"],
+        "file_type": value["file_type"],
+        "file_size": value["file_size"],
+        "mtime": value["mtime"],
+        "export": mount_path,
+        "cached": hit != None,
+    }
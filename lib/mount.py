@@ -1,6 +1,5 @@
-import struct
-
 from .rpc import RPC
+from .xdr import Unpacker
 
 #
 # Author: Hegusung
@@ -9,101 +8,75 @@ from .rpc import RPC
 class MountAccessError(Exception):
     pass
 
-class Mount(RPC):
-    program = 100005
-    program_version = 3
-
-    def null(self, auth=None):
-        procedure = 0 # Null
-
-        super(Mount, self).request(self.program, self.program_version, procedure, auth=auth)
-
-        # no exception raised
-        return True
-
-    def mnt(self, path, auth=None):
-        procedure = 1
-
-        data = struct.pack('!L', len(path))
-        data += path.encode()
-        data += b'\x00'*((4-len(path) % 4)%4)
-
-        data = super(Mount, self).request(self.program, self.program_version, procedure, data=data, auth=auth)
-
-        status = struct.unpack('!L', data[:4])[0]
-        data = data[4:]
+def pack_mnt(packer, path):
+    packer.pack_string(path)
 
-        if status != 0:
-            raise MountAccessError("MNT error: %d" % status)
+def parse_mnt(data):
+    unpacker = Unpacker(data)
 
-        len_file_handle = struct.unpack('!L', data[:4])[0]
-        data = data[4:]
-        file_handle = data[:len_file_handle]
-        data = data[len_file_handle:]
+    status = unpacker.unpack_uint()
 
-        flavors = []
-        flavors_nb = struct.unpack('!L', data[:4])[0]
-        data = data[4:]
-        for _ in range(flavors_nb):
-            flavor = struct.unpack('!L', data[:4])[0]
-            flavors.append(flavor)
-            data = data[4:]
+    if status != 0:
+        raise MountAccessError("MNT error: %d" % status)
 
-        return {
-            "file_handle": file_handle,
-            "flavors": flavors,
-        }
+    file_handle = unpacker.unpack_opaque()
 
+    flavors = []
+    flavors_nb = unpacker.unpack_uint()
+    for _ in range(flavors_nb):
+        flavors.append(unpacker.unpack_uint())
 
-    def export(self):
-        # RPC
-        procedure = 5 # Export
+    return {
+        "file_handle": file_handle,
+        "flavors": flavors,
+    }
 
-        export = super(Mount, self).request(self.program, self.program_version, procedure)
+def parse_export(export):
+    exports = []
 
-        exports = []
+    unpacker = Unpacker(export)
 
-        export_Value_Follows = export[:4]
-        export_Entries = export[4:]
+    while unpacker.remaining() >= 4 and unpacker.unpack_bool():
+        path = unpacker.unpack_string()
 
-        while export_Value_Follows == b'\x00\x00\x00\x01':
-            (path_len,) = struct.unpack('!L', export_Entries[:4])
-            export_Entries = export_Entries[4:]
+        authorized_ip = []
 
-            path = export_Entries[:path_len].decode('utf-8')
+        while unpacker.unpack_bool():
+            authorized_ip.append(unpacker.unpack_string())
 
-            export_Entries = export_Entries[path_len:]
+        exports.append({
+            "path": path,
+            "authorized": authorized_ip,
+        })
 
-            export_Entries = export_Entries[(4-path_len % 4)%4:]
+    return exports
 
-            group_value_follows = export_Entries[:4]
-            export_Entries = export_Entries[4:]
+class Mount(RPC):
+    program = 100005
+    program_version = 3
 
-            authorized_ip = []
+    def null(self, auth=None):
+        procedure = 0 # Null
 
-            while group_value_follows == b'\x00\x00\x00\x01':
-                (ip_len,) = struct.unpack('!L', export_Entries[:4])
-                export_Entries = export_Entries[4:]
+        super(Mount, self).request(self.program, self.program_version, procedure, auth=auth)
 
-                ip = export_Entries[:ip_len].decode('utf-8')
-                authorized_ip.append(ip)
+        # no exception raised
+        return True
 
-                export_Entries = export_Entries[ip_len:]
+    def mnt(self, path, auth=None):
+        procedure = 1
 
-                export_Entries = export_Entries[(4-ip_len % 4)%4:]
+        data = super(Mount, self).request(self.program, self.program_version, procedure, pack_args=lambda packer: pack_mnt(packer, path), auth=auth)
 
-                group_value_follows = export_Entries[:4]
-                export_Entries = export_Entries[4:]
+        return parse_mnt(data)
 
-            exports.append({
-                "path": path,
-                "authorized": authorized_ip,
-            })
 
-            export_Value_Follows = export_Entries[:4]
-            export_Entries = export_Entries[4:]
+    def export(self):
+        # RPC
+        procedure = 5 # Export
 
+        export = super(Mount, self).request(self.program, self.program_version, procedure)
 
-        return exports
+        return parse_export(export)
 
 
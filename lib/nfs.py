@@ -1,6 +1,9 @@
 import struct
+from collections import deque
+from functools import lru_cache
 
 from .rpc import RPC
+from .xdr import Unpacker, Packer
 
 #
 # Author: Hegusung
@@ -19,214 +22,420 @@ from .rpc import RPC
 class NFSAccessError(Exception):
     pass
 
-class NFS(RPC):
-    program = 100003
-    program_version = 3
+@lru_cache(maxsize=4096)
+def encode_handle(file_handle):
+    # file handles are sent again and again (LOOKUP of every entry of a directory, READ of every chunk)
+    if type(file_handle) != bytes:
+        raise Exception("file_id should be bytes")
 
-    def null(self):
-        procedure = 0 # Null
+    packer = Packer(len(file_handle)+8)
+    packer.pack_opaque(file_handle)
 
-        super(NFS, self).request(self.program, self.program_version, procedure)
+    return bytes(packer.get_view())
 
-        # no exception raised
-        return True
+def pack_lookup(packer, dir_handle, file_folder):
+    packer.pack_fixed(encode_handle(dir_handle))
+    packer.pack_string(file_folder)
 
-    def lookup(self, dir_handle, file_folder, auth=None):
-        if type(dir_handle) != bytes:
-            raise Exception("file_id should be bytes")
+# fattr3: type, mode, nlink, uid, gid, size, used, rdev (2 words), fsid, fileid, atime, mtime, ctime (seconds, nseconds)
+fattr3 = struct.Struct('!LLLLLQQLLQQLLLLLL')
 
-        procedure = 3 # Lookup
+def unpack_attributes(unpacker):
+    # post_op_attr
+    if not unpacker.unpack_bool():
+        return None
 
-        data = struct.pack('!L', len(dir_handle))
-        data += dir_handle
-        data += b'\x00'*((4-len(dir_handle) % 4)%4)
+    return unpack_fattr(unpacker)
 
-        data += struct.pack('!L', len(file_folder))
-        data += file_folder.encode()
-        data += b'\x00'*((4-len(file_folder) % 4)%4)
+def unpack_fattr(unpacker):
+    (file_type, mode, nlink, uid, gid, file_size, used, rdev1, rdev2, fsid, file_id, atime, atime_ns, mtime, mtime_ns, ctime, ctime_ns) = unpacker.unpack_struct(fattr3)
+    # File types:
+    # 1: Regular file
+    # 2: Directory
+    # 5: Symbolic link
 
-        data = super(NFS, self).request(self.program, self.program_version, procedure, data=data, auth=auth)
+    return {
+        "file_type": file_type,
+        "mode": mode,
+        "uid": uid,
+        "gid": gid,
+        "file_size": file_size,
+        "file_id": file_id,
+        "mtime": mtime,
+        "ctime": ctime,
+    }
 
-        nfs_status = struct.unpack('!L', data[:4])[0]
-        data = data[4:]
+def parse_lookup(data):
+    unpacker = Unpacker(data)
 
-        if nfs_status != 0:
-            raise NFSAccessError("Error: %d" % nfs_status)
+    nfs_status = unpacker.unpack_uint()
 
-        file_handle_len = struct.unpack("!L", data[:4])[0]
-        data = data[4:]
+    if nfs_status != 0:
+        raise NFSAccessError("Error: %d" % nfs_status)
 
-        file_handle = data[:file_handle_len]
-        data = data[file_handle_len:]
-        data = data[(4-file_handle_len % 4)%4:]
+    file_handle = unpacker.unpack_opaque()
 
-        value_follows = data[:4]
-        data = data[4:]
+    attributes = unpack_attributes(unpacker)
+    if attributes != None:
+        file_type = attributes["file_type"]
+        file_size = attributes["file_size"]
+        mtime = attributes["mtime"]
+    else:
+        file_type = None
+        file_size = None
+        mtime = None
 
-        if value_follows == b'\x00\x00\x00\x01':
-            attributes = data[:84]
-            data = data[84:]
+    return {
+        "file_handle": file_handle,
+        "file_type": file_type,
+        "file_size": file_size,
+        "mtime": mtime,
+    }
 
-            (file_type, mode, ulink, uid, gid, file_size) = struct.unpack('!LLLLLL', attributes[:24])
-            # File types:
-            # 1: Regular file
-            # 2: Directory
-            # 5: Symbolic link
-        else:
-            file_type = None
-            file_size = None
+def parse_getattr(data):
+    unpacker = Unpacker(data)
 
-        return {
-            "file_handle": file_handle,
-            "file_type": file_type,
-            "file_size": file_size,
-        }
+    nfs_status = unpacker.unpack_uint()
 
-    def read(self, file_handle, auth=None, offset=0, chunk_count=1024*1024):
-        if type(file_handle) != bytes:
-            raise Exception("file_id should be bytes")
+    if nfs_status != 0:
+        raise NFSAccessError("Error: %d" % nfs_status)
 
-        procedure = 6 # Read
+    return unpack_fattr(unpacker)
 
-        data = struct.pack('!L', len(file_handle))
-        data += file_handle
-        data += b'\x00'*((4-len(file_handle) % 4)%4)
-        data += struct.pack('!QL', offset, chunk_count)
+read_args = struct.Struct('!QL')
 
-        data = super(NFS, self).request(self.program, self.program_version, procedure, data=data, auth=auth)
+def pack_read(packer, file_handle, offset, chunk_count):
+    packer.pack_fixed(encode_handle(file_handle))
+    packer.pack_struct(read_args, offset, chunk_count)
 
-        nfs_status = struct.unpack('!L', data[:4])[0]
-        data = data[4:]
+def parse_read(data):
+    unpacker = Unpacker(data)
 
-        if nfs_status != 0:
-            raise NFSAccessError("Error: %d" % nfs_status)
+    nfs_status = unpacker.unpack_uint()
 
-        value_follows = data[:4]
-        data = data[4:]
+    if nfs_status != 0:
+        raise NFSAccessError("Error: %d" % nfs_status)
 
-        if value_follows == b'\x00\x00\x00\x01':
-            attributes = data[:84]
-            data = data[84:]
+    attributes = unpack_attributes(unpacker)
+    if attributes != None:
+        file_type = attributes["file_type"]
+        file_size = attributes["file_size"]
+    else:
+        file_type = None
+        file_size = None
 
-            (file_type, mode, ulink, uid, gid, file_size) = struct.unpack('!LLLLLL', attributes[:24])
-            # File types:
-            # 1: Regular file
-            # 2: Directory
-            # 5: Symbolic link
-        else:
-            file_type = None
-            file_size = None
+    count = unpacker.unpack_uint()
+    EOF = unpacker.unpack_uint()
 
-        (count, EOF) = struct.unpack('!LL', data[:8])
-        data = data[8:]
+    # the file data is not copied, it is a view on the reply buffer
+    file_data = unpacker.unpack_opaque_view()
 
-        file_len = struct.unpack("!L", data[:4])[0]
-        data = data[4:]
-        file_data = data[:file_len]
-        data = data[file_len:]
-        data = data[(4-file_len % 4)%4:]
+    if len(file_data) != count:
+        raise Exception("File size mismatch")
 
-        if len(file_data) != count:
-            raise Exception("File size mismatch")
+    return {
+        "data": file_data,
+        "eof": EOF != 0,
+        "file_type": file_type,
+        "file_size": file_size,
+    }
 
-        if EOF == 0:
-            file_data += self.read(file_handle, auth=auth, offset=offset+len(file_data))
+readdirplus_args = struct.Struct('!QQLL')
 
-        return file_data
+# first READDIRPLUS size, doubled on every page of a directory up to the server limit
+readdirplus_dircount = 4096
+readdirplus_maxcount = readdirplus_dircount*8
 
-    def readdirplus(self, dir_handle, cookie=0, auth=None):
-        # file_id should by bytes
-        if type(dir_handle) != bytes:
-            raise Exception("file_id should be bytes")
+def pack_readdirplus(packer, dir_handle, cookie, cookie_verifier=0, dircount=readdirplus_dircount, maxcount=readdirplus_maxcount):
+    packer.pack_fixed(encode_handle(dir_handle))
+    packer.pack_struct(readdirplus_args, cookie, cookie_verifier, dircount, maxcount)
 
-        procedure = 17 # Export
+def grow_readdirplus_counts(dircount, maxcount, limit):
+    # the directory does not fit in one reply, ask for bigger ones
+    maxcount = min(maxcount*2, limit)
+    dircount = max(min(dircount*2, maxcount//8), dircount)
 
-        dircount = 4096
-        maxcount = dircount*8
+    return dircount, maxcount
 
-        data = struct.pack('!L', len(dir_handle))
-        data += dir_handle
-        data += struct.pack('!Q', cookie)
-        data += struct.pack('!QLL', 0, dircount, maxcount)
+def parse_readdirplus(data):
+    unpacker = Unpacker(data)
 
-        data = super(NFS, self).request(self.program, self.program_version, procedure, data=data, auth=auth)
+    nfs_status = unpacker.unpack_uint()
 
-        nfs_status = struct.unpack('!L', data[:4])[0]
-        data = data[4:]
+    if nfs_status != 0:
+        raise NFSAccessError("Error: %d" % nfs_status)
 
-        if nfs_status != 0:
-            raise NFSAccessError("Error: %d" % nfs_status)
+    dir_attributes = unpack_attributes(unpacker)
 
-        dir_attributes = data[:88]
-        data = data[88:]
+    cookie_verifier = unpacker.unpack_uhyper()
 
-        opaque_data = data[:8]
-        data = data[8:]
+    contents = []
+    last_cookie = 0
 
-        contents = []
-        last_cookie = 0
+    while unpacker.unpack_bool():
+        file_id = unpacker.unpack_uhyper()
+        name = unpacker.unpack_string()
+        cookie = unpacker.unpack_uhyper()
+        last_cookie = cookie
 
-        value_follows = data[:4]
-        data = data[4:]
-        while value_follows == b'\x00\x00\x00\x01':
-            file_id = struct.unpack("!Q", data[:8])[0]
-            data = data[8:]
+        attributes = unpack_attributes(unpacker)
+        if attributes != None:
+            file_type = attributes["file_type"]
+            file_size = attributes["file_size"]
+            mtime = attributes["mtime"]
+            ctime = attributes["ctime"]
+        else:
+            file_type = None
+            file_size = None
+            mtime = None
+            ctime = None
 
-            name_len = struct.unpack("!L", data[:4])[0]
-            data = data[4:]
+        if unpacker.unpack_bool():
+            file_handle = unpacker.unpack_opaque()
+        else:
+            file_handle = None
 
-            name = data[:name_len].decode()
-            data = data[name_len:]
-            data = data[(4-name_len % 4)%4:]
+        contents.append({
+            "name": name,
+            "file_type": file_type,
+            "cookie": cookie,
+            "file_id": file_id,
+            "file_handle": file_handle,
+            "file_size": file_size,
+            "mtime": mtime,
+            "ctime": ctime,
+        })
 
-            cookie = struct.unpack("!Q", data[:8])[0]
-            last_cookie = cookie
-            data = data[8:]
+    EOF = unpacker.unpack_bool()
 
-            value_follows = data[:4]
-            data = data[4:]
+    return {
+        "contents": contents,
+        "eof": EOF,
+        "last_cookie": last_cookie,
+        "cookie_verifier": cookie_verifier,
+    }
 
-            if value_follows == b'\x00\x00\x00\x01':
-                attributes = data[:84]
-                data = data[84:]
+fsinfo_result = struct.Struct('!LLLLLLLQLLL')
 
-                (file_type, mode, ulink, uid, gid, file_size) = struct.unpack('!LLLLLL', attributes[:24])
-                # File types:
-                # 1: Regular file
-                # 2: Directory
-                # 5: Symbolic link
-            else:
-                file_type = None
-                file_size = None
+def parse_fsinfo(data):
+    unpacker = Unpacker(data)
 
-            handle_value_follows = data[:4]
-            data = data[4:]
+    nfs_status = unpacker.unpack_uint()
 
-            if handle_value_follows == b'\x00\x00\x00\x01':
-                len_file_handle = struct.unpack('!L', data[:4])[0]
-                data = data[4:]
-                file_handle = data[:len_file_handle]
-                data = data[len_file_handle:]
-            else:
-                file_handle = None
+    if nfs_status != 0:
+        raise NFSAccessError("Error: %d" % nfs_status)
 
-            contents.append({
-                "name": name,
-                "file_type": file_type,
-                "cookie": cookie,
-                "file_id": file_id,
-                "file_handle": file_handle,
-                "file_size": file_size,
-            })
+    attributes = unpack_attributes(unpacker)
 
-            value_follows = data[:4]
-            data = data[4:]
+    (rtmax, rtpref, rtmult, wtmax, wtpref, wtmult, dtpref, max_file_size, time_delta, time_delta_ns, properties) = unpacker.unpack_struct(fsinfo_result)
 
-        EOF = data[:4]
+    return {
+        "rtmax": rtmax,
+        "rtpref": rtpref,
+        "wtmax": wtmax,
+        "wtpref": wtpref,
+        "dtpref": dtpref,
+        "max_file_size": max_file_size,
+    }
 
-        if EOF == b'\x00\x00\x00\x00':
-            self.readdirplus(dir_handle, cookie=last_cookie, auth=auth)
+class NFS(RPC):
+    program = 100003
+    program_version = 3
+    # READ replies carry up to chunk_count bytes of data
+    max_fragment_size = 0x00110000
+    # set by get_readdirplus_limit()
+    readdirplus_limit = None
+
+    def null(self):
+        procedure = 0 # Null
+
+        super(NFS, self).request(self.program, self.program_version, procedure)
+
+        # no exception raised
+        return True
 
-        return contents
+    def getattr(self, file_handle, auth=None):
+        procedure = 1 # GetAttr
 
+        data = super(NFS, self).request(self.program, self.program_version, procedure, pack_args=lambda packer: packer.pack_fixed(encode_handle(file_handle)), auth=auth)
 
+        return parse_getattr(data)
+
+    def lookup(self, dir_handle, file_folder, auth=None):
+        procedure = 3 # Lookup
+
+        data = super(NFS, self).request(self.program, self.program_version, procedure, pack_args=lambda packer: pack_lookup(packer, dir_handle, file_folder), auth=auth)
+
+        return parse_lookup(data)
+
+    def lookup_many(self, dir_handle, file_folders, auth=None):
+        # pipelined LOOKUPs of several names in the same directory, returns one (result, error) per name:
+        # error is the NFSAccessError of the name, None if it was found
+        procedure = 3 # Lookup
+
+        pending = deque()
+        results = []
+        try:
+            for file_folder in file_folders:
+                pending.append(super(NFS, self).submit(self.program, self.program_version, procedure, pack_args=lambda packer, file_folder=file_folder: pack_lookup(packer, dir_handle, file_folder), auth=auth))
+
+            while len(pending) != 0:
+                xid = pending.popleft()
+                try:
+                    results.append((parse_lookup(super(NFS, self).result(xid)), None))
+                except NFSAccessError as e:
+                    results.append((None, e))
+        except Exception:
+            # read the replies in flight to keep the connection usable
+            super(NFS, self).discard(pending)
+            raise
+
+        return results
+
+    def read_chunks(self, file_handle, auth=None, offset=0, chunk_count=1024*1024, window=8, count=None):
+        # yields (offset, data) in offset order, at most window READs are in flight:
+        # memory use is bounded by window*chunk_count whatever the file size
+        # with count, only the count bytes starting at offset are read, otherwise the file is read up to its end
+        procedure = 6 # Read
+
+        in_flight = deque()
+        next_offset = offset
+        end = offset + count if count != None else None
+        eof = False
+
+        try:
+            while not eof:
+                while len(in_flight) < window and (end == None or next_offset < end):
+                    read_count = chunk_count if end == None else min(chunk_count, end - next_offset)
+                    xid = super(NFS, self).submit(self.program, self.program_version, procedure, pack_args=lambda packer: pack_read(packer, file_handle, next_offset, read_count), auth=auth)
+                    in_flight.append((next_offset, read_count, xid))
+                    next_offset += read_count
+
+                if len(in_flight) == 0:
+                    # end of the range
+                    break
+
+                chunk_offset, read_count, xid = in_flight.popleft()
+                res = parse_read(super(NFS, self).result(xid))
+                eof = res["eof"]
+
+                if not eof and len(res["data"]) != read_count:
+                    # short read, the server caps the READ size: the calls in flight do not start at the right offset anymore
+                    for _, _, pending_xid in in_flight:
+                        super(NFS, self).result(pending_xid)
+                    in_flight.clear()
+                    next_offset = chunk_offset + len(res["data"])
+                    if len(res["data"]) != 0:
+                        chunk_count = len(res["data"])
+
+                if len(res["data"]) != 0:
+                    yield chunk_offset, res["data"]
+        except GeneratorExit:
+            # the caller stopped early, read the replies in flight to keep the connection usable
+            for _, _, pending_xid in in_flight:
+                super(NFS, self).result(pending_xid)
+            raise
+
+        # drain the replies to the READs sent past the end of file
+        for _, _, pending_xid in in_flight:
+            super(NFS, self).result(pending_xid)
+
+    def read(self, file_handle, auth=None, offset=0, chunk_count=1024*1024, window=8, count=None):
+        return b"".join(data for _, data in self.read_chunks(file_handle, auth=auth, offset=offset, chunk_count=chunk_count, window=window, count=count))
+
+    def fsinfo(self, file_handle, auth=None):
+        procedure = 19 # FsInfo
+
+        data = super(NFS, self).request(self.program, self.program_version, procedure, pack_args=lambda packer: packer.pack_fixed(encode_handle(file_handle)), auth=auth)
+
+        return parse_fsinfo(data)
+
+    def get_readdirplus_limit(self, file_handle, auth=None):
+        # biggest READDIRPLUS reply asked for: the server transfer size limit, asked once per connection
+        if self.readdirplus_limit == None:
+            limit = self.max_fragment_size - 0x10000
+            try:
+                limit = min(max(self.fsinfo(file_handle, auth=auth)["rtmax"], readdirplus_maxcount), limit)
+            except NFSAccessError:
+                pass
+            self.readdirplus_limit = limit
+
+        return self.readdirplus_limit
+
+    def iter_readdirplus(self, dir_handle, cookie=0, auth=None):
+        # yields the entries of the directory, the pages are bigger and bigger for big directories
+        procedure = 17 # ReadDirPlus
+
+        cookie_verifier = 0
+        dircount = readdirplus_dircount
+        maxcount = readdirplus_maxcount
+
+        while True:
+            data = super(NFS, self).request(self.program, self.program_version, procedure, pack_args=lambda packer: pack_readdirplus(packer, dir_handle, cookie, cookie_verifier, dircount, maxcount), auth=auth)
+
+            res = parse_readdirplus(data)
+
+            for entry in res["contents"]:
+                yield entry
+
+            if res["eof"]:
+                break
+
+            limit = self.get_readdirplus_limit(dir_handle, auth=auth)
+            if len(res["contents"]) != 0:
+                cookie = res["last_cookie"]
+            elif maxcount >= limit:
+                raise NFSAccessError("Error: no entry fits in a READDIRPLUS reply")
+
+            cookie_verifier = res["cookie_verifier"]
+            dircount, maxcount = grow_readdirplus_counts(dircount, maxcount, limit)
+
+    def readdirplus(self, dir_handle, cookie=0, auth=None):
+        return list(self.iter_readdirplus(dir_handle, cookie=cookie, auth=auth))
+
+    def readdirplus_many(self, dir_handles, auth=None):
+        # pipelined READDIRPLUS of several directories, returns one (entries, error) per directory:
+        # error is the NFSAccessError which stopped the listing of the directory, None if it is complete
+        procedure = 17 # ReadDirPlus
+
+        contents = [[] for _ in dir_handles]
+        errors = [None for _ in dir_handles]
+        # directory index, cookie, dircount and maxcount of the calls in flight, by XID
+        in_flight = {}
+
+        def submit(index, cookie, cookie_verifier, dircount, maxcount):
+            xid = super(NFS, self).submit(self.program, self.program_version, procedure, pack_args=lambda packer: pack_readdirplus(packer, dir_handles[index], cookie, cookie_verifier, dircount, maxcount), auth=auth)
+            in_flight[xid] = (index, cookie, dircount, maxcount)
+
+        try:
+            for index in range(len(dir_handles)):
+                submit(index, 0, 0, readdirplus_dircount, readdirplus_maxcount)
+
+            while len(in_flight) != 0:
+                xid = next(iter(in_flight))
+                index, cookie, dircount, maxcount = in_flight.pop(xid)
+
+                try:
+                    res = parse_readdirplus(super(NFS, self).result(xid))
+                except NFSAccessError as e:
+                    errors[index] = e
+                    continue
+
+                contents[index] += res["contents"]
+
+                if not res["eof"]:
+                    limit = self.get_readdirplus_limit(dir_handles[index], auth=auth)
+                    if len(res["contents"]) != 0:
+                        cookie = res["last_cookie"]
+                    elif maxcount >= limit:
+                        errors[index] = NFSAccessError("Error: no entry fits in a READDIRPLUS reply")
+                        continue
+
+                    dircount, maxcount = grow_readdirplus_counts(dircount, maxcount, limit)
+                    submit(index, cookie, res["cookie_verifier"], dircount, maxcount)
+        except Exception:
+            # read the replies in flight to keep the connection usable
+            super(NFS, self).discard(list(in_flight))
+            raise
+
+        return list(zip(contents, errors))
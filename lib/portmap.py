@@ -1,11 +1,105 @@
 import struct
 
 from .rpc import RPC
+from .xdr import Unpacker
 
 #
 # Author: Hegusung
 #
 
+map_entry = struct.Struct('!LLLL')
+
+def pack_dump(packer, program_version, procedure):
+    packer.pack_uint(program_version)
+    packer.pack_uint(procedure)
+
+def parse_dump(portmap):
+    rpc_map_entries = []
+
+    if len(portmap) <= 4:  # portmap_Value_Follows + one portmap_Map_entry
+        return rpc_map_entries
+
+    unpacker = Unpacker(portmap)
+    seen = set()
+
+    while unpacker.unpack_bool():
+        (
+            program,
+            version,
+            protocol,
+            port
+        ) = unpacker.unpack_struct(map_entry)
+
+        if protocol == 0x06:
+            protocol = 'tcp'
+        elif protocol == 0x11:
+            protocol = 'udp'
+        else:
+            protocol = 'unknown'.format(protocol)
+
+        if (program, version, protocol, port) not in seen:
+            seen.add((program, version, protocol, port))
+            rpc_map_entries.append({
+                'program': program, 'version': version,
+                'protocol': protocol, 'port': port
+            })
+
+    return rpc_map_entries
+
+def pack_getport(packer, getport_program, getport_program_version, getport_protocol=6):
+    # GetPort
+    getport_port = 0
+
+    packer.pack_struct(
+        map_entry,
+        getport_program,
+        getport_program_version,
+        getport_protocol,
+        getport_port
+    )
+
+def parse_getport(getport):
+    return Unpacker(getport).unpack_uint()
+
+# Port resolution from the portmap table: a single DUMP per host answers all
+# the GETPORT questions, GETPORT is only sent when the DUMP is refused
+
+protocol_names = {0x06: 'tcp', 0x11: 'udp'}
+
+class ServicePorts(object):
+    def __init__(self, entries):
+        # DUMP entries, as returned by parse_dump
+        self.entries = entries
+        # program -> [(version, protocol, port)]
+        self.services = {}
+        for entry in entries:
+            self.services.setdefault(entry["program"], []).append((entry["version"], entry["protocol"], entry["port"]))
+
+    def getport(self, program, program_version, protocol=6):
+        # 0 when the service is not registered, like GETPORT
+        for version, service_protocol, port in self.services.get(program, []):
+            if version == program_version and service_protocol == protocol_names.get(protocol):
+                return port
+
+        return 0
+
+def dump_ports(portmap):
+    # ServicePorts from a DUMP, None when the portmapper refuses it
+    try:
+        return ServicePorts(portmap.dump())
+    except OSError:
+        raise
+    except Exception:
+        return None
+
+def resolve_port(portmap, service_ports, program, program_version, protocol=6):
+    # the port from the DUMP, GETPORT when the DUMP was refused or does not list the service
+    port = service_ports.getport(program, program_version, protocol) if service_ports != None else 0
+    if port == 0:
+        port = portmap.getport(program, program_version, protocol)
+
+    return port
+
 class Portmap(RPC):
     program = 100000 # Portmap
     program_version = 2
@@ -21,50 +115,9 @@ class Portmap(RPC):
     def dump(self):
         procedure = 4 # Dump
 
-        proto = struct.pack(
-            '!LL',
-            self.program_version,
-            procedure
-        )
-
-        portmap = super(Portmap, self).request(self.program, self.program_version, procedure, data=proto)
-
-        rpc_map_entries = []
-
-        if len(portmap) <= 4:  # portmap_Value_Follows + one portmap_Map_entry
-            return rpc_map_entries
+        portmap = super(Portmap, self).request(self.program, self.program_version, procedure, pack_args=lambda packer: pack_dump(packer, self.program_version, procedure))
 
-        portmap_Value_Follows = portmap[0:4]
-        portmap_Map_Entries = portmap[4:]
-
-        while portmap_Value_Follows == b'\x00\x00\x00\x01':
-            (
-                program,
-                version,
-                protocol,
-                port
-            ) = struct.unpack('!LLLL', portmap_Map_Entries[:16])
-            portmap_Map_Entries = portmap_Map_Entries[16:]
-
-            if protocol == 0x06:
-                protocol = 'tcp'
-            elif protocol == 0x11:
-                protocol = 'udp'
-            else:
-                protocol = 'unknown'.format(protocol)
-
-            _ = {
-                'program': program, 'version': version,
-                'protocol': protocol, 'port': port
-            }
-            if _ not in rpc_map_entries:
-                rpc_map_entries.append(_)
-
-            portmap_Value_Follows = portmap_Map_Entries[0:4]
-            portmap_Map_Entries = portmap_Map_Entries[4:]
-
-
-        return rpc_map_entries
+        return parse_dump(portmap)
 
     def getport(self, getport_program, getport_program_version, getport_protocol=6):
         # RPC
@@ -72,20 +125,8 @@ class Portmap(RPC):
         program_version = 2
         procedure = 3 # GetPort
 
-        # GetPort
-        getport_port = 0
-
-        proto = struct.pack(
-            '!LLLL',
-            getport_program,
-            getport_program_version,
-            getport_protocol,
-            getport_port
-        )
-
-        getport = super(Portmap, self).request(program, program_version, procedure, data=proto)
+        getport = super(Portmap, self).request(program, program_version, procedure, pack_args=lambda packer: pack_getport(packer, getport_program, getport_program_version, getport_protocol))
 
-        (port,) = struct.unpack('!L', getport)
-        return port
+        return parse_getport(getport)
 
 
@@ -0,0 +1,178 @@
+import time
+import asyncio
+from contextlib import asynccontextmanager
+
+#
+# Author: Hegusung
+#
+
+# Scan rate limiting: token buckets bound the connections, RPC calls and bytes
+# per second, for the whole scan and for each host. Their rates and the number
+# of hosts scanned at once are scaled by a congestion controller (AIMD, as TCP
+# does): the scale is halved when the share of timeouts, connection resets and
+# refused connects rises above a threshold, and raised again while they stay
+# below it.
+
+class Congestion(object):
+    def __init__(self, initial=0.125, minimum=1/64, increase=0.1, threshold=0.05, window=1.0, min_events=10):
+        # scale in [minimum, 1]: doubled every window (slow start) until the first congestion, then raised by increase
+        self.scale = initial
+        self.minimum = minimum
+        self.increase = increase
+        self.threshold = threshold
+        self.window = window
+        self.min_events = min_events
+        self.slow_start = True
+        self.events = 0
+        self.errors = 0
+        self.window_start = time.monotonic()
+
+    def report(self, ok):
+        # ok is False for a timeout, a connection reset or a refused connect
+        self.events += 1
+        if not ok:
+            self.errors += 1
+
+        now = time.monotonic()
+        if now - self.window_start < self.window or self.events < self.min_events:
+            return
+
+        if self.errors > self.threshold*self.events:
+            self.scale = max(self.scale / 2, self.minimum)
+            self.slow_start = False
+        elif self.slow_start:
+            self.scale = min(self.scale*2, 1.0)
+        else:
+            self.scale = min(self.scale + self.increase, 1.0)
+
+        self.events = 0
+        self.errors = 0
+        self.window_start = now
+
+class TokenBucket(object):
+    def __init__(self, rate, congestion=None):
+        # rate: tokens per second, None for no limit, scaled by congestion
+        # the bucket holds up to one second of tokens
+        self.rate = rate
+        self.congestion = congestion
+        self.tokens = None
+        self.last = None
+
+    def current_rate(self):
+        if self.congestion != None:
+            return self.rate * self.congestion.scale
+        return self.rate
+
+    async def take(self, count=1):
+        if self.rate == None:
+            return
+
+        loop = asyncio.get_running_loop()
+        while True:
+            rate = self.current_rate()
+            now = loop.time()
+            if self.tokens == None:
+                self.tokens = rate
+            else:
+                self.tokens = min(self.tokens + (now - self.last)*rate, rate)
+            self.last = now
+
+            # a take bigger than the bucket is allowed once it is not empty, the next ones wait for the debt
+            if self.tokens > 0:
+                self.tokens -= count
+                return
+
+            await asyncio.sleep(max(-self.tokens / rate, 0.001))
+
+class Pacer(object):
+    # blocking rate limit of the liveness sweeps, which run outside of the event loop
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.next = time.monotonic()
+
+    def wait(self):
+        now = time.monotonic()
+        if now < self.next:
+            time.sleep(self.next - now)
+            now = self.next
+        self.next = max(self.next + self.interval, now)
+
+class ScanLimiter(object):
+    def __init__(self, workers, connection_rate=None, call_rate=None, byte_rate=None, host_connection_rate=None, host_call_rate=None, host_byte_rate=None, congestion_control=False):
+        # workers: maximum number of hosts scanned at once, scaled by the congestion controller
+        self.workers = workers
+        self.congestion = Congestion() if congestion_control else None
+        self.connections = TokenBucket(connection_rate, self.congestion)
+        self.calls = TokenBucket(call_rate, self.congestion)
+        self.bytes = TokenBucket(byte_rate, self.congestion)
+        self.host_rates = (host_connection_rate, host_call_rate, host_byte_rate)
+        self.congestion_control = congestion_control
+
+        self.active = 0
+        self.condition = asyncio.Condition()
+
+    def max_active(self):
+        if self.congestion != None:
+            return max(int(self.workers * self.congestion.scale), 1)
+        return self.workers
+
+    @asynccontextmanager
+    async def slot(self):
+        # a host is scanned in a slot
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.active < self.max_active())
+            self.active += 1
+
+        try:
+            yield
+        finally:
+            async with self.condition:
+                self.active -= 1
+                self.condition.notify_all()
+
+    def host(self):
+        return HostLimiter(self)
+
+    async def wake(self):
+        async with self.condition:
+            self.condition.notify_all()
+
+    def report(self, ok):
+        if self.congestion != None:
+            before = self.max_active()
+            self.congestion.report(ok)
+            # the hosts waiting for a slot are also let in when the scale grows, not only when a host is done
+            if self.max_active() > before:
+                asyncio.ensure_future(self.wake())
+
+class HostLimiter(object):
+    # limits of the connections to a host, shared by them, within the limits of the scan
+
+    def __init__(self, scan):
+        self.scan = scan
+        # a host makes too few calls for a slow start, its rates start at the limits
+        self.congestion = Congestion(initial=1.0) if scan.congestion_control else None
+        connection_rate, call_rate, byte_rate = scan.host_rates
+        self.connections = TokenBucket(connection_rate, self.congestion)
+        self.calls = TokenBucket(call_rate, self.congestion)
+        self.bytes = TokenBucket(byte_rate, self.congestion)
+
+    async def connection(self):
+        await self.scan.connections.take()
+        await self.connections.take()
+
+    async def call(self, size):
+        await self.scan.calls.take()
+        await self.calls.take()
+        await self.transferred(size)
+
+    async def transferred(self, size):
+        # bytes sent or received
+        await self.scan.bytes.take(size)
+        await self.bytes.take(size)
+
+    def report(self, ok):
+        if self.congestion != None:
+            self.congestion.report(ok)
+        self.scan.report(ok)
@@ -2,6 +2,10 @@ import struct
 import socket
 import time
 from random import randint
+from functools import lru_cache
+
+from .xdr import Packer, uint
+from .stats import CONNECT
 
 #
 # Author: Hegusung
@@ -10,100 +14,182 @@ from random import randint
 class RPCProtocolError(Exception):
     pass
 
+def bind_reserved_port(client):
+    # if we are running as root, use a source port between 500 and 1024 (NFS security options...)
+    try:
+        binded = False
+        while not binded:
+            try:
+                random_port = randint(500, 1024)
+                client.bind(('',random_port))
+                binded = True
+            except OSError as e:
+                if "Permission denied" in str(e):
+                    break
+    except PermissionError as e:
+        pass
+
+call_header = struct.Struct('!LLLLL')
+reply_header = struct.Struct('!LLLLLL')
+record_header = struct.Struct('!LL')
+
+AUTH_NULL = struct.pack('!LL', 0, 0)
+
+def credentials(auth):
+    if auth == None: # AUTH_NULL
+        return AUTH_NULL
+    elif auth["flavor"] == 1: # AUTH_UNIX
+        return auth_unix_credentials(auth["machine_name"], auth["uid"], auth["gid"], tuple(auth["aux_gid"]))
+    else:
+        raise Exception("RPC unknown auth method")
+
+@lru_cache(maxsize=256)
+def auth_unix_credentials(machine_name, uid, gid, aux_gids):
+    # serialized once per auth, the stamp is the one of the first use
+    stamp = int(time.time()) & 0xffff
+
+    packer = Packer(64)
+    packer.pack_uint(1) # AUTH_UNIX
+    packer.pack_uint(0) # length, set below
+    packer.pack_uint(stamp)
+    packer.pack_string(machine_name)
+    packer.pack_uint(uid)
+    packer.pack_uint(gid)
+    if len(aux_gids) == 1 and aux_gids[0] == 0:
+        packer.pack_uint(0)
+    else:
+        packer.pack_uint(len(aux_gids))
+        for aux_gid in aux_gids:
+            packer.pack_uint(aux_gid)
+
+    uint.pack_into(packer.buffer, 4, packer.offset - 8)
+
+    return bytes(packer.get_view())
+
+class RTTEstimator(object):
+    # smoothed round trip time and its variation, as computed by TCP (RFC 6298):
+    # the timeout is srtt + 4*rttvar within [floor, ceiling], doubled after every timeout until the next sample
+
+    def __init__(self, initial, floor, ceiling):
+        # initial: timeout used until the first sample
+        self.initial = initial
+        self.floor = floor
+        self.ceiling = ceiling
+        self.srtt = None
+        self.rttvar = None
+        self.backoff = 1
+
+    def sample(self, rtt):
+        if self.srtt == None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75*self.rttvar + 0.25*abs(self.srtt - rtt)
+            self.srtt = 0.875*self.srtt + 0.125*rtt
+        self.backoff = 1
+
+    def timed_out(self):
+        self.backoff = min(self.backoff*2, 64)
+
+    def timeout(self):
+        if self.srtt == None:
+            return self.initial
+
+        return min(max((self.srtt + 4*self.rttvar)*self.backoff, self.floor), self.ceiling)
+
+class HostTimeouts(object):
+    # timeouts of the connections to a host, derived from the durations of the previous connects (handshakes) and requests
+    # (request to reply) to it: the first ones are the portmap connect and NULL
+
+    def __init__(self, initial, floor, ceiling):
+        self.connect = RTTEstimator(initial, floor, ceiling)
+        self.read = RTTEstimator(initial, floor, ceiling)
+
 class RPC(object):
-    def __init__(self, host, port, timeout):
+    # bigger record fragments are considered as an error
+    max_fragment_size = 0x00010000
+    # program of the clients of a service, the connects are counted for it
+    program = None
+    # RPCStats shared by every connection, None to not collect statistics
+    stats = None
+
+    def __init__(self, host, port, timeout, protocol='tcp'):
         self.host = host
         self.port = port
         self.timeout = timeout
+        self.protocol = protocol
         self.client = None
-
-    def request(self, program, program_version, procedure, data=None, message_type=0, version=2, auth=None):
-
-        rpc_XID  = int(time.time())
-        rpc_message_type = message_type # 0=call
-        rpc_RPC_version = version
-        rpc_program = program
-        rpc_program_version = program_version
-        rpc_procedure = procedure
-        rpc_Verifier_Flavor = 0  # AUTH_NULL
-        rpc_Verifier_Length = 0
-
-        proto = struct.pack(
-            # Remote Procedure Call
-            '!LLLLLL',
-            rpc_XID,
-            rpc_message_type,
-            rpc_RPC_version,
-            rpc_program,
-            rpc_program_version,
-            rpc_procedure,
-        )
+        # XIDs are allocated sequentially from a random start, replies are matched on them
+        self.xid = randint(0, 0xffffffff)
+        self.replies = {}
+        self.packer = Packer()
+        self.call_prefixes = {}
+        # auth dicts are not modified once built, the credentials of the last one used are kept at hand
+        self.last_auth = None
+        self.last_credentials = None
+        # program, procedure, size and start time of the calls in flight, by XID, when statistics are collected
+        self.call_starts = {}
+
+    def next_xid(self):
+        self.xid = (self.xid + 1) & 0xffffffff
+        return self.xid
+
+    def build_call(self, program, program_version, procedure, data=None, message_type=0, version=2, auth=None, xid=None, pack_args=None):
+        # the call is built in the connection packer, the returned view is only valid until the next call is built
+        # the procedure arguments are either given as bytes (data) or written by pack_args(packer)
+
+        if xid == None:
+            rpc_XID  = self.next_xid()
+        else:
+            rpc_XID = xid
 
         if auth == None: # AUTH_NULL
-            proto += struct.pack(
-                '!LL',
-                0,
-                0,
-            )
-        elif auth["flavor"] == 1: # AUTH_UNIX
-            stamp = int(time.time())
-            stamp = int(time.time()) & 0xffff
-            auth_data = struct.pack(
-                    "!LL",
-                    stamp,
-                    len(auth["machine_name"])
-            )
-            auth_data += auth["machine_name"].encode()
-            auth_data += b'\x00'*((4-len(auth["machine_name"]) % 4)%4)
-            auth_data += struct.pack(
-                    "!LL",
-                    auth["uid"],
-                    auth["gid"],
-            )
-            if len(auth['aux_gid']) == 1 and auth['aux_gid'][0] == 0:
-                auth_data += struct.pack("!L", 0)
-            else:
-                auth_data += struct.pack("!L", len(auth["aux_gid"]))
-                for aux_gid in auth["aux_gid"]:
-                    auth_data += struct.pack("!L", aux_gid)
-
-            proto += struct.pack(
-                '!LL',
-                1,
-                len(auth_data),
-            )
-            proto += auth_data
-
+            cred = AUTH_NULL
+        elif auth is self.last_auth:
+            cred = self.last_credentials
         else:
-            raise Exception("RPC unknown auth method")
-
-        proto += struct.pack(
-            '!LL',
-            rpc_Verifier_Flavor,
-            rpc_Verifier_Length,
-        )
+            cred = credentials(auth)
+            self.last_auth = auth
+            self.last_credentials = cred
+
+        # everything following the XID up to the procedure arguments only depends on the procedure and the auth
+        call_key = (program, program_version, procedure, message_type, version, cred)
+        call_prefix = self.call_prefixes.get(call_key)
+        if call_prefix == None:
+            call_prefix = call_header.pack(
+                # Remote Procedure Call
+                message_type, # 0=call
+                version,
+                program,
+                program_version,
+                procedure,
+            ) + call_key[5] + AUTH_NULL # Verifier
+            self.call_prefixes[call_key] = call_prefix
+
+        packer = self.packer
+        # leave room for the record marking header and the XID, the prefix size is a multiple of 4
+        end = 8 + len(call_prefix)
+        packer.offset = 8
+        if end > len(packer.buffer):
+            packer.reserve(len(call_prefix))
+        packer.buffer[8:end] = call_prefix
+        packer.offset = end
 
         if data != None:
-            proto += data
-
-        rpc_fragment_header = 0x80000000 + len(proto)
+            packer.pack_fixed(data)
 
-        proto = struct.pack('!L', rpc_fragment_header) + proto
-
-        try:
-            self.client.send(proto)
+        if pack_args != None:
+            pack_args(packer)
 
-            last_fragment = False
-            data = b""
+        rpc_fragment_header = 0x80000000 + packer.offset - 4
 
-            while not last_fragment:
-                response = self.recv()
+        record_header.pack_into(packer.buffer, 0, rpc_fragment_header, rpc_XID)
 
-                last_fragment = struct.unpack('!L', response[:4])[0] & 0x80000000 != 0
+        # only valid until the next call is built
+        return memoryview(packer.buffer)[:packer.offset]
 
-                data += response[4:]
-
-            rpc = data[:24]
+    def parse_reply(self, data):
+        try:
             (
                 rpc_XID,
                 rpc_Message_Type,
@@ -111,59 +197,175 @@ class RPC(object):
                 rpc_Verifier_Flavor,
                 rpc_Verifier_Length,
                 rpc_Accept_State
-            ) = struct.unpack('!LLLLLL', rpc)
-
-            if rpc_Message_Type != 1 or rpc_Reply_State != 0 or rpc_Accept_State != 0:
-                raise Exception("RPC protocol error")
-
-            data = data[24:]
+            ) = reply_header.unpack_from(data)
         except struct.error:
             raise RPCProtocolError("incorrect struct size")
+
+        if rpc_Message_Type != 1 or rpc_Reply_State != 0 or rpc_Accept_State != 0:
+            raise Exception("RPC protocol error")
+
+        # the procedure results are decoded in place
+        return memoryview(data)[24:]
+
+    def request(self, program, program_version, procedure, data=None, message_type=0, version=2, auth=None, pack_args=None):
+        if self.protocol == 'udp':
+            xid = self.next_xid()
+            proto = self.build_call(program, program_version, procedure, data=data, message_type=message_type, version=version, auth=auth, xid=xid, pack_args=pack_args)[4:]
+
+            self.start_call(xid, program, procedure, len(proto))
+            try:
+                data = self.request_udp(proto)
+                reply = self.parse_reply(data)
+            except Exception as e:
+                self.end_call(xid, error=e)
+                raise
+            self.end_call(xid, len(data))
+
+            return reply
+
+        return self.result(self.submit(program, program_version, procedure, data=data, message_type=message_type, version=version, auth=auth, pack_args=pack_args))
+
+    def submit(self, program, program_version, procedure, data=None, message_type=0, version=2, auth=None, pack_args=None):
+        # send a call without waiting for its reply, several calls can be in flight on the same connection
+        xid = self.next_xid()
+        proto = self.build_call(program, program_version, procedure, data=data, message_type=message_type, version=version, auth=auth, xid=xid, pack_args=pack_args)
+
+        self.start_call(xid, program, procedure, len(proto))
+        try:
+            self.client.sendall(proto)
         except Exception as e:
-            raise e
+            self.end_call(xid, error=e)
+            raise
+
+        return xid
+
+    def result(self, xid):
+        try:
+            data = self.recv_reply(xid)
+            reply = self.parse_reply(data)
+        except Exception as e:
+            self.end_call(xid, error=e)
+            raise
+        # record marking header included
+        self.end_call(xid, len(data) + 4)
+
+        return reply
+
+    def discard(self, xids):
+        # reads the replies of calls in flight which are not needed anymore, the next replies are then matched on a clean connection
+        for xid in xids:
+            try:
+                self.result(xid)
+            except OSError:
+                # the connection is unusable anyway
+                return
+            except Exception:
+                pass
+
+    def recv_reply(self, xid):
+        # replies to other in flight calls are kept until their own result() call
+        if xid in self.replies:
+            return self.replies.pop(xid)
+
+        while True:
+            data = self.recv_record()
+            try:
+                (reply_xid,) = uint.unpack_from(data)
+            except struct.error:
+                raise RPCProtocolError("incorrect struct size")
+
+            if reply_xid == xid:
+                return data
+
+            self.replies[reply_xid] = data
+
+    def start_call(self, xid, program, procedure, size):
+        if self.stats != None:
+            self.call_starts[xid] = (program, procedure, size, time.monotonic())
+
+    def end_call(self, xid, size=0, error=None):
+        # the latency of a pipelined call runs from its call sent to its reply read
+        call = self.call_starts.pop(xid, None)
+        if call != None:
+            program, procedure, sent, start = call
+            self.stats.record(program, procedure, time.monotonic() - start, sent, size, error)
+
+    def recv_record(self):
+        last_fragment, data = self.recv_fragment()
+        if last_fragment:
+            return data
+
+        fragments = [data]
+        while not last_fragment:
+            last_fragment, data = self.recv_fragment()
+            fragments.append(data)
+
+        return b"".join(fragments)
+
+    def request_udp(self, proto):
+        # no record marking over UDP, one datagram per call and reply
+        self.client.send(proto)
+
+        while True:
+            data = self.client.recv(65535)
+
+            # drop late replies to previous calls
+            if data[:4] == proto[:4]:
+                break
 
         return data
 
     def connect(self):
-        self.client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if self.protocol == 'udp':
+            self.client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        else:
+            self.client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.client.settimeout(self.timeout)
-        # if we are running as root, use a source port between 500 and 1024 (NFS security options...)
+        bind_reserved_port(self.client)
+
+        start = time.monotonic()
         try:
-            binded = False
-            while not binded:
-                try:
-                    random_port = randint(500, 1024)
-                    self.client.bind(('',random_port))
-                    binded = True
-                except OSError as e:
-                    if "Permission denied" in str(e):
-                        break
-        except PermissionError as e:
-            pass
-
-        self.client.connect((self.host, self.port))
+            self.client.connect((self.host, self.port))
+        except Exception as e:
+            if self.stats != None:
+                self.stats.record(self.program, CONNECT, time.monotonic() - start, error=e)
+            raise
+        if self.stats != None:
+            self.stats.record(self.program, CONNECT, time.monotonic() - start)
 
     def disconnect(self):
         self.client.close()
 
-    def recv(self):
-        rpc_response = None
+    def recv_fragment(self):
+        (rpc_fragment_header,) = uint.unpack(self.recv_exactly(4))
+
+        last_fragment = rpc_fragment_header & 0x80000000 != 0
+        response_size = rpc_fragment_header & 0x7fffffff
+
+        if response_size > self.max_fragment_size: # len too high, propably an error
+            raise RPCProtocolError("response_size > 0x%08x: %d" % (self.max_fragment_size, response_size))
 
-        rpc_response_size = b""
-        while len(rpc_response_size) != 4:
-            rpc_response_size = self.client.recv(4)
+        return last_fragment, self.recv_exactly(response_size)
 
-        if len(rpc_response_size) != 4:
-            raise RPCProtocolError("incorrect recv response size: %d" % len(rpc_response_size))
-        response_size = struct.unpack('!L', rpc_response_size)[0] & 0x7fffffff
+    def recv_exactly(self, size):
+        data = self.client.recv(size)
+        if len(data) == size:
+            return data
 
-        if response_size > 0x00010000: # len too high, propably an error
-            raise RPCProtocolError("response_size > 0x00010000: %d" % response_size)
+        if len(data) == 0:
+            raise ConnectionResetError("connection closed by %s:%d" % (self.host, self.port))
 
-        rpc_response = rpc_response_size
-        while len(rpc_response) < response_size:
-            rpc_response = rpc_response + self.client.recv(response_size-len(rpc_response)+4)
+        # partial read, complete it in place
+        response = bytearray(size)
+        view = memoryview(response)
+        received = len(data)
+        view[:received] = data
+        while received < size:
+            chunk_size = self.client.recv_into(view[received:])
+            if chunk_size == 0:
+                raise ConnectionResetError("connection closed by %s:%d" % (self.host, self.port))
+            received += chunk_size
 
-        return rpc_response
+        return response
 
 
@@ -0,0 +1,117 @@
+from .portmap import ServicePorts
+from .mount import Mount
+from .nfs import NFS
+from .aio import AsyncPortmap, AsyncMount, AsyncNFS
+
+#
+# Author: Hegusung
+#
+
+# Connections to the RPC services of a host, shared by all the actions performed on
+# it: each service is connected to once, and the portmap table and the exports are
+# only asked once
+
+class HostSession(object):
+    def __init__(self, host, port, timeout, timeouts=None, limiter=None, dump=None):
+        # dump: DUMP entries of the portmapper already received (UDP sweep), None to ask for them
+        self.host = host
+        # portmapper port
+        self.port = port
+        self.timeout = timeout
+        # HostTimeouts of the connections, None to use timeout for everything
+        self.timeouts = timeouts
+        # HostLimiter of the connections, None for no rate limit
+        self.limiter = limiter
+        self.portmap = None
+        self.mount = None
+        self.nfs_clients = []
+        self.exports = None
+        # ServicePorts from the portmap DUMP, or the error if it was refused
+        self.service_ports = ServicePorts(dump) if dump != None else None
+        self.dump_error = None
+        # (program, version) -> port
+        self.ports = {}
+
+    async def get_portmap(self):
+        if self.portmap == None:
+            portmap = AsyncPortmap(self.host, self.port, self.timeout)
+            portmap.timeouts = self.timeouts
+            portmap.limiter = self.limiter
+            await portmap.connect()
+            self.portmap = portmap
+
+        return self.portmap
+
+    async def get_service_ports(self):
+        # None when the portmapper refuses DUMP
+        if self.service_ports == None and self.dump_error == None:
+            portmap = await self.get_portmap()
+            try:
+                self.service_ports = ServicePorts(await portmap.dump())
+            except OSError:
+                raise
+            except Exception as e:
+                self.dump_error = e
+
+        return self.service_ports
+
+    async def dump(self):
+        service_ports = await self.get_service_ports()
+        if service_ports == None:
+            raise self.dump_error
+
+        return service_ports.entries
+
+    async def getport(self, program, program_version):
+        if (program, program_version) not in self.ports:
+            service_ports = await self.get_service_ports()
+            port = service_ports.getport(program, program_version) if service_ports != None else 0
+            if port == 0:
+                # DUMP refused, or the service is not listed
+                portmap = await self.get_portmap()
+                port = await portmap.getport(program, program_version)
+            self.ports[(program, program_version)] = port
+
+        return self.ports[(program, program_version)]
+
+    async def get_mount(self):
+        if self.mount == None:
+            mount = AsyncMount(self.host, await self.getport(Mount.program, Mount.program_version), self.timeout)
+            mount.timeouts = self.timeouts
+            mount.limiter = self.limiter
+            await mount.connect()
+            self.mount = mount
+
+        return self.mount
+
+    async def get_exports(self):
+        if self.exports == None:
+            mount = await self.get_mount()
+            self.exports = await mount.export()
+
+        return self.exports
+
+    async def get_nfs(self, connections=1):
+        # returns connections NFS clients
+        while len(self.nfs_clients) < connections:
+            nfs = AsyncNFS(self.host, await self.getport(NFS.program, NFS.program_version), self.timeout)
+            nfs.timeouts = self.timeouts
+            nfs.limiter = self.limiter
+            await nfs.connect()
+            self.nfs_clients.append(nfs)
+
+        return self.nfs_clients[:connections]
+
+    async def close(self):
+        clients = self.nfs_clients
+        if self.mount != None:
+            clients = [self.mount] + clients
+        if self.portmap != None:
+            clients = [self.portmap] + clients
+
+        for client in clients:
+            await client.disconnect()
+
+        self.portmap = None
+        self.mount = None
+        self.nfs_clients = []
@@ -0,0 +1,153 @@
+import queue
+import signal
+import multiprocessing
+from collections import deque
+from itertools import islice
+
+#
+# Author: Hegusung
+#
+
+# Multi-process scan: the targets are numbered and dispatched in batches to
+# worker processes through a shared queue, so that a process which is done with
+# its hosts takes the next ones. Every process scans its targets in order and
+# streams the records back, the parent merges them in target order.
+
+def shard_targets(tasks, indexes):
+    # targets of a worker process, their indexes are kept in order for the results
+    while True:
+        batch = tasks.get()
+        if batch == None:
+            return
+
+        for item in batch:
+            indexes.append(item[0])
+            yield item[1:]
+
+def shard_worker(run, tasks, results, flush_size):
+    # Ctrl-C is handled by the parent, which terminates the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    indexes = deque()
+    messages = []
+
+    def flush():
+        if len(messages) != 0:
+            results.put(list(messages))
+            messages.clear()
+
+    def output(record):
+        # the records are output host after host, in the order of the targets
+        messages.append((indexes[0], record))
+        if len(messages) >= flush_size:
+            flush()
+
+    def host_done(host, port):
+        messages.append((indexes.popleft(), None))
+        flush()
+
+    result = run(shard_targets(tasks, indexes), output, host_done)
+
+    flush()
+    results.put([(None, result)])
+
+def sharded(targets, processes, run, output, host_done=None, window=4096, batch_size=64, flush_size=256):
+    # run(targets, output, host_done) scans the targets in a worker process, output(record) is called for every record
+    # and host_done(host, port) after the records of each host, in the order of the targets
+    # window: number of targets dispatched ahead of the first one not complete
+    # returns the values returned by run
+    tasks = multiprocessing.Queue(processes*2)
+    results = multiprocessing.Queue()
+
+    workers = []
+    for _ in range(processes):
+        worker = multiprocessing.Process(target=shard_worker, args=(run, tasks, results, flush_size))
+        worker.start()
+        workers.append(worker)
+
+    # index -> (host, port) of the targets dispatched and not complete
+    hosts = {}
+    # records of the targets which are not the first one, until its turn
+    buffered = {}
+    finished = set()
+    returned = []
+    position = {"next": 0, "count": 0}
+
+    def check_workers():
+        for worker in workers:
+            if worker.exitcode not in [None, 0]:
+                raise Exception("worker process %d exited with code %d" % (worker.pid, worker.exitcode))
+
+    def receive(block=True):
+        try:
+            messages = results.get(timeout=1) if block else results.get_nowait()
+        except queue.Empty:
+            check_workers()
+            return False
+
+        for index, record in messages:
+            if index == None:
+                returned.append(record)
+            elif record != None:
+                if index == position["next"]:
+                    output(record)
+                else:
+                    buffered.setdefault(index, []).append(record)
+            else:
+                finished.add(index)
+                while position["next"] in finished:
+                    finished.remove(position["next"])
+                    host, port = hosts.pop(position["next"])
+                    if host_done != None:
+                        host_done(host, port)
+
+                    position["next"] += 1
+                    for record in buffered.pop(position["next"], []):
+                        output(record)
+
+        return True
+
+    def dispatch(item):
+        while True:
+            try:
+                tasks.put(item, timeout=1)
+                return
+            except queue.Full:
+                check_workers()
+                while receive(block=False):
+                    pass
+
+    try:
+        targets = iter(targets)
+        while True:
+            batch = list(islice(targets, batch_size))
+            if len(batch) == 0:
+                break
+
+            while position["count"] - position["next"] >= window:
+                receive()
+
+            # the targets are (host, port), followed by the data of the sweep if any
+            batch = [(position["count"] + offset,) + tuple(target) for offset, target in enumerate(batch)]
+            for item in batch:
+                hosts[item[0]] = item[1:3]
+            dispatch(batch)
+            position["count"] += len(batch)
+
+            while receive(block=False):
+                pass
+
+        for _ in workers:
+            dispatch(None)
+
+        while position["next"] < position["count"] or len(returned) < len(workers):
+            receive()
+
+        for worker in workers:
+            worker.join()
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+
+    return returned
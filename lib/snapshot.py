@@ -0,0 +1,200 @@
+import os
+import json
+import asyncio
+from os.path import join
+
+from .nfs import NFSAccessError
+
+#
+# Author: Hegusung
+#
+
+# Incremental NFS tree listing: the entries of every directory listed are kept
+# in a snapshot with the mtime/ctime of the directory. The next walk sends a
+# GETATTR per directory and only lists again the directories whose mtime or
+# ctime changed, the entries added, removed and modified in them are reported.
+# A file modified in place does not change the mtime of its directory: only the
+# modifications of the entries of the directories listed again are seen.
+
+# snapshot entry: tuple of these fields
+entry_fields = ("file_id", "file_type", "file_size", "mtime", "ctime", "file_handle")
+
+class TreeSnapshots(object):
+    def __init__(self, path):
+        self.path = path
+        # (host, export) -> {directory path relative to the export: {"stamp", "file_handle", "entries": {name: entry}}}
+        self.trees = {}
+        # keys of the trees set since the snapshots were loaded
+        self.updated_keys = set()
+
+        self.load()
+
+    def get(self, host, export):
+        return self.trees.get((host, export), {})
+
+    def set(self, host, export, tree):
+        self.trees[(host, export)] = tree
+        self.updated_keys.add((host, export))
+
+    def updated(self):
+        # trees set since the snapshots were loaded, to be merged in the snapshots of another process
+        return {key: self.trees[key] for key in self.updated_keys}
+
+    def merge(self, trees):
+        for (host, export), tree in trees.items():
+            self.set(host, export, tree)
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                self.trees = {(tree["host"], tree["export"]): load_tree(tree["directories"]) for tree in json.load(f)}
+        except Exception:
+            # first walk, or unreadable snapshot: everything is reported as added
+            self.trees = {}
+
+    def save(self):
+        # JSON, the file handles in hex
+        trees = [{"host": host, "export": export, "directories": dump_tree(tree)} for (host, export), tree in self.trees.items()]
+        with open(self.path + ".tmp", 'w') as f:
+            json.dump(trees, f)
+        os.replace(self.path + ".tmp", self.path)
+
+def hex_handle(file_handle):
+    return file_handle.hex() if file_handle != None else None
+
+def bytes_handle(file_handle):
+    return bytes.fromhex(file_handle) if file_handle != None else None
+
+def dump_tree(tree):
+    directories = {}
+    for dir_path, directory in tree.items():
+        directories[dir_path] = {
+            "stamp": directory["stamp"],
+            "file_handle": hex_handle(directory["file_handle"]),
+            "entries": {name: entry[:5] + (hex_handle(entry[5]),) for name, entry in directory["entries"].items()},
+        }
+    return directories
+
+def load_tree(directories):
+    tree = {}
+    for dir_path, directory in directories.items():
+        tree[dir_path] = {
+            "stamp": tuple(directory["stamp"]),
+            "file_handle": bytes_handle(directory["file_handle"]),
+            "entries": {name: tuple(entry[:5]) + (bytes_handle(entry[5]),) for name, entry in directory["entries"].items()},
+        }
+    return tree
+
+def snapshot_entry(item):
+    return tuple(item[field] for field in entry_fields)
+
+def entry_dict(entry):
+    return dict(zip(entry_fields, entry))
+
+def is_modified(old_entry, entry):
+    # the mtime of a directory changes with its entries, which are compared on their own
+    if old_entry[0] != entry[0] or old_entry[1] != entry[1]:
+        return True
+    return entry[1] != 2 and (old_entry[2] != entry[2] or old_entry[3] != entry[3])
+
+def subtree(tree, dir_path):
+    # directories of tree under dir_path, dir_path included, sorted
+    prefix = dir_path + "/" if len(dir_path) != 0 else ""
+    return sorted(key for key in tree if key == dir_path or key.startswith(prefix))
+
+async def walk_changes(clients, auth, file_handle, path, max_depth, old_tree, new_tree, fanout=16):
+    # async generator of (path, change, entry, error), directories breadth first:
+    # - change is "added", "removed" or "modified", entry is a dict of entry_fields
+    # - directories which cannot be listed: (path + "/", None, None, NFSAccessError)
+    # new_tree is filled with the snapshot of the walk, errors on the root directory and transport errors are raised
+    if max_depth <= 0:
+        return
+
+    semaphore = asyncio.Semaphore(max(fanout, 1))
+
+    async def scan_dir(index, dir_path, dir_handle, stamp):
+        # returns (stamp, entries, listed, error)
+        client = clients[index % len(clients)]
+        old = old_tree.get(dir_path)
+
+        async with semaphore:
+            try:
+                if stamp == None:
+                    attributes = await client.getattr(dir_handle, auth=auth)
+                    stamp = (attributes["mtime"], attributes["ctime"])
+
+                if old != None and old["stamp"] == stamp:
+                    return stamp, old["entries"], False, None
+
+                # the stamp is taken before the listing: a change made meanwhile is seen by the next walk
+                items = await client.readdirplus(dir_handle, auth=auth)
+            except NFSAccessError as e:
+                if len(dir_path) == 0:
+                    raise
+                return None, None, False, e
+
+        entries = {}
+        for item in items:
+            if item["name"] not in [".", ".."]:
+                entries[item["name"]] = snapshot_entry(item)
+
+        return stamp, entries, True, None
+
+    def removed(dir_path):
+        # the entries of a directory removed, with the ones of its subdirectories
+        for key in subtree(old_tree, dir_path):
+            for name, entry in sorted(old_tree[key]["entries"].items()):
+                entry_path = join(path, key, name)
+                yield (entry_path + "/" if entry[1] == 2 else entry_path, "removed", entry_dict(entry), None)
+
+    # (directory path relative to the export, file handle, stamp if known)
+    level = [("", file_handle, None)]
+    depth = 0
+    while len(level) != 0:
+        results = await asyncio.gather(*[scan_dir(index, dir_path, dir_handle, stamp) for index, (dir_path, dir_handle, stamp) in enumerate(level)])
+
+        next_level = []
+        for (dir_path, dir_handle, _), (stamp, entries, listed, error) in zip(level, results):
+            if error != None:
+                # keep the previous snapshot of the directory, it is compared again by the next walk
+                for key in subtree(old_tree, dir_path):
+                    new_tree[key] = old_tree[key]
+                yield (join(path, dir_path) + "/", None, None, error)
+                continue
+
+            new_tree[dir_path] = {"stamp": stamp, "file_handle": dir_handle, "entries": entries}
+
+            if listed:
+                old = old_tree.get(dir_path)
+                old_entries = old["entries"] if old != None else {}
+
+                for name in sorted(set(old_entries) | set(entries)):
+                    entry_path = join(path, dir_path, name)
+
+                    if name not in entries:
+                        if old_entries[name][1] == 2:
+                            yield (entry_path + "/", "removed", entry_dict(old_entries[name]), None)
+                            for record in removed(join(dir_path, name)):
+                                yield record
+                        else:
+                            yield (entry_path, "removed", entry_dict(old_entries[name]), None)
+                        continue
+
+                    entry = entries[name]
+                    if entry[1] == 2:
+                        entry_path += "/"
+
+                    if name not in old_entries:
+                        yield (entry_path, "added", entry_dict(entry), None)
+                    elif is_modified(old_entries[name], entry):
+                        yield (entry_path, "modified", entry_dict(entry), None)
+
+            if depth + 1 < max_depth:
+                for name, entry in sorted(entries.items()):
+                    if entry[1] == 2 and entry[5] != None: # DIR
+                        # the attributes of the entries just listed are fresh, the others are asked with GETATTR
+                        child_stamp = (entry[3], entry[4]) if listed and entry[3] != None else None
+                        next_level.append((join(dir_path, name), entry[5], child_stamp))
+
+        level = next_level
+        depth += 1
@@ -0,0 +1,157 @@
+import json
+import time
+import sqlite3
+import threading
+from collections import deque
+
+#
+# Author: Hegusung
+#
+
+# Scan state saved to a SQLite database: the last result of every host (its
+# status and the records found on it) is saved as the scan goes, so that an
+# interrupted scan can be resumed and a rescan can skip the hosts found dead
+# recently.
+
+schema = """
+CREATE TABLE IF NOT EXISTS scans (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    started REAL,
+    actions TEXT
+);
+CREATE TABLE IF NOT EXISTS hosts (
+    host TEXT,
+    port INTEGER,
+    scan INTEGER,
+    status TEXT,
+    alive INTEGER,
+    updated REAL,
+    PRIMARY KEY (host, port)
+);
+CREATE TABLE IF NOT EXISTS records (
+    host TEXT,
+    port INTEGER,
+    type TEXT,
+    record TEXT
+);
+CREATE INDEX IF NOT EXISTS records_host ON records (host, port);
+"""
+
+class ScanState(object):
+    def __init__(self, path, actions, resume=False, max_age=None, commit_interval=1.0):
+        # resume: continue the last scan, the hosts it completed are skipped
+        # max_age: incremental scan, the hosts found dead less than max_age seconds ago are skipped
+        self.resume = resume
+        self.max_age = max_age
+        self.commit_interval = commit_interval
+        self.last_commit = time.monotonic()
+        # set when the scan is interrupted: the hosts being processed are not complete
+        self.stopped = False
+
+        # the targets are filtered in a thread while the hosts are processed in the event loop
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(schema)
+
+        self.scan = None
+        if resume:
+            row = self.db.execute("SELECT max(id) FROM scans").fetchone()
+            self.scan = row[0]
+        if self.scan == None:
+            cursor = self.db.execute("INSERT INTO scans (started, actions) VALUES (?, ?)", (time.time(), ",".join(actions)))
+            self.scan = cursor.lastrowid
+        self.db.commit()
+
+    def skip(self, host, port):
+        row = self.db.execute("SELECT scan, status, alive, updated FROM hosts WHERE host = ? AND port = ?", (host, port)).fetchone()
+        if row == None:
+            return False
+
+        scan, status, alive, updated = row
+        if status != "done":
+            return False
+
+        if self.resume and scan == self.scan:
+            return True
+
+        if self.max_age != None and not alive and updated > time.time() - self.max_age:
+            return True
+
+        return False
+
+    def select(self, targets):
+        # targets left to probe
+        for host, port in targets:
+            with self.lock:
+                skip = self.skip(host, port)
+            if not skip:
+                yield (host, port)
+
+    def sweep(self, targets, sweep):
+        # sweep yields the alive targets in order: the targets it drops are saved as dead
+        # the targets it yields may carry data after (host, port), they are passed on as they are
+        swept = deque()
+
+        def feed():
+            for target in targets:
+                swept.append(target)
+                yield target
+
+        for target in sweep(feed()):
+            while swept[0] != tuple(target[:2]):
+                self.dead(*swept.popleft())
+            swept.popleft()
+            yield target
+
+        while len(swept) != 0:
+            self.dead(*swept.popleft())
+
+    def save_host(self, host, port, status, alive):
+        self.db.execute("INSERT OR REPLACE INTO hosts (host, port, scan, status, alive, updated) VALUES (?, ?, ?, ?, ?, ?)", (host, port, self.scan, status, alive, time.time()))
+
+    def dead(self, host, port):
+        with self.lock:
+            self.db.execute("DELETE FROM records WHERE host = ? AND port = ?", (host, port))
+            self.save_host(host, port, "done", 0)
+            self.commit()
+
+    def start(self, host, port):
+        # the previous results of the host are replaced by the new ones
+        with self.lock:
+            self.db.execute("DELETE FROM records WHERE host = ? AND port = ?", (host, port))
+            self.save_host(host, port, "running", 0)
+
+    def add(self, host, port, record):
+        # section titles are not results
+        if record["type"] == "section":
+            return
+
+        with self.lock:
+            self.db.execute("INSERT INTO records (host, port, type, record) VALUES (?, ?, ?, ?)", (host, port, record["type"], json.dumps(record)))
+            if record["type"] == "portmapper":
+                self.db.execute("UPDATE hosts SET alive = 1 WHERE host = ? AND port = ?", (host, port))
+
+    def finish(self, host, port):
+        with self.lock:
+            if self.stopped:
+                return
+
+            self.db.execute("UPDATE hosts SET status = 'done', updated = ? WHERE host = ? AND port = ?", (time.time(), host, port))
+            self.commit()
+
+    def commit(self):
+        # at most one commit every commit_interval seconds, a crash loses the last hosts completed
+        if time.monotonic() - self.last_commit > self.commit_interval:
+            self.db.commit()
+            self.last_commit = time.monotonic()
+
+    def stop(self):
+        with self.lock:
+            self.stopped = True
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
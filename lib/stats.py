@@ -0,0 +1,223 @@
+import sys
+import json
+import socket
+import asyncio
+import threading
+import cProfile
+import pstats
+
+#
+# Author: Hegusung
+#
+
+# RPC statistics: the calls (request to reply) and the connects of the clients
+# are counted per program and procedure, with a histogram of their latencies,
+# the bytes sent and received, the timeouts and the errors. They are collected
+# once RPC.stats is set, for every connection.
+
+# upper bounds of the latency histogram buckets (seconds), the last bucket is unbounded
+latency_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+program_names = {
+    100000: "portmap",
+    100003: "nfs",
+    100005: "mount",
+}
+
+procedure_names = {
+    100000: {0: "NULL", 3: "GETPORT", 4: "DUMP"},
+    100003: {0: "NULL", 1: "GETATTR", 3: "LOOKUP", 6: "READ", 17: "READDIRPLUS", 19: "FSINFO"},
+    100005: {0: "NULL", 1: "MNT", 5: "EXPORT"},
+}
+
+# procedure of the connects
+CONNECT = "connect"
+
+class OperationStats(object):
+    def __init__(self):
+        self.calls = 0
+        self.timeouts = 0
+        self.errors = 0
+        self.sent = 0
+        self.received = 0
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+        self.buckets = [0]*(len(latency_buckets) + 1)
+
+    def add(self, seconds, sent, received, error):
+        self.calls += 1
+        if error == "timeout":
+            self.timeouts += 1
+        elif error != None:
+            self.errors += 1
+        self.sent += sent
+        self.received += received
+        self.latency_sum += seconds
+        self.latency_max = max(self.latency_max, seconds)
+
+        index = 0
+        while index < len(latency_buckets) and seconds > latency_buckets[index]:
+            index += 1
+        self.buckets[index] += 1
+
+    def merge(self, other):
+        self.calls += other.calls
+        self.timeouts += other.timeouts
+        self.errors += other.errors
+        self.sent += other.sent
+        self.received += other.received
+        self.latency_sum += other.latency_sum
+        self.latency_max = max(self.latency_max, other.latency_max)
+        for index, count in enumerate(other.buckets):
+            self.buckets[index] += count
+
+    def quantile(self, q):
+        # upper bound of the bucket holding the quantile, at most the maximum
+        rank = q*self.calls
+        total = 0
+        for index, count in enumerate(self.buckets):
+            total += count
+            if total >= rank and count != 0 and index < len(latency_buckets):
+                return min(latency_buckets[index], self.latency_max)
+        return self.latency_max
+
+    def cumulative_buckets(self):
+        # [(upper bound, number of operations up to it)], as in a Prometheus histogram
+        cumulative = []
+        total = 0
+        for bound, count in zip(latency_buckets + (float("inf"),), self.buckets):
+            total += count
+            cumulative.append((bound, total))
+        return cumulative
+
+def classify(error):
+    if error == None:
+        return None
+    if isinstance(error, (socket.timeout, asyncio.TimeoutError)):
+        return "timeout"
+    return "error"
+
+def operation_labels(program, procedure):
+    program_name = program_names.get(program, str(program))
+    if procedure == CONNECT:
+        return program_name, CONNECT
+    return program_name, procedure_names.get(program, {}).get(procedure, str(procedure))
+
+class RPCStats(object):
+    def __init__(self):
+        # (program, procedure or CONNECT) -> OperationStats
+        self.operations = {}
+        # the blocking clients of nfs-get.py run in threads
+        self.lock = threading.Lock()
+
+    def record(self, program, procedure, seconds, sent=0, received=0, error=None):
+        # error: the exception raised by the operation, None if it succeeded
+        with self.lock:
+            operation = self.operations.get((program, procedure))
+            if operation == None:
+                operation = OperationStats()
+                self.operations[(program, procedure)] = operation
+            operation.add(seconds, sent, received, classify(error))
+
+    def merge(self, operations):
+        # operations: the operations of the RPCStats of another process
+        with self.lock:
+            for key, other in operations.items():
+                self.operations.setdefault(key, OperationStats()).merge(other)
+
+    def sorted_operations(self):
+        # connects first, then the procedures of each program in order
+        return sorted(self.operations.items(), key=lambda item: (item[0][0] or 0, item[0][1] != CONNECT, str(item[0][1]).zfill(4)))
+
+    def summary(self):
+        lines = ["%-8s %-12s %8s %8s %8s %12s %12s %9s %9s %9s %9s" % ("program", "procedure", "calls", "timeouts", "errors", "sent", "received", "avg ms", "p50 ms", "p99 ms", "max ms")]
+        for (program, procedure), operation in self.sorted_operations():
+            program_name, procedure_name = operation_labels(program, procedure)
+            lines.append("%-8s %-12s %8d %8d %8d %12d %12d %9.2f %9.2f %9.2f %9.2f" % (
+                program_name, procedure_name, operation.calls, operation.timeouts, operation.errors, operation.sent, operation.received,
+                operation.latency_sum*1000 / max(operation.calls, 1), operation.quantile(0.5)*1000, operation.quantile(0.99)*1000, operation.latency_max*1000))
+        return "\n".join(lines)
+
+    def to_json(self):
+        result = []
+        for (program, procedure), operation in self.sorted_operations():
+            program_name, procedure_name = operation_labels(program, procedure)
+            result.append({
+                "program": program,
+                "program_name": program_name,
+                "procedure": procedure,
+                "procedure_name": procedure_name,
+                "calls": operation.calls,
+                "timeouts": operation.timeouts,
+                "errors": operation.errors,
+                "sent": operation.sent,
+                "received": operation.received,
+                "latency_sum": operation.latency_sum,
+                "latency_max": operation.latency_max,
+                "latency_buckets": [[bound if bound != float("inf") else "+Inf", count] for bound, count in operation.cumulative_buckets()],
+            })
+        return result
+
+    def prometheus(self):
+        counters = [
+            ("rpcscan_rpc_calls_total", "RPC calls and connects", "calls"),
+            ("rpcscan_rpc_timeouts_total", "RPC calls and connects timed out", "timeouts"),
+            ("rpcscan_rpc_errors_total", "RPC calls and connects failed", "errors"),
+            ("rpcscan_rpc_sent_bytes_total", "bytes of the RPC calls", "sent"),
+            ("rpcscan_rpc_received_bytes_total", "bytes of the RPC replies", "received"),
+        ]
+        operations = self.sorted_operations()
+
+        lines = []
+        for name, description, attribute in counters:
+            lines.append("# HELP %s %s" % (name, description))
+            lines.append("# TYPE %s counter" % name)
+            for (program, procedure), operation in operations:
+                lines.append('%s{program="%s",procedure="%s"} %d' % ((name,) + operation_labels(program, procedure) + (getattr(operation, attribute),)))
+
+        name = "rpcscan_rpc_latency_seconds"
+        lines.append("# HELP %s latency of the RPC calls (request to reply) and connects" % name)
+        lines.append("# TYPE %s histogram" % name)
+        for (program, procedure), operation in operations:
+            labels = 'program="%s",procedure="%s"' % operation_labels(program, procedure)
+            for bound, count in operation.cumulative_buckets():
+                lines.append('%s_bucket{%s,le="%s"} %d' % (name, labels, "+Inf" if bound == float("inf") else repr(bound), count))
+            lines.append('%s_sum{%s} %r' % (name, labels, operation.latency_sum))
+            lines.append('%s_count{%s} %d' % (name, labels, operation.calls))
+
+        return "\n".join(lines) + "\n"
+
+def write_stats(stats, summary=False, json_file=None, prometheus_file=None):
+    # the summary is written to stderr, stdout may hold the results
+    if summary:
+        print("RPC statistics:", file=sys.stderr)
+        print(stats.summary(), file=sys.stderr)
+
+    if json_file != None:
+        with open(json_file, 'w') as f:
+            json.dump(stats.to_json(), f, indent=2)
+
+    if prometheus_file != None:
+        with open(prometheus_file, 'w') as f:
+            f.write(stats.prometheus())
+
+def start_profile(enabled):
+    # returns the profiler, None if not enabled
+    if not enabled:
+        return None
+
+    profile = cProfile.Profile()
+    profile.enable()
+    return profile
+
+def stop_profile(profile, path=None, limit=40):
+    # the profile is saved to path (pstats format) if given, otherwise the hottest functions are written to stderr
+    if profile == None:
+        return
+
+    profile.disable()
+    if path != None:
+        profile.dump_stats(path)
+    else:
+        stats = pstats.Stats(profile, stream=sys.stderr)
+        stats.sort_stats("cumulative").print_stats(limit)
@@ -0,0 +1,106 @@
+import time
+import errno
+import socket
+import selectors
+from collections import deque
+
+from .ratelimit import Pacer
+
+#
+# Author: Hegusung
+#
+
+# Liveness pre-probe: non-blocking connects are fired at the targets through a
+# sliding window, each connect has its own window to succeed in and a new one is
+# started as soon as one ends. Only the targets which accept the connection are kept.
+
+def tcp_sweep(targets, timeout, batch_size=512, rate=None):
+    # targets is an iterable of (host, port), alive targets are yielded in the same order, as soon as the targets before them are done
+    # timeout: connect window of each target
+    # batch_size: maximum number of connects in flight
+    # rate: maximum number of connects per second, None for no limit
+    targets = iter(targets)
+    pacer = Pacer(rate) if rate != None else None
+    selector = selectors.DefaultSelector()
+
+    # [target, alive] in target order, alive is None while the connect is in flight
+    window = deque()
+    # (deadline, entry, socket) of the connects started, in deadline order, the ones done are dropped once they reach the head
+    deadlines = deque()
+    # target waiting for a file descriptor
+    next_target = None
+    done = False
+
+    try:
+        while True:
+            # the targets ahead of the first one in flight are bounded, a silent target does not buffer the whole range
+            starved = False
+            while not done and len(selector.get_map()) < batch_size and len(window) < batch_size*4:
+                if next_target == None:
+                    next_target = next(targets, None)
+                    if next_target == None:
+                        done = True
+                        break
+
+                try:
+                    client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                except OSError as e:
+                    if e.errno not in [errno.EMFILE, errno.ENFILE]:
+                        raise
+                    # the target is probed once a connect in flight is done
+                    starved = True
+                    break
+
+                if pacer != None:
+                    pacer.wait()
+
+                entry = [next_target, None]
+                window.append(entry)
+                next_target = None
+                client.setblocking(False)
+
+                try:
+                    res = client.connect_ex(tuple(entry[0]))
+                except OSError:
+                    res = None
+
+                if res in [errno.EINPROGRESS, errno.EWOULDBLOCK]:
+                    selector.register(client, selectors.EVENT_WRITE, entry)
+                    deadlines.append((time.monotonic() + timeout, entry, client))
+                else:
+                    entry[1] = res == 0
+                    client.close()
+
+            while len(window) != 0 and window[0][1] != None:
+                entry = window.popleft()
+                if entry[1]:
+                    yield entry[0]
+
+            if len(selector.get_map()) == 0:
+                deadlines.clear()
+                if done and len(window) == 0:
+                    break
+                if starved:
+                    # no file descriptor free, the scan running meanwhile releases some
+                    time.sleep(0.1)
+                continue
+
+            # the connects which succeeded while the alive targets were consumed are read before the deadlines are checked
+            for key, _ in selector.select(max(deadlines[0][0] - time.monotonic(), 0)):
+                client = key.fileobj
+                key.data[1] = client.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0
+                selector.unregister(client)
+                client.close()
+
+            now = time.monotonic()
+            while len(deadlines) != 0 and (deadlines[0][1][1] != None or deadlines[0][0] <= now):
+                _, entry, client = deadlines.popleft()
+                if entry[1] == None:
+                    entry[1] = False
+                    selector.unregister(client)
+                    client.close()
+    finally:
+        for key in list(selector.get_map().values()):
+            selector.unregister(key.fileobj)
+            key.fileobj.close()
+        selector.close()
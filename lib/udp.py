@@ -0,0 +1,133 @@
+import time
+import struct
+import socket
+import selectors
+from random import randint
+from itertools import islice
+
+from .rpc import RPC
+from .portmap import Portmap, pack_dump, parse_dump
+from .ratelimit import Pacer
+
+#
+# Author: Hegusung
+#
+
+# Connectionless discovery: a single UDP socket sends the same call to a whole
+# batch of targets, replies are matched back to their target using the XID
+
+def batch_request(targets, program, program_version, procedure, pack_args=None, timeout=1, retries=1, batch_size=4096, rate=None):
+    # yields (host, port, reply data) for every target which answered
+    # rate: maximum number of calls sent per second, None for no limit
+    targets = iter(targets)
+    pacer = Pacer(rate) if rate != None else None
+    rpc = RPC(None, None, timeout, protocol='udp')
+
+    while True:
+        batch = list(islice(targets, batch_size))
+        if len(batch) == 0:
+            break
+
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        client.setblocking(False)
+        selector = selectors.DefaultSelector()
+        selector.register(client, selectors.EVENT_READ)
+
+        # one xid per target of the batch, the record marking header is not used over UDP
+        # the replies are matched to the address of the target, host names are resolved once
+        xid_base = randint(0, 0xffffffff - len(batch))
+        calls = {}
+        for index, (host, port) in enumerate(batch):
+            try:
+                address = (socket.gethostbyname(host), port)
+            except OSError:
+                continue
+            calls[xid_base + index] = (index, address, bytes(rpc.build_call(program, program_version, procedure, pack_args=pack_args, xid=xid_base+index)[4:]))
+
+        replies = {}
+        try:
+            for _ in range(retries+1):
+                for xid, (index, address, proto) in calls.items():
+                    if index in replies:
+                        continue
+
+                    if pacer != None:
+                        pacer.wait()
+
+                    while True:
+                        try:
+                            client.sendto(proto, address)
+                            break
+                        except (BlockingIOError, InterruptedError):
+                            # socket buffer full, let the kernel drain it
+                            time.sleep(0.001)
+                        except OSError:
+                            # unreachable target
+                            break
+
+                    # read replies while sending to keep the receive buffer from overflowing
+                    receive_replies(client, calls, replies, rpc)
+
+                deadline = time.monotonic() + timeout
+                while len(replies) != len(calls):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+
+                    if len(selector.select(remaining)) != 0:
+                        receive_replies(client, calls, replies, rpc)
+
+                if len(replies) == len(calls):
+                    break
+        finally:
+            selector.close()
+            client.close()
+
+        for index, target in enumerate(batch):
+            if index in replies:
+                yield (target[0], target[1], replies[index])
+
+def receive_replies(client, calls, replies, rpc):
+    while True:
+        try:
+            data, addr = client.recvfrom(65535)
+        except (BlockingIOError, InterruptedError):
+            break
+        except OSError:
+            # ICMP errors are reported on the socket, skip them
+            continue
+
+        if len(data) < 4:
+            continue
+
+        (xid,) = struct.unpack('!L', data[:4])
+        # the reply must come from the target the xid was sent to
+        if xid not in calls or addr[:2] != calls[xid][1]:
+            continue
+
+        try:
+            replies[calls[xid][0]] = rpc.parse_reply(data)
+        except Exception:
+            # rejected or malformed reply, the target is still alive
+            replies[calls[xid][0]] = None
+
+def portmap_null_sweep(targets, timeout=1, retries=1, batch_size=4096, rate=None):
+    for host, port, _ in batch_request(targets, Portmap.program, Portmap.program_version, 0, timeout=timeout, retries=retries, batch_size=batch_size, rate=rate):
+        yield (host, port)
+
+def portmap_dump_sweep(targets, timeout=1, retries=1, batch_size=4096, rate=None):
+    # yields (host, port, DUMP entries) for every target which answered
+    # the entries are None when the DUMP was refused or its reply is malformed, the target is still alive
+    procedure = 4 # Dump
+
+    args = lambda packer: pack_dump(packer, Portmap.program_version, procedure)
+
+    for host, port, data in batch_request(targets, Portmap.program, Portmap.program_version, procedure, pack_args=args, timeout=timeout, retries=retries, batch_size=batch_size, rate=rate):
+        entries = None
+        if data != None:
+            try:
+                entries = parse_dump(data)
+            except Exception:
+                pass
+
+        yield (host, port, entries)
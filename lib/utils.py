@@ -1,4 +1,7 @@
 import csv
+import argparse
+import resource
+from bisect import bisect_left, bisect_right
 
 def parse_rpc_names(csv_rpc_names):
     rpc_names = []
@@ -8,9 +11,9 @@ def parse_rpc_names(csv_rpc_names):
         next(spamreader, None) #skip the header
         for row in spamreader:
             if '-' in row[1]:
-                rng = range(int(row[1].split('-')[0]),int(row[1].split('-')[1]))
+                rng = range(int(row[1].split('-')[0]),int(row[1].split('-')[1])+1)
             else:
-                rng = [int(row[1])]
+                rng = range(int(row[1]), int(row[1])+1)
 
             if len(row[0]) != 0:
                 name = row[0]
@@ -23,3 +26,85 @@ def parse_rpc_names(csv_rpc_names):
             })
 
     return rpc_names
+
+class RPCNames(object):
+    # sorted, non overlapping program number intervals: lookups are a bisect
+
+    def __init__(self, starts, ends, names):
+        self.starts = starts
+        self.ends = ends
+        self.names = names
+
+    @classmethod
+    def from_rpc_names(cls, rpc_names):
+        # when ranges overlap, the first one of the csv file wins
+        points = set()
+        for rpc_service in rpc_names:
+            points.add(rpc_service["range"].start)
+            points.add(rpc_service["range"].stop)
+        points = sorted(points)
+
+        segment_names = [None]*len(points)
+        for rpc_service in reversed(rpc_names):
+            first = bisect_left(points, rpc_service["range"].start)
+            last = bisect_left(points, rpc_service["range"].stop)
+            for index in range(first, last):
+                segment_names[index] = rpc_service["name"]
+
+        starts = []
+        ends = []
+        names = []
+        for index in range(len(points)-1):
+            name = segment_names[index]
+            if name == None:
+                continue
+
+            if len(names) != 0 and names[-1] == name and ends[-1] == points[index]:
+                ends[-1] = points[index+1]
+            else:
+                starts.append(points[index])
+                ends.append(points[index+1])
+                names.append(name)
+
+        return cls(starts, ends, names)
+
+    def lookup(self, program):
+        index = bisect_right(self.starts, program) - 1
+
+        if index >= 0 and program < self.ends[index]:
+            return self.names[index]
+
+        return None
+
+rpc_names_indexes = {}
+
+def load_rpc_names(csv_rpc_names):
+    # the index is built once per process, from the csv file (a few milliseconds)
+    if csv_rpc_names not in rpc_names_indexes:
+        rpc_names_indexes[csv_rpc_names] = RPCNames.from_rpc_names(parse_rpc_names(csv_rpc_names))
+
+    return rpc_names_indexes[csv_rpc_names]
+
+def open_files_limit():
+    # number of file descriptors the process can open, the soft limit is raised up to the hard limit
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+            soft = hard
+        except (ValueError, OSError):
+            pass
+
+    return soft
+
+def positive_float(value):
+    # argparse type of the rates, which are divided by
+    try:
+        number = float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid float value: '%s'" % value)
+
+    if not number > 0:
+        raise argparse.ArgumentTypeError("must be greater than 0: '%s'" % value)
+
+    return number
@@ -0,0 +1,96 @@
+import asyncio
+from os.path import join
+
+from .nfs import NFSAccessError
+
+#
+# Author: Hegusung
+#
+
+# Concurrent NFS tree walk: directories are listed by fanout workers with READDIRPLUS
+# calls pipelined over the given connections, while the entries are yielded in
+# depth-first order. The work queue is ordered by depth-first position, so the
+# workers list the directories which are about to be yielded first, and only the
+# children of the directories on the current path are queued.
+
+async def walk(clients, auth, file_handle, path, max_depth, fanout=16):
+    # async generator of (path, entry, error):
+    # - files: (path, readdirplus entry, None)
+    # - directories not listed (max_depth reached, access error) or empty: (path + "/", readdirplus entry or None for the root, NFSAccessError or None)
+    # errors listing the root directory and transport errors are raised
+    if max_depth <= 0:
+        yield (path + "/", None, None)
+        return
+
+    loop = asyncio.get_running_loop()
+    work = asyncio.PriorityQueue()
+    futures = set()
+
+    def schedule(position, dir_handle):
+        future = loop.create_future()
+        futures.add(future)
+        work.put_nowait((position, dir_handle, future))
+        return future
+
+    async def worker(client):
+        while True:
+            position, dir_handle, future = await work.get()
+            if future.done():
+                continue
+
+            try:
+                future.set_result(await client.readdirplus(dir_handle, auth=auth))
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
+            except Exception as e:
+                future.set_exception(e)
+
+    async def listed(path, entry, future, position, depth):
+        try:
+            items = await future
+        except NFSAccessError as e:
+            if depth == 0:
+                raise
+            yield (path + "/", entry, e)
+            return
+        finally:
+            futures.discard(future)
+
+        if len(items) == 0:
+            yield (path + "/", entry, None)
+            return
+
+        # queue the subdirectories before yielding, the workers list them meanwhile
+        children = {}
+        if depth + 1 < max_depth:
+            for index, item in enumerate(items):
+                if item["file_type"] == 2 and item["name"] not in [".", ".."]:
+                    children[index] = schedule(position + (index,), item["file_handle"])
+
+        for index, item in enumerate(items):
+            if item["name"] in [".", ".."]:
+                continue
+
+            item_path = join(path, item["name"])
+            if index in children:
+                async for record in listed(item_path, item, children[index], position + (index,), depth + 1):
+                    yield record
+            elif item["file_type"] == 2:
+                yield (item_path + "/", item, None)
+            else:
+                yield (item_path, item, None)
+
+    workers = [asyncio.ensure_future(worker(clients[index % len(clients)])) for index in range(max(fanout, 1))]
+    try:
+        async for record in listed(path, None, schedule((), file_handle), (), 0):
+            yield record
+    finally:
+        for task in workers:
+            task.cancel()
+        # the walk stopped early: the listings queued are not needed anymore
+        for future in futures:
+            if future.done() and not future.cancelled():
+                future.exception()
+            else:
+                future.cancel()
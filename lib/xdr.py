@@ -0,0 +1,139 @@
+import struct
+
+#
+# Author: Hegusung
+#
+
+# XDR decoding over a memoryview: fields are read in place at an offset with
+# struct.unpack_from, only the values handed back to the caller are copied.
+# Encoding is done with pack_into in a bytearray which is reused from one call to the next.
+
+uint = struct.Struct('!L')
+uhyper = struct.Struct('!Q')
+
+class Unpacker(object):
+    def __init__(self, data, offset=0):
+        self.data = memoryview(data)
+        self.size = len(self.data)
+        self.offset = offset
+
+    def unpack_uint(self):
+        (value,) = uint.unpack_from(self.data, self.offset)
+        self.offset += 4
+        return value
+
+    def unpack_uhyper(self):
+        (value,) = uhyper.unpack_from(self.data, self.offset)
+        self.offset += 8
+        return value
+
+    def unpack_bool(self):
+        (value,) = uint.unpack_from(self.data, self.offset)
+        self.offset += 4
+        return value != 0
+
+    def unpack_struct(self, fmt):
+        # fmt is a struct.Struct, for fixed size groups of fields
+        values = fmt.unpack_from(self.data, self.offset)
+        self.offset += fmt.size
+        return values
+
+    def unpack_fixed_view(self, size):
+        start = self.offset
+        end = start + size
+        if end > self.size:
+            raise struct.error("unpack requires a buffer of %d bytes" % end)
+
+        self.offset = end + (-size & 3)
+        return self.data[start:end]
+
+    def unpack_opaque_view(self):
+        (size,) = uint.unpack_from(self.data, self.offset)
+        self.offset += 4
+        return self.unpack_fixed_view(size)
+
+    def unpack_opaque(self):
+        return bytes(self.unpack_opaque_view())
+
+    def unpack_string(self):
+        return str(self.unpack_opaque_view(), 'utf-8')
+
+    def skip(self, size):
+        if self.offset + size > self.size:
+            raise struct.error("unpack requires a buffer of %d bytes" % (self.offset + size))
+        self.offset += size
+
+    def remaining(self):
+        return self.size - self.offset
+
+PADDING = (b'', b'\x00', b'\x00'*2, b'\x00'*3)
+
+class Packer(object):
+    def __init__(self, size=4096):
+        self.buffer = bytearray(size)
+        self.offset = 0
+
+    def reset(self, offset=0):
+        self.offset = offset
+
+    def reserve(self, size):
+        if self.offset + size > len(self.buffer):
+            # views returned by get_view() may still be alive, grow into a new buffer
+            buffer = bytearray(max(len(self.buffer)*2, self.offset + size))
+            buffer[:self.offset] = self.buffer[:self.offset]
+            self.buffer = buffer
+
+    def pack_uint(self, value):
+        if self.offset + 4 > len(self.buffer):
+            self.reserve(4)
+        uint.pack_into(self.buffer, self.offset, value)
+        self.offset += 4
+
+    def pack_uhyper(self, value):
+        if self.offset + 8 > len(self.buffer):
+            self.reserve(8)
+        uhyper.pack_into(self.buffer, self.offset, value)
+        self.offset += 8
+
+    def pack_struct(self, fmt, *values):
+        # fmt is a struct.Struct, for fixed size groups of fields
+        if self.offset + fmt.size > len(self.buffer):
+            self.reserve(fmt.size)
+        fmt.pack_into(self.buffer, self.offset, *values)
+        self.offset += fmt.size
+
+    def pack_fixed(self, data):
+        size = len(data)
+        if self.offset + size + 3 > len(self.buffer):
+            self.reserve(size + 3)
+
+        end = self.offset + size
+        self.buffer[self.offset:end] = data
+
+        padding = -size & 3
+        if padding != 0:
+            self.buffer[end:end+padding] = PADDING[padding]
+        self.offset = end + padding
+
+    def pack_opaque(self, data):
+        size = len(data)
+        if self.offset + size + 7 > len(self.buffer):
+            self.reserve(size + 7)
+
+        start = self.offset + 4
+        end = start + size
+        uint.pack_into(self.buffer, self.offset, size)
+        self.buffer[start:end] = data
+
+        padding = -size & 3
+        if padding != 0:
+            self.buffer[end:end+padding] = PADDING[padding]
+        self.offset = end + padding
+
+    def pack_string(self, data):
+        self.pack_opaque(data.encode())
+
+    def get_view(self):
+        # only valid until the next use of the packer
+        return memoryview(self.buffer)[:self.offset]
+
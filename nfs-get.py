@@ -3,11 +3,13 @@
 import sys
 import time
 import argparse
+from os.path import basename
 from urllib.parse import urlparse
 
-from lib.portmap import Portmap
-from lib.mount import Mount
-from lib.nfs import NFS
+from lib.rpc import RPC
+from lib.stats import RPCStats, write_stats, start_profile, stop_profile
+from lib.lookup import LookupCache, resolve_path
+from lib.download import download, mirror
 
 #
 # Author: Hegusung
@@ -16,11 +18,25 @@ from lib.nfs import NFS
 def main():
     parser = argparse.ArgumentParser(description='download a nfs file', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument('nfs_path', help='nfs path', nargs='?', default=None)
+    parser.add_argument('-p', help='portmapper port', dest='port', default=111, type=int)
     parser.add_argument('-t', help='timeout', nargs='?', default=15, type=int, dest='timeout')
     parser.add_argument('-u', help='uid', nargs='?', default=0, type=int, dest='uid')
     parser.add_argument('-g', help='gid', nargs='?', default=0, type=int, dest='gid')
     parser.add_argument('--hostname', help='authentication hostname', nargs='?', default="nfsclient", type=str, dest='hostname')
-    parser.add_argument('-d', help='destination file', nargs='?', type=str, dest='destination_file')
+    parser.add_argument('-d', help='destination file (destination directory with --recursive)', nargs='?', type=str, dest='destination_file')
+    parser.add_argument('--recursive', help='mirror a directory tree, files already present with the same size and mtime are skipped', action='store_true', dest='recursive')
+    parser.add_argument('--fanout', help='number of directories listed at once with --recursive', nargs='?', default=16, type=int, dest='fanout')
+    parser.add_argument('--chunk-size', help='size of the READ calls (bytes)', nargs='?', default=1024*1024, type=int, dest='chunk_size')
+    parser.add_argument('--window', help='number of READ calls in flight per connection', nargs='?', default=8, type=int, dest='window')
+    parser.add_argument('--connections', help='number of NFS connections, each one downloads a byte range of the file (a file at a time with --recursive)', nargs='?', default=4, type=int, dest='connections')
+    parser.add_argument('--no-checkpoint', help='do not save the progress to <destination file>.nfsget to resume interrupted downloads', action='store_false', dest='checkpoint')
+    parser.add_argument('--lookup-cache', help='file keeping the file handles of the paths resolved, shared with nfs-ls.py', nargs='?', default=None, type=str, dest='lookup_cache')
+    parser.add_argument('--lookup-cache-ttl', help='lifetime of the file handles in the lookup cache (seconds)', nargs='?', default=300, type=int, dest='lookup_cache_ttl')
+    parser.add_argument('--sha256', help='compute the SHA-256 of the file while it is downloaded, and compare it to the given value if any', nargs='?', const='', default=None, type=str, dest='sha256')
+    parser.add_argument('--stats', help='print the count, latency, bytes, timeouts and errors of the connects and RPC calls per program and procedure at exit', action='store_true', dest='stats')
+    parser.add_argument('--stats-json', help='write the RPC statistics to the given file as JSON', nargs='?', default=None, type=str, dest='stats_json')
+    parser.add_argument('--stats-prometheus', help='write the RPC statistics to the given file in the Prometheus text format', nargs='?', default=None, type=str, dest='stats_prometheus')
+    parser.add_argument('--profile', help='profile with cProfile, the hottest functions are printed at exit or the profile is saved to the given file', nargs='?', const='', default=None, type=str, dest='profile')
 
     args = parser.parse_args()
 
@@ -28,6 +44,18 @@ def main():
         parser.print_help()
         sys.exit()
 
+    if args.stats or args.stats_json != None or args.stats_prometheus != None:
+        RPC.stats = RPCStats()
+
+    profile = start_profile(args.profile != None)
+    try:
+        get(args)
+    finally:
+        stop_profile(profile, args.profile if args.profile else None)
+        if RPC.stats != None:
+            write_stats(RPC.stats, summary=args.stats, json_file=args.stats_json, prometheus_file=args.stats_prometheus)
+
+def get(args):
     nfs_path = args.nfs_path
     timeout = args.timeout
 
@@ -47,61 +75,51 @@ def main():
     host = o.netloc
     uri = o.path
 
-    portmapper_port = 111
-    portmap = Portmap(host, portmapper_port, timeout)
-    portmap.connect()
-
-    # get mount service port
-    mount_port = portmap.getport(Mount.program, Mount.program_version)
-    mount = Mount(host, mount_port, timeout)
-    mount.connect()
-
-    # list mount points and grab the correct file handle
-    file_handle = None
-    for mountpoint in mount.export():
-        if uri.startswith(mountpoint["path"]):
-            mount_path = mountpoint["path"]
-            file_handle = mount.mnt(mountpoint["path"])["file_handle"]
-            file_type = 2
-
-    if file_handle == None:
-        mount.disconnect()
-        portmap.disconnect()
-        raise Exception("Mount point not found")
-
-    # get nfs port
-    nfs_port = portmap.getport(NFS.program, NFS.program_version)
-    nfs = NFS(host, nfs_port, timeout)
-    nfs.connect()
-
-    # iterate through folders
-    folders_str = uri[len(mount_path):]
-
-    for folder in folders_str.split("/"):
-        if len(folder) == 0:
-            continue
-
-        res = nfs.lookup(file_handle, folder, auth=auth)
-        if res["file_type"] == 2: # DIR
-            file_handle = res["file_handle"]
-            file_type = res["file_type"]
-        elif res["file_type"] in [1] and folder == folders_str.split("/")[-1]: # last file
-            file_handle = res["file_handle"]
-            file_type = res["file_type"]
-        else:
-            raise Exception("Unexpected file type")
+    cache = LookupCache(args.lookup_cache, ttl=args.lookup_cache_ttl)
+
+    # the attributes of a cached handle are refreshed: the size and mtime are used to resume downloads
+    res = resolve_path(host, uri, timeout, auth=auth, cache=cache, portmapper_port=args.port, refresh=True)
+    cache.save()
+
+    nfs = res["nfs"]
+    file_handle = res["file_handle"]
+    file_type = res["file_type"]
+    file_size = res["file_size"]
+    mtime = res["mtime"]
+    folders_str = uri[len(res["export"]):]
 
     # We got the handle, read file
     if file_type == 1: # regular file
-        data = nfs.read(file_handle, auth=auth)
         if args.destination_file == None:
             file_name = folders_str.split("/")[-1]
         else:
             file_name = args.destination_file
-        f = open(file_name, 'wb')
-        f.write(data)
-        f.close()
+        if args.checkpoint:
+            checkpoint_file = file_name + ".nfsget"
+        else:
+            checkpoint_file = None
+        # the chunks are written at their offset as they are received, at most connections*window*chunk_size bytes are held in memory
+        res = download(nfs, file_handle, file_size, file_name, auth=auth, connections=max(args.connections, 1), chunk_count=max(args.chunk_size, 1), window=max(args.window, 1), mtime=mtime, checkpoint_file=checkpoint_file, sha256=args.sha256 != None)
+        nfs.disconnect()
+        if res["resumed"]:
+            print("download of %s resumed" % file_name)
         print("file %s written" % file_name)
+
+        if args.sha256 != None:
+            print("sha256: %s" % res["sha256"])
+            if len(args.sha256) != 0 and args.sha256.lower() != res["sha256"]:
+                raise Exception("SHA-256 mismatch")
+    elif file_type == 2 and args.recursive: # directory
+        if args.destination_file == None:
+            file_name = basename(uri.rstrip("/"))
+            if len(file_name) == 0:
+                file_name = host
+        else:
+            file_name = args.destination_file
+        # the tree is walked over the current connection, files are downloaded by a pool of connections
+        res = mirror(nfs, file_handle, file_name, auth=auth, workers=max(args.connections, 1), chunk_count=max(args.chunk_size, 1), window=max(args.window, 1), checkpoint=args.checkpoint, fanout=max(args.fanout, 1))
+        nfs.disconnect()
+        print("%d files written (%d bytes), %d skipped, %d errors" % (res["files"], res["bytes"], res["skipped"], res["errors"]))
     else:
         raise Exception("Unexpected file type")
 
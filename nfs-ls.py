@@ -5,9 +5,10 @@ import time
 import argparse
 from urllib.parse import urlparse
 
-from lib.portmap import Portmap
-from lib.mount import Mount
-from lib.nfs import NFS
+from lib.nfs import NFSAccessError
+from lib.rpc import RPC
+from lib.stats import RPCStats, write_stats, start_profile, stop_profile
+from lib.lookup import LookupCache, resolve_path
 
 #
 # Author: Hegusung
@@ -19,7 +20,14 @@ def main():
     parser.add_argument('-u', help='uid', nargs='?', default=0, type=int, dest='uid')
     parser.add_argument('-g', help='gid', nargs='?', default=0, type=int, dest='gid')
     parser.add_argument('--hostname', help='authentication hostname', nargs='?', default="nfsclient", type=str, dest='hostname')
+    parser.add_argument('-p', help='portmapper port', dest='port', default=111, type=int)
     parser.add_argument('-t', help='timeout', nargs='?', default=15, type=int, dest='timeout')
+    parser.add_argument('--lookup-cache', help='file keeping the file handles of the paths resolved, shared with nfs-get.py', nargs='?', default=None, type=str, dest='lookup_cache')
+    parser.add_argument('--lookup-cache-ttl', help='lifetime of the file handles in the lookup cache (seconds)', nargs='?', default=300, type=int, dest='lookup_cache_ttl')
+    parser.add_argument('--stats', help='print the count, latency, bytes, timeouts and errors of the connects and RPC calls per program and procedure at exit', action='store_true', dest='stats')
+    parser.add_argument('--stats-json', help='write the RPC statistics to the given file as JSON', nargs='?', default=None, type=str, dest='stats_json')
+    parser.add_argument('--stats-prometheus', help='write the RPC statistics to the given file in the Prometheus text format', nargs='?', default=None, type=str, dest='stats_prometheus')
+    parser.add_argument('--profile', help='profile with cProfile, the hottest functions are printed at exit or the profile is saved to the given file', nargs='?', const='', default=None, type=str, dest='profile')
 
     args = parser.parse_args()
 
@@ -27,6 +35,18 @@ def main():
         parser.print_help()
         sys.exit()
 
+    if args.stats or args.stats_json != None or args.stats_prometheus != None:
+        RPC.stats = RPCStats()
+
+    profile = start_profile(args.profile != None)
+    try:
+        ls(args)
+    finally:
+        stop_profile(profile, args.profile if args.profile else None)
+        if RPC.stats != None:
+            write_stats(RPC.stats, summary=args.stats, json_file=args.stats_json, prometheus_file=args.stats_prometheus)
+
+def ls(args):
     nfs_path = args.nfs_path
     timeout = args.timeout
 
@@ -46,61 +66,35 @@ def main():
     host = o.netloc
     uri = o.path
 
-    portmapper_port = 111
-    portmap = Portmap(host, portmapper_port, timeout)
-    portmap.connect()
-
-    # get mount service port
-    mount_port = portmap.getport(Mount.program, Mount.program_version)
-    mount = Mount(host, mount_port, timeout)
-    mount.connect()
-
-    # list mount points and grab the correct file handle
-    file_handle = None
-    for mountpoint in mount.export():
-        if uri.startswith(mountpoint["path"]):
-            mount_path = mountpoint["path"]
-            file_handle = mount.mnt(mountpoint["path"])["file_handle"]
-            file_type = 2
-
-    if file_handle == None:
-        mount.disconnect()
-        portmap.disconnect()
-        raise Exception("Mount point not found")
-
-    # get nfs port
-    nfs_port = portmap.getport(NFS.program, NFS.program_version)
-    nfs = NFS(host, nfs_port, timeout)
-    nfs.connect()
-
-    # iterate through folders
-    folders_str = uri[len(mount_path):]
-
-    for folder in folders_str.split("/"):
-        if len(folder) == 0:
-            continue
-
-        res = nfs.lookup(file_handle, folder, auth=auth)
-        if res["file_type"] == 2: # DIR
-            file_handle = res["file_handle"]
-            file_type = res["file_type"]
-        else:
-            raise Exception("Unexpected file type")
+    cache = LookupCache(args.lookup_cache, ttl=args.lookup_cache_ttl)
+
+    res = resolve_path(host, uri, timeout, auth=auth, cache=cache, portmapper_port=args.port)
 
     # We got the handle, list content
-    if file_type == 2: # DIR
-        for item in nfs.readdirplus(file_handle, auth=auth):
-            if item["file_type"] == 2: # DIR
-                print(item["name"] + "/")
-            else:
-                print(item["name"])
-    else:
+    if res["file_type"] != 2: # DIR
+        res["nfs"].disconnect()
         raise Exception("Unexpected file type")
 
+    try:
+        items = res["nfs"].readdirplus(res["file_handle"], auth=auth)
+    except NFSAccessError:
+        res["nfs"].disconnect()
+        if not res["cached"]:
+            raise
 
+        # stale file handle in the cache
+        cache.invalidate(host)
+        res = resolve_path(host, uri, timeout, auth=auth, cache=cache, portmapper_port=args.port)
+        items = res["nfs"].readdirplus(res["file_handle"], auth=auth)
 
+    res["nfs"].disconnect()
+    cache.save()
 
-
+    for item in items:
+        if item["file_type"] == 2: # DIR
+            print(item["name"] + "/")
+        else:
+            print(item["name"])
 
 if __name__ == '__main__':
     main()
@@ -1,45 +1,48 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -
 import sys
+import errno
+import resource
+import json
 import struct
 import time
 from ipaddress import IPv4Network
 from operator import itemgetter
-from os.path import join
+from os.path import join, dirname, abspath
 import argparse
-
-from lib.portmap import Portmap
-from lib.mount import Mount, MountAccessError
-from lib.nfs import NFS, NFSAccessError
+import asyncio
+from functools import partial
+from itertools import islice
+
+from lib.rpc import RPC, HostTimeouts
+from lib.stats import RPCStats, write_stats, start_profile, stop_profile
+from lib.ratelimit import ScanLimiter
+from lib.mount import MountAccessError
+from lib.sweep import tcp_sweep
+from lib.udp import portmap_null_sweep, portmap_dump_sweep
+from lib.walk import walk
+from lib.snapshot import TreeSnapshots, walk_changes
+from lib.session import HostSession
+from lib.state import ScanState
+from lib.shard import sharded
 from lib.utils import *
 
+rpc_names_csv = join(dirname(abspath(__file__)), 'rpc_names.csv')
+
 #
 # Author: Hegusung
 #
 
-def showmount(host, port, timeout):
-    portmap = Portmap(host, port, timeout)
-    portmap.connect()
-    port = portmap.getport(Mount.program, Mount.program_version)
-
-    mount = Mount(host, port, timeout)
-    mount.connect()
-    exports = mount.export()
-
-    mount.disconnect()
-    portmap.disconnect()
-
-    return exports
+async def showmount(session):
+    for export in await session.get_exports():
+        yield export
 
-def listnfs(host, port, timeout, recurse=1, uid=0, gid=0, auth_hostname='nfsclient'):
-    portmap = Portmap(host, port, timeout)
-    portmap.connect()
-
-    mount_port = portmap.getport(Mount.program, Mount.program_version)
-    mount = Mount(host, mount_port, timeout)
-    mount.connect()
-
-    exports = mount.export()
+async def listnfs(session, recurse=1, uid=0, gid=0, auth_hostname='nfsclient', fanout=16, nfs_connections=1, snapshots=None):
+    # async generator of (path, change, entry, error):
+    # - without snapshots, change is None and (path, entry, error) are the records of lib.walk
+    # - with snapshots, the changes since the previous snapshot of the export, see lib.snapshot
+    exports = await session.get_exports()
+    mount = await session.get_mount()
 
     auth = {
         "flavor": 1, #AUTH_UNIX
@@ -49,99 +52,262 @@ def listnfs(host, port, timeout, recurse=1, uid=0, gid=0, auth_hostname='nfsclie
         "aux_gid": [gid],
     }
 
-    nfs_port = portmap.getport(NFS.program, NFS.program_version)
-    nfs = NFS(host, nfs_port, timeout)
-    nfs.connect()
-
-    contents = []
+    nfs_clients = await session.get_nfs(max(nfs_connections, 1))
 
     for export in exports:
         try:
-            mount_info = mount.mnt(export["path"], auth=auth)
-
-            contents += listdir(nfs, auth, mount_info["file_handle"], "nfs://%s:%d%s" % (host, nfs_port, export["path"]), recurse=recurse)
-
+            mount_info = await mount.mnt(export["path"], auth=auth)
         except MountAccessError:
-            pass
-
-
-    portmap.disconnect()
-    mount.disconnect()
-    nfs.disconnect()
-
-    return contents
-
-def listdir(nfs, auth, file_handle, path, recurse=1):
-    if recurse == 0:
-        return [path + "/"]
-
-    items = nfs.readdirplus(file_handle, auth=auth)
-
-    if len(items) == 0:
-        return [path + "/"]
-
-    contents = []
-
-    for item in items:
-        if item["name"] in [".", ".."]:
             continue
 
-        if item["file_type"] == 2:
-            try:
-                contents += listdir(nfs, auth, item["file_handle"], join(path, item["name"]), recurse=recurse-1)
-            except NFSAccessError:
-                contents.append(join(path, item["name"]) + "/")
+        path = "nfs://%s:%d%s" % (session.host, nfs_clients[0].port, export["path"])
 
-        else:
-            contents.append(join(path, item["name"]))
+        if snapshots == None:
+            async for path, entry, error in walk(nfs_clients, auth, mount_info["file_handle"], path, recurse, fanout=fanout):
+                yield (path, None, entry, error)
+            continue
 
-    return contents
+        tree = {}
+        async for record in walk_changes(nfs_clients, auth, mount_info["file_handle"], path, recurse, snapshots.get(session.host, export["path"]), tree, fanout=fanout):
+            yield record
+        # the walk is complete, it is the reference of the next one
+        snapshots.set(session.host, export["path"], tree)
+
+async def process(host, port, timeout, actions, uid, gid, auth_hostname, recurse, fanout=16, nfs_connections=1, rtt=None, limiter=None, snapshots=None, dump=None):
+    # async generator of the records found on the host, as they are found
+    # the connections to the services of the host are shared by the actions
+    # rtt: (floor, ceiling) of the timeouts derived from the round trip times to the host, None to use timeout for everything
+    # limiter: ScanLimiter of the scan, None for no rate limit
+    # dump: DUMP entries received by the UDP sweep, the portmapper is then not connected to over TCP for them
+    timeouts = HostTimeouts(timeout, rtt[0], rtt[1]) if rtt != None else None
+    session = HostSession(host, port, timeout, timeouts=timeouts, limiter=limiter.host() if limiter != None else None, dump=dump)
+    alive = False
 
-def process(host, port, timeout, actions, uid, gid, auth_hostname, recurse):
     try:
-        portmap = Portmap(host, 111, timeout)
-        portmap.connect()
-        res = portmap.null()
-        portmap.disconnect()
+        if dump != None:
+            # the portmapper answered the DUMP
+            res = True
+        else:
+            portmap = await session.get_portmap()
+            res = await portmap.null()
 
-        rpc_names = parse_rpc_names('rpc_names.csv')
+        rpc_names = load_rpc_names(rpc_names_csv)
 
         if res:
-            print("rpc://%s:%d\tPortmapper" % (host, port))
+            alive = True
+            yield {"host": host, "port": port, "type": "portmapper"}
 
             if "list_rpc" in actions:
-                print("RPC services for %s:" % host)
-                portmap.connect()
-                for item in sorted(portmap.dump(),key=itemgetter('program')):
-                    name = str(item["program"])
-                    for rpc_service in rpc_names:
-                        if item["program"] in rpc_service["range"]:
-                            name = "%s (%d)" % (rpc_service["name"], item["program"])
-                            break
-                    print("%s %s %s %s" % (name.ljust(30), str(item["version"]).ljust(10), item["protocol"].ljust(10), str(item["port"]).ljust(10)))
-                portmap.disconnect()
+                yield {"host": host, "port": port, "type": "section", "title": "RPC services for %s:" % host}
+                for item in sorted(await session.dump(),key=itemgetter('program')):
+                    yield {
+                        "host": host,
+                        "port": port,
+                        "type": "rpc",
+                        "program": item["program"],
+                        "program_name": rpc_names.lookup(item["program"]),
+                        "version": item["version"],
+                        "protocol": item["protocol"],
+                        "service_port": item["port"],
+                    }
 
             if "list_mounts" in actions:
-                print("Exports for %s:" % host)
-                for item in showmount(host, port, timeout):
-                    print("%s %s" % (item["path"].ljust(20), ','.join(item["authorized"])))
+                yield {"host": host, "port": port, "type": "section", "title": "Exports for %s:" % host}
+                async for item in showmount(session):
+                    yield {"host": host, "port": port, "type": "export", "path": item["path"], "authorized": item["authorized"]}
 
             if "list_nfs" in actions:
-                for item in listnfs(host, port, timeout, recurse=recurse, uid=uid, gid=gid, auth_hostname=auth_hostname):
-                    print(item)
-
-    except OSError:
-        pass
+                async for path, change, entry, error in listnfs(session, recurse=recurse, uid=uid, gid=gid, auth_hostname=auth_hostname, fanout=fanout, nfs_connections=nfs_connections, snapshots=snapshots):
+                    record = {"host": host, "port": port, "type": "nfs", "path": path}
+                    if change != None:
+                        record["change"] = change
+                    if entry != None:
+                        record["file_type"] = entry["file_type"]
+                        record["file_size"] = entry["file_size"]
+                        record["mtime"] = entry["mtime"]
+                        record["file_id"] = entry["file_id"]
+                    if error != None:
+                        record["error"] = str(error)
+                    yield record
+
+    except OSError as e:
+        # the hosts which do not answer are skipped silently, but not the ones cut off once they answered (timeout, connection reset)
+        # nor the ones left because no file descriptor was free
+        if alive or e.errno in [errno.EMFILE, errno.ENFILE]:
+            print("%s:%d Exception %s:%s" % (host, port, type(e), e), file=sys.stderr)
     except Exception as e:
-        raise e
-        print("%s:%d Exception %s:%s" % (host, port, type(e), e))
+        # the other hosts are still scanned
+        print("%s:%d Exception %s:%s" % (host, port, type(e), e), file=sys.stderr)
+    finally:
+        await session.close()
+
+def format_record(record):
+    # text output line of a record
+    if record["type"] == "portmapper":
+        return "rpc://%s:%d\tPortmapper" % (record["host"], record["port"])
+    elif record["type"] == "section":
+        return record["title"]
+    elif record["type"] == "rpc":
+        name = str(record["program"])
+        if record["program_name"] != None:
+            name = "%s (%d)" % (record["program_name"], record["program"])
+        return "%s %s %s %s" % (name.ljust(30), str(record["version"]).ljust(10), record["protocol"].ljust(10), str(record["service_port"]).ljust(10))
+    elif record["type"] == "export":
+        return "%s %s" % (record["path"].ljust(20), ','.join(record["authorized"]))
+    elif record["type"] == "nfs":
+        if "change" in record:
+            return "%s %s" % (record["change"].ljust(10), record["path"])
+        return record["path"]
+
+def text_output(record):
+    print(format_record(record))
+
+def jsonl_output(output_file):
+    def output(record):
+        # section titles are only useful in the text output
+        if record["type"] == "section":
+            return
+        output_file.write(json.dumps(record) + "\n")
+        output_file.flush()
+
+    return output
+
+def iter_targets(ip_range, host_file, port):
+    if ip_range != None:
+        for ip in IPv4Network(ip_range):
+            yield (str(ip), port)
+
+    if host_file != None:
+        with open(host_file) as f:
+            for line in f:
+                host_port = line.split()[0]
+                if ":" in host_port:
+                    yield (host_port.split(":")[0], int(host_port.split(":")[1]))
+                else:
+                    yield (host_port, port)
+
+async def scan(targets, workers, timeout, actions, uid, gid, auth_hostname, recurse, fanout=16, nfs_connections=1, rtt=None, limits=None, output=text_output, state=None, snapshots=None, host_done=None):
+    # host_done(host, port) is called after the records of each host are output
+    # limits: ScanLimiter arguments, None for no rate limit
+    semaphore = asyncio.Semaphore(workers)
+    limiter = ScanLimiter(workers, **limits) if limits != None else None
+
+    async def worker(host, port, dump, records):
+        try:
+            async with (limiter.slot() if limiter != None else semaphore):
+                if state != None:
+                    state.start(host, port)
+                async for record in process(host, port, timeout, actions, uid, gid, auth_hostname, recurse, fanout=fanout, nfs_connections=nfs_connections, rtt=rtt, limiter=limiter, snapshots=snapshots, dump=dump):
+                    if state != None:
+                        state.add(host, port, record)
+                    # blocks while the records of the hosts before are output
+                    await records.put(record)
+                if state != None:
+                    state.finish(host, port)
+        except asyncio.CancelledError:
+            # interrupted, the printer is cancelled too
+            raise
+        except Exception:
+            await records.put(None)
+            raise
+        await records.put(None)
+
+    # bounded window of scheduled hosts, in target order
+    hosts = asyncio.Queue(workers*4)
+
+    async def printer():
+        # the records of the first host are output as they are found, the next hosts are buffered until their turn
+        while True:
+            item = await hosts.get()
+            if item == None:
+                break
+
+            task, records, host, port = item
+            while True:
+                record = await records.get()
+                if record == None:
+                    break
+                output(record)
+
+            await task
+            if host_done != None:
+                host_done(host, port)
+
+    printer_task = asyncio.ensure_future(printer())
+
+    async def schedule(item):
+        put = asyncio.ensure_future(hosts.put(item))
+        await asyncio.wait([put, printer_task], return_when=asyncio.FIRST_COMPLETED)
+        if printer_task.done():
+            put.cancel()
+            await printer_task
+
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            # fetching targets can block (liveness sweep, host file), do it outside of the event loop
+            batch = await loop.run_in_executor(None, lambda: list(islice(targets, 64)))
+            if len(batch) == 0:
+                break
+
+            for target in batch:
+                host, port = target[:2]
+                # DUMP entries of the UDP sweep
+                dump = target[2] if len(target) > 2 else None
+                # bounded, the hosts behind the first one do not buffer their whole listing
+                records = asyncio.Queue(256)
+                await schedule((asyncio.ensure_future(worker(host, port, dump, records)), records, host, port))
+
+        await schedule(None)
+        await printer_task
+    finally:
+        printer_task.cancel()
+        if state != None:
+            # interrupted: the hosts still being processed end with connection errors, they are not complete
+            state.stop()
+
+def fit_open_files(workers, nfs_connections, sweep_fds, processes):
+    # returns (workers, sweep_fds) scaled down so that the connections of the workers and of the sweep fit in the open files limit
+    # a host holds a portmap, a mount and nfs_connections NFS connections
+    # with --processes the sweep runs in this process and the workers in the others
+    available = open_files_limit()
+    if available == resource.RLIM_INFINITY:
+        return workers, sweep_fds
+    # stdio, output files, sqlite state, ...
+    available = max(available - 64, 2)
+    host_fds = 2 + nfs_connections
+
+    if processes == 1:
+        needed = workers*host_fds + sweep_fds
+        if needed <= available:
+            return workers, sweep_fds
+        scale = available / needed
+        fitted = (max(int(workers*scale), 1), max(int(sweep_fds*scale), 1) if sweep_fds != 0 else 0)
+    else:
+        if workers*host_fds <= available and sweep_fds <= available:
+            return workers, sweep_fds
+        fitted = (max(min(workers, available // host_fds), 1), min(sweep_fds, available))
+
+    print("Open files limit of %d: %d workers and %d sweep connections instead of %d and %d" % (available + 64, fitted[0], fitted[1], workers, sweep_fds), file=sys.stderr)
+    return fitted
+
+def scan_shard(scan_args, snapshots, targets, output, host_done):
+    # scan of the targets of a --processes worker process, returns the NFS trees it listed and its RPC statistics
+    asyncio.run(scan(targets, *scan_args, output=output, snapshots=snapshots, host_done=host_done))
+
+    trees = snapshots.updated() if snapshots != None else None
+    operations = RPC.stats.operations if RPC.stats != None else None
+    return trees, operations
 
 def main():
     parser = argparse.ArgumentParser(description='Tool to perform rpc recon on hosts', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument('ip_range', help='ip or ip range', nargs='?', default=None)
     parser.add_argument('-H', help='Host:port file', dest='host_file', default=None)
     parser.add_argument('-p', help='port', dest='port', default=111, type=int)
-    parser.add_argument('-t', help='timeout', nargs='?', default=15, type=int, dest='timeout')
+    parser.add_argument('-t', help='timeout, the timeouts of a host are then derived from its round trip times unless --fixed-timeout is set', nargs='?', default=15, type=int, dest='timeout')
+    parser.add_argument('--rtt-floor', help='minimum connect and read timeout derived from the round trip times (seconds)', nargs='?', default=2.0, type=float, dest='rtt_floor')
+    parser.add_argument('--rtt-ceiling', help='maximum connect and read timeout derived from the round trip times (seconds, -t by default)', nargs='?', default=None, type=float, dest='rtt_ceiling')
+    parser.add_argument('--fixed-timeout', help='use -t for every connect and read', action='store_false', dest='adaptive_timeout')
     parser.add_argument('--rpc', help='list rpc (portmapper)', action='store_true', dest='list_rpc')
     parser.add_argument('--mounts', help='list mounts', action='store_true', dest='list_mounts')
     parser.add_argument('--nfs', help='list nfs', action='store_true', dest='list_nfs')
@@ -149,6 +315,30 @@ def main():
     parser.add_argument('-g', help='gid', nargs='?', default=0, type=int, dest='gid')
     parser.add_argument('--hostname', help='authentication hostname', nargs='?', default="nfsclient", type=str, dest='hostname')
     parser.add_argument('--recurse', help='recurse levels', nargs='?', default=1, type=int, dest='recurse')
+    parser.add_argument('--fanout', help='number of directories listed concurrently on each host', nargs='?', default=16, type=int, dest='fanout')
+    parser.add_argument('--nfs-connections', help='number of NFS connections per host used to list directories', nargs='?', default=1, type=int, dest='nfs_connections')
+    parser.add_argument('--workers', help='number of hosts scanned concurrently', nargs='?', default=256, type=int, dest='workers')
+    parser.add_argument('--max-connection-rate', help='maximum number of connections per second', nargs='?', default=None, type=positive_float, dest='connection_rate')
+    parser.add_argument('--max-call-rate', help='maximum number of RPC calls per second', nargs='?', default=None, type=positive_float, dest='call_rate')
+    parser.add_argument('--max-bandwidth', help='maximum number of bytes sent and received per second', nargs='?', default=None, type=positive_float, dest='byte_rate')
+    parser.add_argument('--host-connection-rate', help='maximum number of connections per second to a host', nargs='?', default=None, type=positive_float, dest='host_connection_rate')
+    parser.add_argument('--host-call-rate', help='maximum number of RPC calls per second to a host', nargs='?', default=None, type=positive_float, dest='host_call_rate')
+    parser.add_argument('--host-bandwidth', help='maximum number of bytes sent to and received from a host per second', nargs='?', default=None, type=positive_float, dest='host_byte_rate')
+    parser.add_argument('--congestion-control', help='scale the rates and the number of hosts scanned at once down when timeouts and connection resets rise, and up again when they fall', action='store_true', dest='congestion_control')
+    parser.add_argument('--processes', help='number of processes the targets are scanned by, the workers are shared between them', nargs='?', default=1, type=int, dest='processes')
+    parser.add_argument('--no-sweep', help='do not check that the port is open with a non-blocking connect before processing hosts', action='store_false', dest='sweep')
+    parser.add_argument('--sweep-timeout', help='liveness sweep connect window (seconds), the timeout (-t) by default', nargs='?', default=None, type=float, dest='sweep_timeout')
+    parser.add_argument('--sweep-batch', help='maximum number of connects in flight of the liveness sweep (the UDP sweep sends its calls in batches of this size)', nargs='?', default=512, type=int, dest='sweep_batch')
+    parser.add_argument('--jsonl', help='output one JSON record per line to the given file (stdout if no file is given)', nargs='?', const='-', default=None, type=str, dest='jsonl')
+    parser.add_argument('--udp', help='perform the liveness sweep with batched portmap NULL calls over UDP, or DUMP calls with --rpc: the services are then listed from their replies', action='store_true', dest='udp')
+    parser.add_argument('--state', help='SQLite database the progress and the results of the scan are saved to', nargs='?', default=None, type=str, dest='state')
+    parser.add_argument('--resume', help='resume the last scan saved to the --state database, skipping the hosts it completed', action='store_true', dest='resume')
+    parser.add_argument('--incremental', help='only probe again the hosts of the --state database which were alive, or whose results are older than the given number of hours', nargs='?', const=24.0, default=None, type=float, dest='incremental')
+    parser.add_argument('--snapshot', help='file keeping a snapshot of the NFS trees listed: the next scans only list the directories changed, and output the entries added, removed or modified', nargs='?', default=None, type=str, dest='snapshot')
+    parser.add_argument('--stats', help='print the count, latency, bytes, timeouts and errors of the connects and RPC calls per program and procedure at exit', action='store_true', dest='stats')
+    parser.add_argument('--stats-json', help='write the RPC statistics to the given file as JSON', nargs='?', default=None, type=str, dest='stats_json')
+    parser.add_argument('--stats-prometheus', help='write the RPC statistics to the given file in the Prometheus text format', nargs='?', default=None, type=str, dest='stats_prometheus')
+    parser.add_argument('--profile', help='profile the scan with cProfile, the hottest functions are printed at exit or the profile is saved to the given file (the --processes workers are not profiled)', nargs='?', const='', default=None, type=str, dest='profile')
 
 
     args = parser.parse_args()
@@ -157,6 +347,9 @@ def main():
         parser.print_help()
         sys.exit()
 
+    if args.state == None and (args.resume or args.incremental != None):
+        parser.error("--resume and --incremental require --state")
+
     port = args.port
 
     timeout = args.timeout
@@ -168,20 +361,113 @@ def main():
     if args.list_nfs:
         actions.append("list_nfs")
 
-    if args.ip_range != None:
-        for ip in IPv4Network(args.ip_range):
-            process(str(ip), port, timeout, actions, args.uid, args.gid, args.hostname, args.recurse)
-
-    if args.host_file != None:
-        with open(args.host_file) as f:
-            for line in f:
-                host_port = line.split()[0]
-                if ":" in host_port:
-                    process(host_port.split(":")[0], int(host_port.split(":")[1]), timeout, actions, args.uid, args.gid, args.hostname, args.recurse)
-                else:
-                    process(host_port, port, timeout, actions, args.uid, args.gid, args.hostname, args.recurse)
-
-
+    # build or load the program name index before the scan starts
+    load_rpc_names(rpc_names_csv)
+
+    state = None
+    if args.state != None:
+        state = ScanState(args.state, actions, resume=args.resume, max_age=args.incremental*3600 if args.incremental != None else None)
+
+    snapshots = None
+    if args.snapshot != None:
+        snapshots = TreeSnapshots(args.snapshot)
+
+    processes = max(args.processes, 1)
+
+    # the limits of the whole scan are shared between the processes
+    scan_rates = [rate / processes if rate != None else None for rate in [args.connection_rate, args.call_rate, args.byte_rate]]
+    host_rates = [args.host_connection_rate, args.host_call_rate, args.host_byte_rate]
+
+    limits = None
+    if args.congestion_control or any(rate != None for rate in scan_rates + host_rates):
+        limits = {
+            "connection_rate": scan_rates[0],
+            "call_rate": scan_rates[1],
+            "byte_rate": scan_rates[2],
+            "host_connection_rate": host_rates[0],
+            "host_call_rate": host_rates[1],
+            "host_byte_rate": host_rates[2],
+            "congestion_control": args.congestion_control,
+        }
+
+    targets = iter_targets(args.ip_range, args.host_file, port)
+    if state != None:
+        targets = state.select(targets)
+
+    # the UDP sweep uses a single socket
+    sweep_fds = max(args.sweep_batch, 1) if args.sweep and not args.udp else 0
+    workers, sweep_fds = fit_open_files(max(args.workers // processes, 1), max(args.nfs_connections, 1), sweep_fds, processes)
+
+    # hosts slower than the window are dropped without being reported, wait as long as the scan would by default
+    sweep_timeout = args.sweep_timeout if args.sweep_timeout != None else timeout
+
+    sweep = None
+    if args.udp and args.list_rpc:
+        # the services are listed from the DUMP replies, without a TCP connection to the portmapper
+        sweep = lambda targets: portmap_dump_sweep(targets, timeout=sweep_timeout, batch_size=max(args.sweep_batch, 1), rate=args.call_rate)
+    elif args.udp:
+        sweep = lambda targets: portmap_null_sweep(targets, timeout=sweep_timeout, batch_size=max(args.sweep_batch, 1), rate=args.call_rate)
+    elif args.sweep:
+        sweep = lambda targets: tcp_sweep(targets, sweep_timeout, batch_size=sweep_fds, rate=args.connection_rate)
+
+    if sweep != None:
+        # the targets dropped by the sweep are saved as dead
+        targets = state.sweep(targets, sweep) if state != None else sweep(targets)
+
+    output_file = None
+    if args.jsonl == None:
+        output = text_output
+    elif args.jsonl == '-':
+        output = jsonl_output(sys.stdout)
+    else:
+        output_file = open(args.jsonl, 'w')
+        output = jsonl_output(output_file)
+
+    rtt = None
+    if args.adaptive_timeout:
+        rtt = (args.rtt_floor, args.rtt_ceiling if args.rtt_ceiling != None else timeout)
+
+    scan_args = (workers, timeout, actions, args.uid, args.gid, args.hostname, args.recurse, max(args.fanout, 1), max(args.nfs_connections, 1), rtt, limits)
+
+    if args.stats or args.stats_json != None or args.stats_prometheus != None:
+        RPC.stats = RPCStats()
+
+    profile = start_profile(args.profile != None)
+    try:
+        if processes == 1:
+            asyncio.run(scan(targets, *scan_args, output=output, state=state, snapshots=snapshots))
+        else:
+            # the scan state is saved by this process, from the merged records
+            host_records = []
+
+            def shard_output(record):
+                if state != None:
+                    host_records.append(record)
+                output(record)
+
+            def shard_host_done(host, port):
+                if state != None:
+                    state.start(host, port)
+                    for record in host_records:
+                        state.add(host, port, record)
+                    state.finish(host, port)
+                    host_records.clear()
+
+            for trees, operations in sharded(targets, processes, partial(scan_shard, scan_args, snapshots), shard_output, host_done=shard_host_done, window=processes*workers*4):
+                if snapshots != None:
+                    snapshots.merge(trees)
+                if RPC.stats != None:
+                    RPC.stats.merge(operations)
+    finally:
+        stop_profile(profile, args.profile if args.profile else None)
+        if snapshots != None:
+            snapshots.save()
+        if output_file != None:
+            output_file.close()
+        if state != None:
+            state.close()
+        if RPC.stats != None:
+            write_stats(RPC.stats, summary=args.stats, json_file=args.stats_json, prometheus_file=args.stats_prometheus)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,9 @@
+import sys
+from os.path import dirname, abspath
+
+#
+# Author: Hegusung
+#
+
+# the tests import lib from the root of the repository, as the scripts do
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
@@ -0,0 +1,228 @@
+import os
+import hashlib
+
+import pytest
+
+from lib.download import split_ranges, Checkpoint, download, is_mirrored
+
+#
+# Author: Hegusung
+#
+
+def covered(ranges, file_size):
+    # the ranges follow each other up to the end of file
+    offset = 0
+    for start, count in ranges:
+        assert start == offset
+        offset = start + count if count != None else file_size
+
+    return offset
+
+def test_split_ranges():
+    ranges = split_ranges([(0, None)], 100, 4, 10)
+
+    assert ranges == [(0, 30), (30, 30), (60, 30), (90, None)]
+    assert covered(ranges, 100) == 100
+
+def test_split_ranges_aligned_on_chunks():
+    ranges = split_ranges([(0, None)], 1000, 3, 64)
+
+    for offset, count in ranges:
+        assert offset % 64 == 0
+    assert len(ranges) == 3
+    assert covered(ranges, 1000) == 1000
+
+def test_split_ranges_small_file():
+    # never less than a chunk per range
+    assert split_ranges([(0, None)], 5, 4, 10) == [(0, None)]
+
+def test_split_ranges_one_connection():
+    assert split_ranges([(0, None)], 100, 1, 10) == [(0, None)]
+    assert split_ranges([(0, None)], 100, 0, 10) == [(0, None)]
+
+def test_split_ranges_unknown_size():
+    assert split_ranges([(0, None)], None, 4, 10) == [(0, None)]
+
+def test_split_ranges_missing_pieces():
+    # 20 bytes missing in the middle, 50 at the end
+    ranges = split_ranges([(10, 20), (50, None)], 100, 2, 10)
+
+    assert ranges == [(10, 20), (50, 40), (90, None)]
+
+def test_split_ranges_past_end_of_file():
+    # the file shrunk below the checkpoint
+    assert split_ranges([(200, None)], 100, 4, 10) == [(200, None)]
+
+def test_checkpoint_add_merges_ranges():
+    checkpoint = Checkpoint(None, b"handle", 100, 1)
+    checkpoint.add(20, 30, None)
+    checkpoint.add(0, 10, None)
+    checkpoint.add(50, 60, None)
+    checkpoint.add(10, 20, None)
+
+    assert checkpoint.ranges == [(0, 30), (50, 60)]
+    assert checkpoint.contiguous_end() == 30
+
+    checkpoint.add(25, 55, None)
+    assert checkpoint.ranges == [(0, 60)]
+
+def test_checkpoint_missing():
+    checkpoint = Checkpoint(None, b"handle", 100, 1)
+    assert checkpoint.missing() == [(0, None)]
+    assert checkpoint.contiguous_end() == 0
+
+    checkpoint.add(10, 20, None)
+    checkpoint.add(40, 50, None)
+    assert checkpoint.missing() == [(0, 10), (20, 20), (50, None)]
+    assert checkpoint.contiguous_end() == 0
+
+    checkpoint.add(0, 10, None)
+    checkpoint.add(50, 100, None)
+    assert checkpoint.missing() == [(20, 20)]
+
+def test_checkpoint_missing_complete():
+    # the end of file is read again, the file may have grown
+    checkpoint = Checkpoint(None, b"handle", 100, 1)
+    checkpoint.add(0, 100, None)
+
+    assert checkpoint.missing() == [(100, None)]
+
+def test_checkpoint_save_load(tmp_path):
+    path = str(tmp_path / "file.checkpoint")
+    fd = os.open(str(tmp_path / "file"), os.O_RDWR | os.O_CREAT)
+    try:
+        checkpoint = Checkpoint(path, b"handle", 100, 1)
+        checkpoint.add(0, 10, fd)
+        checkpoint.add(50, 60, fd)
+        checkpoint.save(fd)
+    finally:
+        os.close(fd)
+
+    loaded = Checkpoint(path, b"handle", 100, 1)
+    assert loaded.load()
+    assert loaded.ranges == [(0, 10), (50, 60)]
+
+    loaded.remove()
+    assert not os.path.exists(path)
+    loaded.remove()
+
+def test_checkpoint_load_mismatch(tmp_path):
+    path = str(tmp_path / "file.checkpoint")
+    fd = os.open(str(tmp_path / "file"), os.O_RDWR | os.O_CREAT)
+    try:
+        Checkpoint(path, b"handle", 100, 1).save(fd)
+    finally:
+        os.close(fd)
+
+    # another file, a file of another size or a modified file
+    assert not Checkpoint(path, b"other", 100, 1).load()
+    assert not Checkpoint(path, b"handle", 200, 1).load()
+    assert not Checkpoint(path, b"handle", 100, 2).load()
+    assert not Checkpoint(path, b"handle", None, 1).load()
+    assert not Checkpoint(None, b"handle", 100, 1).load()
+    assert not Checkpoint(str(tmp_path / "none"), b"handle", 100, 1).load()
+
+    with open(path, 'w') as f:
+        f.write("{")
+    assert not Checkpoint(path, b"handle", 100, 1).load()
+
+class FakeNFS(object):
+    # serves a file from memory, fails after fail_after chunks
+
+    def __init__(self, data, fail_after=None):
+        self.host = "127.0.0.1"
+        self.port = 2049
+        self.timeout = 1
+        self.data = data
+        self.fail_after = fail_after
+        self.reads = []
+
+    def read_chunks(self, file_handle, auth=None, offset=0, chunk_count=1024*1024, window=8, count=None):
+        end = len(self.data) if count == None else min(offset + count, len(self.data))
+        self.reads.append((offset, count))
+
+        while offset < end:
+            if self.fail_after != None:
+                if self.fail_after == 0:
+                    raise OSError("connection reset")
+                self.fail_after -= 1
+
+            chunk = self.data[offset:min(offset + chunk_count, end)]
+            yield offset, chunk
+            offset += len(chunk)
+
+def test_download(tmp_path):
+    data = os.urandom(1000)
+    file_name = str(tmp_path / "file")
+
+    result = download(FakeNFS(data), b"handle", len(data), file_name, connections=1, chunk_count=64, sha256=True)
+
+    assert result == {"file_size": 1000, "sha256": hashlib.sha256(data).hexdigest(), "resumed": False}
+    with open(file_name, 'rb') as f:
+        assert f.read() == data
+
+def test_download_resume(tmp_path):
+    data = os.urandom(1000)
+    file_name = str(tmp_path / "file")
+    checkpoint_file = file_name + ".checkpoint"
+
+    with pytest.raises(OSError):
+        download(FakeNFS(data, fail_after=5), b"handle", len(data), file_name, connections=1, chunk_count=64, mtime=1, checkpoint_file=checkpoint_file)
+
+    # the checkpoint is saved when the download fails
+    checkpoint = Checkpoint(checkpoint_file, b"handle", len(data), 1)
+    assert checkpoint.load()
+    assert checkpoint.ranges == [(0, 5*64)]
+
+    nfs = FakeNFS(data)
+    result = download(nfs, b"handle", len(data), file_name, connections=1, chunk_count=64, mtime=1, checkpoint_file=checkpoint_file, sha256=True)
+
+    # only the end of the file is read again, the hash covers the whole file
+    assert nfs.reads == [(5*64, None)]
+    assert result == {"file_size": 1000, "sha256": hashlib.sha256(data).hexdigest(), "resumed": True}
+    assert not os.path.exists(checkpoint_file)
+    with open(file_name, 'rb') as f:
+        assert f.read() == data
+
+def test_download_no_resume_of_a_modified_file(tmp_path):
+    data = os.urandom(1000)
+    file_name = str(tmp_path / "file")
+    checkpoint_file = file_name + ".checkpoint"
+
+    with pytest.raises(OSError):
+        download(FakeNFS(data, fail_after=5), b"handle", len(data), file_name, connections=1, chunk_count=64, mtime=1, checkpoint_file=checkpoint_file)
+
+    data = os.urandom(1000)
+    nfs = FakeNFS(data)
+    result = download(nfs, b"handle", len(data), file_name, connections=1, chunk_count=64, mtime=2, checkpoint_file=checkpoint_file)
+
+    assert nfs.reads == [(0, None)]
+    assert not result["resumed"]
+    with open(file_name, 'rb') as f:
+        assert f.read() == data
+
+def test_download_shrunk_file(tmp_path):
+    # the file is smaller than its size when the download started
+    data = os.urandom(700)
+    file_name = str(tmp_path / "file")
+
+    result = download(FakeNFS(data), b"handle", 1000, file_name, connections=1, chunk_count=64)
+
+    assert result["file_size"] == 700
+    with open(file_name, 'rb') as f:
+        assert f.read() == data
+
+def test_is_mirrored(tmp_path):
+    path = str(tmp_path / "file")
+    with open(path, 'wb') as f:
+        f.write(b"x"*10)
+    os.utime(path, (1000, 1000))
+
+    assert is_mirrored(path, {"file_size": 10, "mtime": 1000})
+    # modified or resized on the server
+    assert not is_mirrored(path, {"file_size": 10, "mtime": 1001})
+    assert not is_mirrored(path, {"file_size": 11, "mtime": 1000})
+    # no attributes in the READDIRPLUS reply
+    assert not is_mirrored(path, {"file_size": None, "mtime": 1000})
+    assert not is_mirrored(path, {"file_size": 10, "mtime": None})
+    assert not is_mirrored(str(tmp_path / "none"), {"file_size": 10, "mtime": 1000})
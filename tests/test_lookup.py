@@ -0,0 +1,109 @@
+import json
+
+from lib.lookup import LookupCache, cached_path
+
+#
+# Author: Hegusung
+#
+
+def value(file_handle, file_type=2):
+    return {
+        "nfs_port": 2049,
+        "file_handle": file_handle,
+        "file_type": file_type,
+        "file_size": None,
+        "mtime": None,
+    }
+
+def test_get_set():
+    cache = LookupCache()
+    cache.set(("host", "/srv", ""), value(b"root"))
+
+    assert cache.get(("host", "/srv", ""))["file_handle"] == b"root"
+    assert cache.get(("host", "/srv", "etc")) == None
+
+def test_expired():
+    cache = LookupCache(ttl=-1)
+    cache.set(("host", "/srv", ""), value(b"root"))
+
+    assert cache.get(("host", "/srv", "")) == None
+    assert len(cache.entries) == 0
+
+def test_least_recently_used_evicted():
+    cache = LookupCache(size=2)
+    cache.set(("host", "/srv", "a"), value(b"a"))
+    cache.set(("host", "/srv", "b"), value(b"b"))
+    cache.get(("host", "/srv", "a"))
+    cache.set(("host", "/srv", "c"), value(b"c"))
+
+    assert cache.get(("host", "/srv", "b")) == None
+    assert cache.get(("host", "/srv", "a")) != None
+    assert cache.get(("host", "/srv", "c")) != None
+
+def test_invalidate():
+    cache = LookupCache()
+    cache.set(("host", "/srv", ""), value(b"srv"))
+    cache.set(("host", "/home", ""), value(b"home"))
+    cache.set(("other", "/srv", ""), value(b"other"))
+
+    cache.invalidate("host", "/srv")
+    assert cache.get(("host", "/srv", "")) == None
+    assert cache.get(("host", "/home", "")) != None
+
+    cache.invalidate("host")
+    assert cache.get(("host", "/home", "")) == None
+    assert cache.get(("other", "/srv", "")) != None
+
+def test_save_load(tmp_path):
+    path = str(tmp_path / "cache.json")
+    cache = LookupCache(path)
+    cache.set(("host", "/srv", ""), value(b"\x00root"))
+    cache.set(("host", "/srv", "etc/passwd"), value(b"\xffpasswd", file_type=1))
+    cache.save()
+
+    loaded = LookupCache(path)
+    assert loaded.get(("host", "/srv", "")) == value(b"\x00root")
+    assert loaded.get(("host", "/srv", "etc/passwd")) == value(b"\xffpasswd", file_type=1)
+
+def test_load_drops_expired_and_extra_entries(tmp_path):
+    path = str(tmp_path / "cache.json")
+    cache = LookupCache(path)
+    cache.set(("host", "/srv", "a"), value(b"a"))
+    cache.set(("host", "/srv", "b"), value(b"b"))
+    cache.set(("host", "/srv", "c"), value(b"c"))
+    cache.entries[("host", "/srv", "a")] = (0, value(b"a"))
+    cache.save()
+
+    loaded = LookupCache(path, size=1)
+    assert list(loaded.entries) == [("host", "/srv", "c")]
+
+def test_load_unreadable(tmp_path):
+    path = tmp_path / "cache.json"
+
+    assert len(LookupCache(str(path)).entries) == 0
+
+    path.write_text("[")
+    assert len(LookupCache(str(path)).entries) == 0
+
+    path.write_text(json.dumps([["host", "/srv", "", 2**40, {"file_handle": "zz"}]]))
+    assert len(LookupCache(str(path)).entries) == 0
+
+def test_save_without_path():
+    cache = LookupCache()
+    cache.set(("host", "/srv", ""), value(b"root"))
+    cache.save()
+
+def test_cached_path():
+    cache = LookupCache()
+    cache.set(("host", "/srv/data", ""), value(b"export"))
+    cache.set(("host", "/srv/data", "a"), value(b"a"))
+
+    # the deepest cached directory of the longest export
+    export, path, path_length, cached = cached_path(cache, "host", "/srv/data/a/b/c")
+    assert (export, path, path_length, cached["file_handle"]) == ("/srv/data", ["a", "b", "c"], 1, b"a")
+
+    export, path, path_length, cached = cached_path(cache, "host", "/srv/data")
+    assert (export, path, path_length, cached["file_handle"]) == ("/srv/data", [], 0, b"export")
+
+    assert cached_path(cache, "host", "/home/a") == None
+    assert cached_path(cache, "other", "/srv/data/a") == None
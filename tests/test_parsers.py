@@ -0,0 +1,220 @@
+import struct
+
+import pytest
+
+from lib.xdr import Packer
+from lib.nfs import parse_lookup, parse_read, parse_readdirplus, parse_fsinfo, NFSAccessError, fattr3
+from lib.mount import parse_mnt, parse_export, MountAccessError
+from lib.portmap import parse_dump, parse_getport
+
+#
+# Author: Hegusung
+#
+
+def pack_attributes(packer, file_type=1, file_size=0, file_id=1, mtime=0):
+    packer.pack_uint(1)
+    packer.pack_struct(fattr3, file_type, 0o644, 1, 0, 0, file_size, file_size, 0, 0, 1, file_id, 0, 0, mtime, 0, 0, 0)
+
+def reply(packer):
+    return bytes(packer.get_view())
+
+def readdirplus_reply(entries, eof=True, handles=True):
+    packer = Packer()
+    packer.pack_uint(0)
+    pack_attributes(packer, file_type=2)
+    packer.pack_uhyper(42)
+    for cookie, (name, file_type) in enumerate(entries, 1):
+        packer.pack_uint(1)
+        packer.pack_uhyper(100 + cookie)
+        packer.pack_string(name)
+        packer.pack_uhyper(cookie)
+        pack_attributes(packer, file_type=file_type, file_size=cookie, file_id=100 + cookie)
+        if handles:
+            packer.pack_uint(1)
+            packer.pack_opaque(b"handle-" + name.encode())
+        else:
+            packer.pack_uint(0)
+    packer.pack_uint(0)
+    packer.pack_uint(1 if eof else 0)
+
+    return reply(packer)
+
+def test_readdirplus():
+    result = parse_readdirplus(readdirplus_reply([(".", 2), ("etc", 2), ("passwd", 1)]))
+
+    assert result["eof"]
+    assert result["cookie_verifier"] == 42
+    assert result["last_cookie"] == 3
+    assert [(entry["name"], entry["file_type"]) for entry in result["contents"]] == [(".", 2), ("etc", 2), ("passwd", 1)]
+    assert result["contents"][2]["file_handle"] == b"handle-passwd"
+    assert result["contents"][2]["file_size"] == 3
+    assert result["contents"][2]["file_id"] == 103
+
+def test_readdirplus_without_handles():
+    result = parse_readdirplus(readdirplus_reply([("a", 1)], eof=False, handles=False))
+
+    assert not result["eof"]
+    assert result["contents"][0]["file_handle"] == None
+
+def test_readdirplus_memoryview():
+    data = readdirplus_reply([("a", 1)])
+
+    assert parse_readdirplus(memoryview(data)) == parse_readdirplus(data)
+
+def test_readdirplus_error():
+    with pytest.raises(NFSAccessError):
+        parse_readdirplus(struct.pack('!L', 13))
+
+def test_readdirplus_truncated():
+    data = readdirplus_reply([("etc", 2), ("passwd", 1)])
+
+    for size in [0, 10, len(data)//2, len(data)-4]:
+        with pytest.raises(struct.error):
+            parse_readdirplus(data[:size])
+
+def test_lookup():
+    packer = Packer()
+    packer.pack_uint(0)
+    packer.pack_opaque(b"handle")
+    pack_attributes(packer, file_type=1, file_size=1234, mtime=99)
+
+    assert parse_lookup(reply(packer)) == {
+        "file_handle": b"handle",
+        "file_type": 1,
+        "file_size": 1234,
+        "mtime": 99,
+    }
+
+def test_lookup_without_attributes():
+    packer = Packer()
+    packer.pack_uint(0)
+    packer.pack_opaque(b"handle")
+    packer.pack_uint(0)
+
+    result = parse_lookup(reply(packer))
+    assert result["file_handle"] == b"handle"
+    assert result["file_type"] == None
+
+def test_lookup_error():
+    # NFS3ERR_NOENT
+    with pytest.raises(NFSAccessError):
+        parse_lookup(struct.pack('!L', 2))
+
+def test_read():
+    data = b"abcde"
+    packer = Packer()
+    packer.pack_uint(0)
+    pack_attributes(packer, file_size=5)
+    packer.pack_uint(len(data))
+    packer.pack_uint(1)
+    packer.pack_opaque(data)
+
+    result = parse_read(reply(packer))
+    assert bytes(result["data"]) == data
+    assert result["eof"]
+    assert result["file_size"] == 5
+
+def test_read_count_mismatch():
+    packer = Packer()
+    packer.pack_uint(0)
+    packer.pack_uint(0)
+    packer.pack_uint(10)
+    packer.pack_uint(0)
+    packer.pack_opaque(b"abc")
+
+    with pytest.raises(Exception):
+        parse_read(reply(packer))
+
+def test_read_truncated_data():
+    packer = Packer()
+    packer.pack_uint(0)
+    packer.pack_uint(0)
+    packer.pack_uint(8)
+    packer.pack_uint(0)
+    packer.pack_opaque(b"abcdefgh")
+
+    with pytest.raises(struct.error):
+        parse_read(reply(packer)[:-4])
+
+def test_fsinfo():
+    packer = Packer()
+    packer.pack_uint(0)
+    packer.pack_uint(0)
+    packer.pack_struct(struct.Struct('!LLLLLLLQLLL'), 1048576, 65536, 4096, 1048576, 65536, 4096, 8192, 2**63, 0, 1, 0x1b)
+
+    result = parse_fsinfo(reply(packer))
+    assert result["rtmax"] == 1048576
+    assert result["rtpref"] == 65536
+    assert result["dtpref"] == 8192
+
+def test_mnt():
+    packer = Packer()
+    packer.pack_uint(0)
+    packer.pack_opaque(b"root")
+    packer.pack_uint(2)
+    packer.pack_uint(1)
+    packer.pack_uint(390003)
+
+    assert parse_mnt(reply(packer)) == {"file_handle": b"root", "flavors": [1, 390003]}
+
+def test_mnt_error():
+    # MNT3ERR_ACCES
+    with pytest.raises(MountAccessError):
+        parse_mnt(struct.pack('!L', 13))
+
+def test_export():
+    packer = Packer()
+    for path, authorized in [("/srv", ["*"]), ("/home", ["10.0.0.0/8", "host"])]:
+        packer.pack_uint(1)
+        packer.pack_string(path)
+        for ip in authorized:
+            packer.pack_uint(1)
+            packer.pack_string(ip)
+        packer.pack_uint(0)
+    packer.pack_uint(0)
+
+    assert parse_export(reply(packer)) == [
+        {"path": "/srv", "authorized": ["*"]},
+        {"path": "/home", "authorized": ["10.0.0.0/8", "host"]},
+    ]
+
+def test_export_empty():
+    assert parse_export(b"") == []
+    assert parse_export(struct.pack('!L', 0)) == []
+
+def test_export_truncated():
+    packer = Packer()
+    packer.pack_uint(1)
+    packer.pack_string("/srv")
+
+    with pytest.raises(struct.error):
+        parse_export(reply(packer))
+
+def test_dump():
+    packer = Packer()
+    for entry in [(100000, 2, 6, 111), (100003, 3, 6, 2049), (100003, 3, 17, 2049), (100003, 3, 6, 2049), (100005, 3, 99, 20048)]:
+        packer.pack_uint(1)
+        packer.pack_struct(struct.Struct('!LLLL'), *entry)
+    packer.pack_uint(0)
+
+    # duplicated entries are dropped
+    assert parse_dump(reply(packer)) == [
+        {"program": 100000, "version": 2, "protocol": "tcp", "port": 111},
+        {"program": 100003, "version": 3, "protocol": "tcp", "port": 2049},
+        {"program": 100003, "version": 3, "protocol": "udp", "port": 2049},
+        {"program": 100005, "version": 3, "protocol": "unknown", "port": 20048},
+    ]
+
+def test_dump_empty():
+    assert parse_dump(b"") == []
+    assert parse_dump(struct.pack('!L', 0)) == []
+
+def test_dump_truncated():
+    with pytest.raises(struct.error):
+        parse_dump(struct.pack('!LLL', 1, 100000, 2))
+
+def test_getport():
+    assert parse_getport(struct.pack('!L', 2049)) == 2049
+
+    with pytest.raises(struct.error):
+        parse_getport(b"")
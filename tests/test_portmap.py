@@ -0,0 +1,57 @@
+from lib.portmap import ServicePorts, resolve_port
+
+#
+# Author: Hegusung
+#
+
+entries = [
+    {"program": 100000, "version": 2, "protocol": "tcp", "port": 111},
+    {"program": 100003, "version": 3, "protocol": "tcp", "port": 2049},
+    {"program": 100003, "version": 4, "protocol": "tcp", "port": 2050},
+    {"program": 100005, "version": 3, "protocol": "udp", "port": 20048},
+    {"program": 100005, "version": 3, "protocol": "tcp", "port": 20049},
+]
+
+class FakePortmap(object):
+    # GETPORT answers, counts the calls
+
+    def __init__(self, ports):
+        self.ports = ports
+        self.calls = 0
+
+    def getport(self, program, program_version, protocol=6):
+        self.calls += 1
+        return self.ports.get((program, program_version, protocol), 0)
+
+def test_getport():
+    service_ports = ServicePorts(entries)
+
+    assert service_ports.getport(100003, 3) == 2049
+    assert service_ports.getport(100003, 4) == 2050
+    assert service_ports.getport(100005, 3) == 20049
+    assert service_ports.getport(100005, 3, protocol=17) == 20048
+
+def test_getport_not_registered():
+    # 0, like GETPORT
+    service_ports = ServicePorts(entries)
+
+    assert service_ports.getport(100003, 2) == 0
+    assert service_ports.getport(100000, 2, protocol=17) == 0
+    assert service_ports.getport(100021, 1) == 0
+    assert service_ports.getport(100003, 3, protocol=99) == 0
+    assert ServicePorts([]).getport(100003, 3) == 0
+
+def test_resolve_port_from_dump():
+    portmap = FakePortmap({})
+
+    assert resolve_port(portmap, ServicePorts(entries), 100003, 3) == 2049
+    assert portmap.calls == 0
+
+def test_resolve_port_falls_back_to_getport():
+    portmap = FakePortmap({(100021, 4, 6): 4045, (100003, 3, 6): 2049})
+
+    # not in the DUMP
+    assert resolve_port(portmap, ServicePorts(entries), 100021, 4) == 4045
+    # DUMP refused
+    assert resolve_port(portmap, None, 100003, 3) == 2049
+    assert portmap.calls == 2
@@ -0,0 +1,93 @@
+import pytest
+
+from lib.rpc import RTTEstimator, HostTimeouts
+from lib.aio import AsyncRPC
+
+#
+# Author: Hegusung
+#
+
+def test_initial_timeout():
+    assert RTTEstimator(2.0, 0.1, 5.0).timeout() == 2.0
+
+def test_first_sample():
+    estimator = RTTEstimator(2.0, 0.1, 5.0)
+    estimator.sample(0.2)
+
+    # srtt + 4*rttvar, rttvar is half the first sample
+    assert estimator.timeout() == pytest.approx(0.2 + 4*0.1)
+
+def test_smoothing():
+    estimator = RTTEstimator(2.0, 0.01, 5.0)
+    estimator.sample(0.2)
+    estimator.sample(0.4)
+
+    assert estimator.rttvar == pytest.approx(0.75*0.1 + 0.25*0.2)
+    assert estimator.srtt == pytest.approx(0.875*0.2 + 0.125*0.4)
+
+    # steady round trip times bring the timeout close to them
+    for _ in range(100):
+        estimator.sample(0.05)
+    assert estimator.timeout() == pytest.approx(0.05, abs=0.001)
+
+def test_floor_and_ceiling():
+    estimator = RTTEstimator(2.0, 0.5, 1.0)
+    estimator.sample(0.001)
+    assert estimator.timeout() == 0.5
+
+    estimator.sample(10)
+    assert estimator.timeout() == 1.0
+
+def test_backoff():
+    estimator = RTTEstimator(2.0, 0.1, 100.0)
+    estimator.sample(0.2)
+    timeout = estimator.timeout()
+
+    estimator.timed_out()
+    assert estimator.timeout() == pytest.approx(timeout*2)
+    estimator.timed_out()
+    assert estimator.timeout() == pytest.approx(timeout*4)
+
+    # a sample resets the backoff
+    estimator.sample(0.2)
+    assert estimator.backoff == 1
+
+def test_backoff_limits():
+    estimator = RTTEstimator(2.0, 0.1, 5.0)
+    estimator.sample(0.2)
+
+    for _ in range(20):
+        estimator.timed_out()
+    assert estimator.backoff == 64
+    assert estimator.timeout() == 5.0
+
+def test_backoff_before_the_first_sample():
+    # the initial timeout is kept until a reply is measured
+    estimator = RTTEstimator(2.0, 0.1, 5.0)
+    estimator.timed_out()
+
+    assert estimator.timeout() == 2.0
+
+def test_read_timeout_grows_with_the_calls_in_flight():
+    rpc = AsyncRPC("127.0.0.1", 111, 2.0)
+    rpc.timeouts = HostTimeouts(2.0, 0.1, 5.0)
+    rpc.timeouts.read.sample(0.2)
+    timeout = rpc.timeouts.read.timeout()
+
+    rpc.pending = {1: None}
+    assert rpc.read_timeout() == pytest.approx(timeout)
+
+    rpc.pending = {xid: None for xid in range(3)}
+    assert rpc.read_timeout() == pytest.approx(timeout*3)
+
+    # up to the ceiling
+    rpc.pending = {xid: None for xid in range(100)}
+    assert rpc.read_timeout() == 5.0
+
+def test_read_timeout_not_below_the_initial_timeout():
+    # the initial timeout may be above the ceiling
+    rpc = AsyncRPC("127.0.0.1", 111, 2.0)
+    rpc.timeouts = HostTimeouts(2.0, 0.01, 0.1)
+    rpc.pending = {xid: None for xid in range(4)}
+
+    assert rpc.read_timeout() == 2.0
@@ -0,0 +1,60 @@
+import random
+import time
+
+import pytest
+
+from lib.shard import sharded
+
+#
+# Author: Hegusung
+#
+
+# run functions are defined at the module level, the worker processes import them
+
+def run(targets, output, host_done):
+    # two records per host, the hosts complete out of order across the processes
+    count = 0
+    for target in targets:
+        host, port = target[:2]
+        time.sleep(random.random()*0.002)
+        output({"host": host, "port": port, "data": target[2:]})
+        output({"host": host, "port": port, "data": None})
+        host_done(host, port)
+        count += 1
+
+    return count
+
+def run_failing(targets, output, host_done):
+    for target in targets:
+        raise SystemExit(3)
+
+def test_sharded_keeps_target_order():
+    targets = [("10.0.0.%d" % index, 111) for index in range(200)]
+    records = []
+    done = []
+
+    returned = sharded(targets, 4, run, records.append, host_done=lambda host, port: done.append((host, port)), window=32, batch_size=8, flush_size=4)
+
+    assert done == targets
+    assert [(record["host"], record["port"]) for record in records] == [target for target in targets for _ in range(2)]
+    # one value per process, every target scanned once
+    assert len(returned) == 4
+    assert sum(returned) == len(targets)
+
+def test_sharded_passes_the_sweep_data():
+    targets = [("10.0.0.%d" % index, 111, [{"program": index}]) for index in range(20)]
+    records = []
+
+    sharded(targets, 2, run, records.append, batch_size=3)
+
+    assert [record["data"] for record in records[::2]] == [([{"program": index}],) for index in range(20)]
+
+def test_sharded_no_targets():
+    records = []
+
+    assert sharded([], 2, run, records.append) == [0, 0]
+    assert records == []
+
+def test_sharded_worker_failure():
+    with pytest.raises(Exception, match="exited with code 3"):
+        sharded([("10.0.0.1", 111)], 1, run_failing, lambda record: None)
@@ -0,0 +1,108 @@
+import argparse
+from os.path import dirname, abspath, join
+
+import pytest
+
+from lib.utils import parse_rpc_names, RPCNames, load_rpc_names, positive_float
+
+#
+# Author: Hegusung
+#
+
+rpc_names_csv = join(dirname(dirname(abspath(__file__))), 'rpc_names.csv')
+
+def write_csv(tmp_path, rows):
+    path = tmp_path / "rpc_names.csv"
+    path.write_text("Description/Owner,RPC Program Number,Short Name,Reference\n" + "".join("%s\n" % row for row in rows))
+
+    return str(path)
+
+def test_parse_rpc_names(tmp_path):
+    path = write_csv(tmp_path, [
+        "portmapper,100000,pmapprog,[RFC5531]",
+        "Unassigned,100173 - 100174,,[RFC5531]",
+        ",100405-100409,[unknown],[RFC5531]",
+    ])
+
+    assert parse_rpc_names(path) == [
+        {"name": "portmapper", "range": range(100000, 100001)},
+        {"name": "Unassigned", "range": range(100173, 100175)},
+        # no description, the short name is used
+        {"name": "[unknown]", "range": range(100405, 100410)},
+    ]
+
+def test_lookup():
+    names = RPCNames.from_rpc_names([
+        {"name": "a", "range": range(10, 20)},
+        {"name": "b", "range": range(20, 21)},
+        {"name": "c", "range": range(30, 40)},
+    ])
+
+    assert names.lookup(9) == None
+    assert names.lookup(10) == "a"
+    assert names.lookup(19) == "a"
+    assert names.lookup(20) == "b"
+    assert names.lookup(21) == None
+    assert names.lookup(29) == None
+    assert names.lookup(39) == "c"
+    assert names.lookup(40) == None
+
+def test_lookup_first_row_wins():
+    names = RPCNames.from_rpc_names([
+        {"name": "a", "range": range(15, 16)},
+        {"name": "b", "range": range(10, 20)},
+        {"name": "c", "range": range(18, 30)},
+    ])
+
+    assert [names.lookup(program) for program in [10, 14, 15, 16, 17, 18, 19, 20, 29, 30]] == ["b", "b", "a", "b", "b", "b", "b", "c", "c", None]
+
+def test_lookup_merges_adjacent_intervals():
+    names = RPCNames.from_rpc_names([
+        {"name": "a", "range": range(0, 5)},
+        {"name": "a", "range": range(5, 10)},
+    ])
+
+    assert names.starts == [0]
+    assert names.ends == [10]
+
+def test_lookup_empty():
+    assert RPCNames.from_rpc_names([]).lookup(100000) == None
+
+def test_range_ends_are_inclusive(tmp_path):
+    path = write_csv(tmp_path, [
+        "first,10 - 19,,",
+        "second,20,,",
+    ])
+    names = RPCNames.from_rpc_names(parse_rpc_names(path))
+
+    assert names.lookup(19) == "first"
+    assert names.lookup(20) == "second"
+
+def test_real_csv():
+    names = load_rpc_names(rpc_names_csv)
+
+    assert names.lookup(100000) == "portmapper"
+    assert names.lookup(100003) == "nfs"
+    assert names.lookup(100005) == "mount demon"
+    assert names.lookup(100174) == "Unassigned"
+    assert load_rpc_names(rpc_names_csv) is names
+
+def test_real_csv_matches_a_linear_search():
+    rpc_names = parse_rpc_names(rpc_names_csv)
+    names = RPCNames.from_rpc_names(rpc_names)
+
+    for program in list(range(99990, 100600)) + [2**31, 2**32-1]:
+        expected = None
+        for rpc_service in rpc_names:
+            if program in rpc_service["range"]:
+                expected = rpc_service["name"]
+                break
+
+        assert names.lookup(program) == expected
+
+def test_positive_float():
+    assert positive_float("0.5") == 0.5
+
+    for value in ["0", "-1", "abc", "nan"]:
+        with pytest.raises(argparse.ArgumentTypeError):
+            positive_float(value)
@@ -0,0 +1,92 @@
+import struct
+
+import pytest
+
+from lib.xdr import Packer, Unpacker
+
+#
+# Author: Hegusung
+#
+
+def test_round_trip():
+    packer = Packer(8)
+    packer.pack_uint(7)
+    packer.pack_uhyper(2**40 + 3)
+    packer.pack_opaque(b"abcde")
+    packer.pack_string("dir")
+    packer.pack_fixed(b"xy")
+    packer.pack_uint(1)
+
+    unpacker = Unpacker(bytes(packer.get_view()))
+    assert unpacker.unpack_uint() == 7
+    assert unpacker.unpack_uhyper() == 2**40 + 3
+    assert unpacker.unpack_opaque() == b"abcde"
+    assert unpacker.unpack_string() == "dir"
+    assert bytes(unpacker.unpack_fixed_view(2)) == b"xy"
+    assert unpacker.unpack_bool()
+    assert unpacker.remaining() == 0
+
+def test_padding():
+    packer = Packer()
+    packer.pack_opaque(b"abcde")
+    packer.pack_fixed(b"abc")
+
+    assert bytes(packer.get_view()) == b"\x00\x00\x00\x05abcde\x00\x00\x00abc\x00"
+
+def test_packer_grows_without_breaking_previous_views():
+    packer = Packer(4)
+    packer.pack_uint(1)
+    view = packer.get_view()
+    packer.pack_opaque(b"x"*100)
+
+    assert bytes(view) == b"\x00\x00\x00\x01"
+    assert len(packer.get_view()) == 4 + 4 + 100
+
+def test_packer_reset():
+    packer = Packer()
+    packer.pack_uint(1)
+    packer.reset()
+    packer.pack_uint(2)
+
+    assert bytes(packer.get_view()) == b"\x00\x00\x00\x02"
+
+def test_opaque_is_a_view_on_the_data():
+    data = b"\x00\x00\x00\x03abc\x00"
+    view = Unpacker(data).unpack_opaque_view()
+
+    assert isinstance(view, memoryview)
+    assert view.obj is data
+    assert bytes(view) == b"abc"
+
+def test_offset():
+    unpacker = Unpacker(b"\x00\x00\x00\x01\x00\x00\x00\x02", offset=4)
+
+    assert unpacker.unpack_uint() == 2
+    assert unpacker.remaining() == 0
+
+def test_truncated_uint():
+    with pytest.raises(struct.error):
+        Unpacker(b"\x00\x00\x01").unpack_uint()
+
+def test_truncated_uhyper():
+    with pytest.raises(struct.error):
+        Unpacker(b"\x00"*7).unpack_uhyper()
+
+def test_opaque_longer_than_the_data():
+    # the length comes from the network, it must not be trusted
+    with pytest.raises(struct.error):
+        Unpacker(b"\x00\x00\x00\x08abcd").unpack_opaque()
+
+    with pytest.raises(struct.error):
+        Unpacker(b"\xff\xff\xff\xff").unpack_string()
+
+def test_opaque_padding_is_not_required_at_the_end():
+    # the padding of the last field is skipped, not read
+    assert Unpacker(b"\x00\x00\x00\x03abc").unpack_opaque() == b"abc"
+
+def test_skip_past_the_end():
+    unpacker = Unpacker(b"\x00"*8)
+    unpacker.skip(8)
+
+    with pytest.raises(struct.error):
+        unpacker.skip(1)